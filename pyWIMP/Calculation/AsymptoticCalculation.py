@@ -0,0 +1,172 @@
+import RootFindingExclusionCalculation
+import ROOT
+import math
+from ..utilities.compact_results import compact_curve
+
+class AsymptoticCalculation(RootFindingExclusionCalculation.RootFindingExclusionCalculation):
+    """
+    Calculates upper limits from the asymptotic distribution of the
+    one-sided profile likelihood test statistic, q_mu (Cowan, Cranmer,
+    Gross, Vitells, Eur. Phys. J. C71 (2011) 1554), instead of from a
+    scan or from toys.  The standard deviation of the amplitude is
+    taken from the background-only Asimov data set, sigma^2 = mu^2/q_mu,A.
+
+    The confidence level is one-sided, i.e. a limit is found where
+    the p-value of the signal hypothesis is 1 - cl.  By default
+    the p-value is CLs+b, setting use_cls uses CLs = CLs+b/CLb.
+    The limit is solved for with Brent's method, needing only the
+    unconditional fit plus a handful of conditional fits.
+    """
+    def __init__(self, exit_manager = None):
+        RootFindingExclusionCalculation.RootFindingExclusionCalculation.__init__(
+            self, exit_manager)
+        self.use_cls = False
+
+    def set_use_cls(self, set_c = True): self.use_cls = set_c
+
+    def p_values(self, q_mu, q_mu_asimov):
+        """
+        Returns (CLs+b, CLb) for the value q_mu of the test statistic,
+        q~_mu, given q_mu,A = mu^2/sigma^2 from the Asimov data set.
+        """
+        q_mu = max(q_mu, 0)
+        if q_mu_asimov <= 0: return (1 - ROOT.TMath.Freq(math.sqrt(q_mu)), 1.)
+        sqrt_q_asimov = math.sqrt(q_mu_asimov)
+        if q_mu <= q_mu_asimov:
+            p_sb = 1 - ROOT.TMath.Freq(math.sqrt(q_mu))
+            cl_b = ROOT.TMath.Freq(sqrt_q_asimov - math.sqrt(q_mu))
+        else:
+            p_sb = 1 - ROOT.TMath.Freq((q_mu + q_mu_asimov)/(2*sqrt_q_asimov))
+            cl_b = ROOT.TMath.Freq((q_mu_asimov - q_mu)/(2*sqrt_q_asimov))
+        return (p_sb, cl_b)
+
+    def find_confidence_value_for_model(self,
+                                        model,
+                                        data,
+                                        model_amplitude,
+                                        conf_level,
+                                        mult_factor,
+                                        print_level = -1,
+                                        verbose = False,
+                                        debug = False,
+                                        tolerance = 0.001):
+
+        if conf_level == 0: return None
+        tolerance = math.fabs(tolerance)
+        # conf_level is the delta NLL, convert back to the one-sided
+        # size of the test, alpha
+        alpha = ROOT.TMath.Prob(2*conf_level, 1)
+        z_alpha = ROOT.TMath.NormQuantile(1 - alpha)
+
+        nll, minuit = self.get_fit_context(model, data, verbose)
+        self.fit_background_only(minuit, model, data, model_amplitude)
+        zero_nll = nll.getVal()
+
+        # The Asimov data set is generated with the background-only
+        # (conditional) values of the parameters, which are also
+        # the values at the minimum of its NLL
+        asimov_data = model.generateBinned(model.getObservables(data),
+                                           ROOT.RooFit.ExpectedData())
+        # The Asimov data set is destroyed however the search ends
+        try:
+            asimov_nll, asimov_minuit = self.get_fit_context(model, asimov_data,
+                                                             verbose, 'asimov')
+            asimov_min_nll = asimov_nll.getVal()
+
+            # Now fit with the model_amplitude
+            model_amplitude.setConstant(False)
+            minuit.migrad()
+            min_nll = nll.getVal()
+            best_fit = model_amplitude.getVal()
+            best_fit_error = model_amplitude.getError()
+
+            self.evaluated_points = []
+            self.number_of_fits = 2
+            model_amplitude.setConstant(True)
+            floating = self.get_floating_parameters(model, data, model_amplitude)
+            bounded_min_nll = min_nll
+            if best_fit < 0: bounded_min_nll = zero_nll
+
+            def q_mu_asimov(value):
+                # Fit the Asimov data set without disturbing the
+                # parameters of the fits to the data
+                saved = [(var.getVal(), var.getError()) for var in floating]
+                q_asimov = 2*(self.profile_nll(asimov_minuit, asimov_nll,
+                                               model_amplitude, value, False) -
+                              asimov_min_nll)
+                for var, (val, err) in zip(floating, saved):
+                    var.setVal(val)
+                    var.setError(err)
+                return q_asimov
+
+            def bounded_func(value):
+                q_mu = 2*(self.profile_nll(minuit, nll, model_amplitude, value) -
+                          bounded_min_nll)
+                if best_fit >= 0 and not self.use_cls:
+                    # q~_mu = q_mu, and the Asimov data set is not needed
+                    p_sb, cl_b = self.p_values(q_mu, q_mu)
+                else:
+                    p_sb, cl_b = self.p_values(q_mu, q_mu_asimov(value))
+                if self.use_cls: return alpha - p_sb/cl_b
+                return alpha - p_sb
+
+            # The first guess of the distance to the crossing assumes a
+            # parabolic likelihood
+            step = best_fit_error*z_alpha
+            if step <= 0: step = 1.
+
+            # At the start of the search q~_mu = 0, so that CLs+b = 0.5,
+            # but CLs is only 1 if the search starts at 0 (otherwise CL_b
+            # is below 1), so the function is evaluated there
+            start = max(best_fit, 0)
+            f_start = bounded_func(start)
+            bounded_limit = self.find_crossing(bounded_func,
+                start, f_start, step, tolerance = tolerance*alpha)
+            if bounded_limit is None: return self.get_crossing_failure()
+
+            # The unbounded limits use q_mu with a Gaussian distribution,
+            # which is the crossing of the profile likelihood
+            delta_nll = 0.5*z_alpha*z_alpha
+            def unbounded_func(value):
+                return self.profile_nll(minuit, nll, model_amplitude, value) - \
+                       min_nll - delta_nll
+            unbounded_upper_limit = self.find_crossing(unbounded_func,
+                best_fit, -delta_nll, step, tolerance = tolerance)
+            if unbounded_upper_limit is None: 
+                return self.get_crossing_failure()
+            unbounded_lower_limit = best_fit
+            if best_fit > 0:
+                unbounded_lower_limit = self.find_crossing(unbounded_func,
+                    best_fit, -delta_nll, -min(step, best_fit),
+                    lower_bound = 0, tolerance = tolerance)
+                if unbounded_lower_limit is None: 
+                    return self.get_crossing_failure()
+
+            output_dict = {}
+            if self.debug:
+                output_dict.update(compact_curve(self.evaluated_points, min_nll))
+
+            # Save these bounds in the output dictionary
+            output_dict['unbounded_lower_limit'] = unbounded_lower_limit*mult_factor
+            output_dict['unbounded_upper_limit'] = unbounded_upper_limit*mult_factor
+            output_dict['bounded_limit'] = bounded_limit*mult_factor
+            output_dict['best_fit'] = best_fit*mult_factor
+            output_dict['mult_factor'] = mult_factor
+            output_dict['number_of_fits'] = self.number_of_fits
+
+            model_amplitude.setVal(bounded_limit)
+            minuit.migrad()
+
+            # Return the results
+            return output_dict
+        finally:
+            asimov_data.IsA().Destructor(asimov_data)
+
+class AsymptoticCLsCalculation(AsymptoticCalculation):
+    """
+    AsymptoticCalculation using CLs for the bounded limit.
+    """
+    def __init__(self, exit_manager = None):
+        AsymptoticCalculation.__init__(self, exit_manager)
+        self.use_cls = True
+
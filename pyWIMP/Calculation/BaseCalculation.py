@@ -1,8 +1,12 @@
 import ROOT
 import os
 import sys
+import math
+import numpy
 from exceptions import Exception
 from ..utilities.utilities import rescale_frame
+from ..utilities.budget import ToyBudget
+from ..utilities.convergence import QuantileMonitor
 class BaseCalculation:
 
     def __init__(self, exit_manager = None):
@@ -13,6 +17,19 @@ class BaseCalculation:
         self.plot_base_name = ""
         self.input_variables = {}
         self.print_out_plots = False
+        self.asimov = False
+        self.toy_bank = None
+        self.first_iteration = 0
+        self.hypotheses = None
+        self.background_only_fit = None
+        self.expected_binned_data = None
+        self.list_components = None
+        self.fit_contexts = {}
+        self.result_callback = None
+        self.completed_iterations = set()
+        self.iteration_source = None
+        self.budget = None
+        self.quantile_monitor = None
 
     def is_exit_requested(self):
         if not self.exit_manager: return False
@@ -26,6 +43,130 @@ class BaseCalculation:
         self.show_plots = set_p 
     def set_plot_base_name(self, name): 
         self.plot_base_name = name 
+    def set_asimov(self, set_a = True): 
+        self.asimov = set_a 
+    def set_first_iteration(self, first): 
+        self.first_iteration = first 
+
+    def set_hypotheses(self, hypotheses):
+        """
+        Sets a list of signal hypotheses, (set_hypothesis, outputs), 
+        which every toy is fitted against.  set_hypothesis() sets up 
+        the model for the hypothesis and returns its mult_factor, the 
+        dictionary outputs is added to the results of the hypothesis.  
+        """
+        self.hypotheses = hypotheses
+
+    def set_result_callback(self, callback):
+        """
+        Sets a function called with (iteration, seed, results) when 
+        an iteration of the scan has finished, results being the list
+        of its output dictionaries.
+        """
+        self.result_callback = callback
+
+    def set_completed_iterations(self, iterations):
+        """
+        Sets the iterations (counted from first_iteration) which were
+        already completed, e.g. by a previous job, and are skipped.
+        """
+        self.completed_iterations = iterations
+
+    def set_iteration_source(self, source):
+        """
+        Sets a function returning the next iteration to perform, or
+        None when there are no more, e.g. to pull iterations from a
+        queue shared with other processes.  first_iteration and
+        completed_iterations are then not used.
+        """
+        self.iteration_source = source
+
+    def set_deadline(self, deadline):
+        """
+        Sets the time (as from time.time()) by which the scan must
+        have finished, toys are only started if they are predicted to
+        finish before it (see ToyBudget).
+        """
+        self.budget = None
+        if deadline: self.budget = ToyBudget(deadline)
+
+    def set_stop_precision(self, precision, min_toys = 20):
+        """
+        Sets stopping the scan once the median and the +-1 and +-2
+        sigma quantiles of the bounded_limit of the toys are known to
+        the relative precision (see QuantileMonitor), with at least
+        min_toys toys.  0 disables this.
+        """
+        self.quantile_monitor = None
+        if precision: 
+            self.quantile_monitor = QuantileMonitor(precision, 
+                                                    min_toys = min_toys)
+
+    def get_toys_per_hour(self):
+        """
+        Returns the number of toys per hour measured against the 
+        deadline, or None.
+        """
+        if not self.budget: return None
+        return self.budget.get_toys_per_hour()
+
+    def get_next_iteration(self, last_iteration, number_iterations):
+        """
+        Returns the iteration to perform after last_iteration (None
+        at the start), or None if there are no more, or if it 
+        wouldn't finish before the deadline, or if the quantiles of
+        the limit are known to the requested precision (see 
+        set_stop_precision).  Without an iteration
+        source, these are the number_iterations iterations from 
+        first_iteration which aren't completed.
+        """
+        if self.budget and not self.budget.can_start():
+            self.logging("Process %s: Stopping, a toy wouldn't finish before the deadline"
+                         % os.getpid())
+            return None
+        if self.quantile_monitor and self.quantile_monitor.is_converged():
+            self.logging("Process %s: Stopping, the quantiles of the limit are known to %g after %i toys"
+                         % (os.getpid(), self.quantile_monitor.get_relative_precision(),
+                            self.quantile_monitor.number_of_toys))
+            return None
+        if self.iteration_source: 
+            iteration = self.iteration_source()
+        else:
+            iteration = self.first_iteration
+            if last_iteration is not None: iteration = last_iteration + 1
+            while iteration in self.completed_iterations: iteration += 1
+            if iteration >= self.first_iteration + number_iterations: 
+                iteration = None
+        if self.budget and iteration is not None: self.budget.start()
+        return iteration
+
+    def finish_iteration(self, iteration, seed, results):
+        """
+        Called when an iteration has finished with the list results,
+        or was skipped if results is None.
+        """
+        if self.budget: self.budget.finish()
+        if results is not None and self.quantile_monitor:
+            self.quantile_monitor.add(results)
+        if results is not None and self.result_callback:
+            self.result_callback(iteration, seed, results)
+
+    def set_toy_bank(self, bank, energy, time, weighting = None):
+        """
+        Replay the toys of a ToyBank instead of generating them.  
+        energy, time and weighting are the RooRealVars filled with 
+        the columns of the bank.
+        """
+        self.toy_bank = (bank, energy, time, weighting)
+
+    def set_list_components(self, pdf_list, yield_list):
+        """
+        Sets the extended components of the fitting model, the 
+        (normalized) pdfs in pdf_list with the number of events in
+        yield_list.  Only used by calculations which evaluate the 
+        likelihood themselves.
+        """
+        self.list_components = (pdf_list, yield_list)
 
     def set_input_variables(self, input):
         self.input_variables = input
@@ -72,6 +213,150 @@ class BaseCalculation:
                 raw_input("Hit Enter to continue")
 
 
+    def get_floating_parameters(self, model, data, model_amplitude):
+        """
+        Returns a list of the parameters of model which are floated 
+        in a fit to data, not including model_amplitude.
+        """
+        floating = []
+        var_iter = model.getParameters(data).createIterator()
+        while 1:
+            var_obj = var_iter.Next()
+            if not var_obj: break
+            if var_obj.isConstant(): continue
+            if var_obj.GetName() == model_amplitude.GetName(): continue
+            floating.append(var_obj)
+        return floating
+
+    def get_fit_context(self, model, data, verbose = False, name = 'data'):
+        """
+        Returns (nll, minuit) to fit model to data.  The NLL and the
+        minimizer are built the first time and kept (by name) for the
+        following calls, which only swap in the new data with setData.
+        This avoids setting up the normalization integrals and the
+        constant term optimization of the NLL again for every toy.
+        The data isn't cloned, so it must not be deleted while it 
+        is being fitted.
+        """
+        context = self.fit_contexts.get(name)
+        if context is not None:
+            context_model, data_class, nll, minuit = context
+            if context_model is model and data_class == data.IsA().GetName():
+                nll.setData(data, False)
+                return nll, minuit
+            # The NLL is of a different type for binned data
+            for obj in [minuit, nll]:
+                obj.IsA().Destructor(obj)
+        nll = model.createNLL(data, ROOT.RooFit.Verbose(verbose), 
+                              ROOT.RooFit.CloneData(False))
+        minuit = ROOT.RooMinuit(nll)
+        self.fit_contexts[name] = (model, data.IsA().GetName(), nll, minuit)
+        return nll, minuit
+
+    def fit_background_only(self, minuit, model, data, model_amplitude):
+        """
+        Performs the fit with model_amplitude fixed at 0.  While data
+        is being fitted against several hypotheses, the result of this
+        fit is the same for all of them, so it is only performed the
+        first time and the floating parameters are reset to its 
+        result afterwards.
+        """
+        model_amplitude.setVal(0)
+        model_amplitude.setConstant(True)
+        if self.background_only_fit is None or \
+           self.background_only_fit[0] is not data:
+            minuit.migrad()
+            return
+        saved = self.background_only_fit[1]
+        if saved is None:
+            minuit.migrad()
+            floating = self.get_floating_parameters(model, data, model_amplitude)
+            saved = [(var, var.getVal(), var.getError()) for var in floating]
+            self.background_only_fit = (data, saved)
+            return
+        for var, val, err in saved:
+            var.setVal(val)
+            var.setError(err)
+
+    def scan_profile_likelihood(self,
+                                minuit,
+                                model,
+                                data,
+                                model_amplitude,
+                                test_points,
+                                start_value,
+                                keep_results = False,
+                                plot_points = False):
+        """
+        Performs a fit at each value in test_points with model_amplitude
+        held constant.  The points are not visited in increasing order,
+        instead the scan starts at the point closest to start_value
+        (normally the best fit) and walks outward in both directions.  
+        Before each fit, the floating parameters are reset to the 
+        values and errors (which RooMinuit uses as initial step sizes) 
+        of the nearest neighbour that has already converged.  This keeps 
+        migrad close to the minimum and avoids walking into spurious
+        minima far from the best fit.  Only the diagonal errors are 
+        passed on, RooMinuit has no way to start migrad from the 
+        neighbour's error matrix.
+
+        Returns a tuple (output_list, fit_results) where output_list is
+        an array of [test_val, min_nll] in the order of test_points 
+        and fit_results is a list of the saved RooFitResults (only if
+        keep_results is set, otherwise they are destroyed and None is 
+        returned).  Returns (None, None) if an exit was requested, 
+        the saved RooFitResults are then destroyed.
+        """
+        number_of_points = len(test_points)
+        output_list = numpy.zeros((number_of_points, 2))
+        fit_results = None
+        if keep_results: fit_results = [None]*number_of_points
+        floating = self.get_floating_parameters(model, data, model_amplitude)
+        if number_of_points == 0: return output_list, fit_results
+
+        start = numpy.fabs(numpy.asarray(test_points) - start_value).argmin()
+        # (index to fit, index of neighbour to seed from)
+        order = [(start, None)]
+        order.extend([(j, j-1) for j in range(start+1, number_of_points)])
+        order.extend([(j, j+1) for j in range(start-1, -1, -1)])
+
+        seeds = [None]*number_of_points
+        start_seed = [(var.getVal(), var.getError()) for var in floating]
+        for j, neighbour in order:
+            seed = start_seed
+            if neighbour is not None: seed = seeds[neighbour]
+            for var, (val, err) in zip(floating, seed):
+                var.setVal(val)
+                var.setError(err)
+
+            test_val = test_points[j]
+            if self.debug:
+                self.logging("Performing: ", test_val)
+            model_amplitude.setVal(test_val)
+            status = minuit.migrad()
+            res = minuit.save(str(test_val))
+            output_list[j] = [test_val, res.minNll()]
+            if keep_results: fit_results[j] = res
+            else: res.IsA().Destructor(res)
+
+            # Only seed neighbours from converged fits, otherwise 
+            # pass on the seed that this fit was given
+            if status == 0:
+                seeds[j] = [(var.getVal(), var.getError()) for var in floating]
+            else:
+                seeds[j] = seed
+
+            if plot_points:
+                self.print_plot(model, data, str(test_val))
+            # This is the most dense loop, so checking if we should get out
+            if self.is_exit_requested(): 
+                if keep_results:
+                    for res in fit_results:
+                        if res: res.IsA().Destructor(res)
+                return None, None
+
+        return output_list, fit_results
+
     def find_confidence_value_for_model(self, 
                                         model, 
                                         data, 
@@ -85,6 +370,187 @@ class BaseCalculation:
         print "Base Class: BaseCalculation being called."
         return None
 
+    def get_asimov_data_set(self, data_model, variables):
+        """
+        Returns the Asimov data set of data_model, a RooDataHist where 
+        each bin holds the expected number of counts.  The binning is
+        taken from the variables.
+        """
+        return data_model.generateBinned(variables, ROOT.RooFit.ExpectedData())
+
+    def add_asimov_bands(self, output_dict, confidence_value):
+        """
+        Adds the median limit and the +-1, +-2 sigma bands to the 
+        output_dict of a fit to the Asimov data set.  In the asymptotic
+        limit, the Asimov limit, mu_A, is the median limit and the 
+        standard deviation of the amplitude is sigma_A = mu_A/Z where 
+        Z = sqrt(confidence_value).  The band at N sigma is then 
+        sigma_A*(Z + N), bounded below at 0. 
+        """
+        z_value = math.sqrt(confidence_value)
+        median = output_dict['bounded_limit']
+        sigma = median/z_value
+        output_dict['median_limit'] = median 
+        output_dict['asimov_sigma'] = sigma 
+        for name, n_sigma in [('minus_two_sigma', -2), ('minus_one_sigma', -1),
+                              ('plus_one_sigma', 1), ('plus_two_sigma', 2)]: 
+            output_dict['limit_%s' % name] = max(sigma*(z_value + n_sigma), 0)
+        return output_dict
+
+    def asimov_confidence_values_for_model(self, 
+                                           model, 
+                                           data_model, 
+                                           variables, 
+                                           model_amplitude, 
+                                           mult_factor, 
+                                           cl):
+        """
+        Performs a single profile likelihood calculation on the Asimov 
+        data set of data_model (see get_asimov_data_set) instead of 
+        fitting toys, with each of the hypotheses (see set_hypotheses)
+        if there are any.  The returned list has one entry per 
+        hypothesis holding the limits of the Asimov data set and, if 
+        available, the median limit and the bands.
+        """
+        print_level = -1
+        verbose = self.debug
+        if self.debug: print_level = 3
+
+        confidence_value = ROOT.TMath.ChisquareQuantile(cl, 1) 
+        asimov_data = self.get_asimov_data_set(data_model, variables)
+        self.logging("Fitting Asimov data set")
+        model_amplitude.setVal(0)
+        list_of_values = self.find_confidence_values_for_hypotheses(
+            model, 
+            asimov_data, 
+            model_amplitude, 
+            confidence_value/2,
+            mult_factor,
+            print_level,
+            verbose)
+        asimov_data.IsA().Destructor(asimov_data)
+        # The Asimov data set is fixed, so a retry wouldn't help 
+        if not list_of_values or list_of_values == self.retry_error: 
+            return []
+        for get_val in list_of_values:
+            if 'bounded_limit' in get_val.keys():
+                self.add_asimov_bands(get_val, confidence_value)
+        return list_of_values
+
+    def get_toy_seed(self):
+        """
+        Draws a seed for the next toy and seeds the random generator
+        with it.  Returns the seed.
+        """
+        random = ROOT.RooRandom.randomGenerator()
+        seed = random.Integer(2147483646) + 1
+        random.SetSeed(seed)
+        return seed
+
+    def generate_binned_toy(self, data_model, variables):
+        """
+        Returns a binned toy of data_model without generating its 
+        events.  The expected number of counts in each bin is 
+        calculated once (for the first toy, after the variables 
+        have been reset) and each toy then draws a Poisson number 
+        for every bin, so that generating is O(bins) instead of 
+        O(events).  Returns None if no counts are expected.
+        """
+        if self.expected_binned_data is None or \
+           self.expected_binned_data[0] is not data_model or \
+           self.expected_binned_data[1] is not variables:
+            expected = self.get_asimov_data_set(data_model, variables)
+            self.expected_binned_data = (data_model, variables, expected)
+        expected = self.expected_binned_data[2]
+        if expected.sumEntries() <= 0: return None
+
+        random = ROOT.RooRandom.randomGenerator()
+        data_set = ROOT.RooDataHist(expected, "%s_toy" % data_model.GetName())
+        for i in range(expected.numEntries()):
+            expected.get(i)
+            data_set.get(i)
+            data_set.set(random.Poisson(expected.weight()))
+        return data_set
+
+    def generate_toy(self, data_model, variables, do_bin_data, toy_index):
+        """
+        Returns the data set of toy toy_index, taken from the toy bank
+        if one is set, otherwise generated from data_model.  Binned
+        toys are drawn directly from the expected counts in each bin 
+        (see generate_binned_toy).  Returns None if the toy couldn't 
+        be generated.
+        """
+        if self.toy_bank:
+            bank, energy, time, weighting = self.toy_bank
+            if toy_index >= bank.get_number_of_toys():
+                self.logging("Toy (%i) is not in the toy bank." % toy_index)
+                return None
+            if do_bin_data:
+                # Histogrammed directly from the columns of the bank
+                return bank.get_data_hist(toy_index, variables, 
+                                          energy, time, weighting)
+            data_set_func = bank.get_data_set(toy_index, variables, 
+                                              energy, time, weighting)
+        elif do_bin_data:
+            return self.generate_binned_toy(data_model, variables)
+        else:
+            data_set_func = data_model.generate(variables)
+        if do_bin_data and data_set_func:
+            data_cache = data_set_func
+            data_set_func = data_cache.binnedClone()
+            data_cache.IsA().Destructor(data_cache)
+        return data_set_func
+
+    def find_confidence_values_for_hypotheses(self, 
+                                              model, 
+                                              data, 
+                                              model_amplitude, 
+                                              conf_level, 
+                                              mult_factor, 
+                                              print_level = -1, 
+                                              verbose = False):
+        """
+        Calls find_confidence_value_for_model for data with each of 
+        the hypotheses (see set_hypotheses), or once with mult_factor 
+        if there are none.  Returns the list of results, or None or
+        retry_error if any of the calls returned it.
+        """
+        if not self.hypotheses:
+            get_val = self.find_confidence_value_for_model(
+                model, 
+                data, 
+                model_amplitude, 
+                conf_level,
+                mult_factor,
+                print_level,
+                verbose,
+                self.show_plots) 
+            if not get_val or get_val == self.retry_error: return get_val
+            return [get_val]
+
+        list_of_values = []
+        # Enables reusing the background-only fit
+        self.background_only_fit = (data, None)
+        for set_hypothesis, outputs in self.hypotheses:
+            model_amplitude.setVal(0)
+            get_val = self.find_confidence_value_for_model(
+                model, 
+                data, 
+                model_amplitude, 
+                conf_level,
+                set_hypothesis(),
+                print_level,
+                verbose,
+                self.show_plots) 
+            if not get_val or get_val == self.retry_error \
+               or self.is_exit_requested(): 
+                list_of_values = get_val 
+                break
+            get_val.update(outputs)
+            list_of_values.append(get_val)
+        self.background_only_fit = None
+        return list_of_values
+
     def scan_confidence_value_space_for_model(self, 
                                               model, 
                                               data_model, 
@@ -95,12 +561,20 @@ class BaseCalculation:
                                               number_iterations, 
                                               cl):
     
+        if self.asimov:
+            return self.asimov_confidence_values_for_model(
+                model, 
+                data_model, 
+                variables,
+                model_amplitude, 
+                mult_factor, 
+                cl)
+
         print_level = -1
         verbose = self.debug
         if self.debug: print_level = 3
 
         list_of_values = []
-        i = 0
         confidence_value = ROOT.TMath.ChisquareQuantile(cl, 1) 
         #ROOT.RooTrace.active(True)
 
@@ -117,36 +591,36 @@ class BaseCalculation:
             scaling = 1./(kilos*time_in_years*365.25)
             axis_title = "Counts/keV/kg/d"
 
-        while i < number_iterations:
+        iteration = self.get_next_iteration(None, number_iterations)
+        while iteration is not None:
             #ROOT.RooTrace.dump(ROOT.cout, True)
             #ROOT.RooTrace.mark()
-            self.logging("Process %s: Iteration (%i) of (%i)" 
-                    % (os.getpid(), i+1, number_iterations))
+            self.logging("Process %s: Iteration (%i)" 
+                    % (os.getpid(), iteration))
             model_amplitude.setVal(0)
 
-            # Generate the data
+            # Generate the data from its own seed, so that 
+            # the toy can be reproduced
+            seed = self.get_toy_seed()
             # Reset the variables to the initial values in the cache
             data_model.getVariables().readFromStream(ROOT.istringstream(var_cache.str()), False)
-            data_set_func = data_model.generate(variables)
-            data_cache = None
-            if do_bin_data:
-                data_cache = data_set_func
-                data_set_func = data_cache.binnedClone()
-            
+            # The toy of the bank is the one of the iteration
+            data_set_func = self.generate_toy(data_model, variables, 
+                                              do_bin_data, iteration)
     
             if not data_set_func:
-                print "Background entries are much too low, need to estimate with FC or Rolke."
+                if not self.toy_bank:
+                    print "Background entries are much too low, need to estimate with FC or Rolke."
                 break
             # Perform the fit and find the limits
-            get_val = self.find_confidence_value_for_model(
+            get_val = self.find_confidence_values_for_hypotheses(
                 model, 
                 data_set_func, 
                 model_amplitude, 
                 confidence_value/2,
                 mult_factor,
                 print_level,
-                verbose,
-                self.show_plots) 
+                verbose)
     
             if not get_val or self.is_exit_requested(): 
                 # There was an error somewhere downstream
@@ -154,12 +628,21 @@ class BaseCalculation:
                 # Get out
                 break
             elif get_val == self.retry_error: 
-                # Calling function requested a retry
+                # Calling function requested a retry, a toy 
+                # of the bank can't be regenerated, so it's skipped 
+                if self.toy_bank:
+                    self.logging("Skipping toy (%i)" % iteration)
+                    self.finish_iteration(iteration, seed, None)
+                    iteration = self.get_next_iteration(iteration, 
+                                                        number_iterations)
                 continue
     
             # Store the results
-            list_of_values.append(get_val)
-            i += 1
+            for a_val in get_val:
+                if self.toy_bank: a_val['toy_index'] = iteration
+                list_of_values.append(a_val)
+            self.finish_iteration(iteration, seed, get_val)
+            iteration = self.get_next_iteration(iteration, number_iterations)
     
             if self.show_plots:
                 var_iter = model.getObservables(data_set_func).createIterator()
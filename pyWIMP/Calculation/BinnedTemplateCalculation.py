@@ -0,0 +1,547 @@
+import RootFindingExclusionCalculation
+import ROOT
+import numpy
+import math
+import os
+from ..utilities.compact_results import compact_curve
+
+class BinnedTemplateCalculation(RootFindingExclusionCalculation.RootFindingExclusionCalculation):
+    """
+    Calculates the same limits as ExclusionCalculation for binned
+    data, but evaluates the extended Poisson likelihood with numpy
+    instead of RooFit.  The pdf of each extended component (see
+    BaseCalculation.set_list_components) is converted once into a
+    template, the expected counts in each bin for a yield of 1, so
+    that the expected counts of the model are a matrix product and
+    the NLL, its gradient and Hessian are cheap array operations.
+
+    Toys are handled in batches, a (K x bins) array of counts, and
+    all K likelihoods are minimized in lockstep: the NLL is profiled
+    over the yields with a damped Newton method (one batched linear
+    solve per iteration) and the crossings are found with a
+    vectorized Illinois (regula falsi) root finder.  The toys are
+    drawn directly as Poisson counts in numpy, or histogrammed from
+    the toy bank.
+
+    Only the yields are floated, the shape parameters of the pdfs
+    are held at their values when the templates are made.  Unbinned
+    data, or a model without components, are passed on to
+    RootFindingExclusionCalculation.
+    """
+    def __init__(self, exit_manager = None):
+        RootFindingExclusionCalculation.RootFindingExclusionCalculation.__init__(
+            self, exit_manager)
+        self.template_cache = {}
+        self.batch_size = 100
+        self.random_state = None
+        self.bank_binning = None
+
+    def set_batch_size(self, size): self.batch_size = size
+
+    def get_random_state(self):
+        """
+        Returns the numpy random generator, created the first time
+        it is needed so that each (forked) process is seeded
+        separately.
+        """
+        if self.random_state is None:
+            self.random_state = numpy.random.RandomState()
+        return self.random_state
+
+    def get_bin_contents(self, data):
+        """
+        Returns an array of the weights of the bins of the
+        RooDataHist data.
+        """
+        contents = numpy.zeros(data.numEntries())
+        for i in range(len(contents)):
+            data.get(i)
+            contents[i] = data.weight()
+        return contents
+
+    def get_template(self, pdf, observables):
+        """
+        Returns the template of pdf, the fraction of its events in
+        each bin of observables.  Templates are cached for the values
+        of the parameters of pdf (e.g. the mass of the WIMP), so that
+        they are only made again if these change.
+        """
+        key = [pdf.GetName()]
+        var_iter = pdf.getParameters(observables).createIterator()
+        while 1:
+            var_obj = var_iter.Next()
+            if not var_obj: break
+            key.append((var_obj.GetName(), var_obj.getVal()))
+        var_iter = observables.createIterator()
+        while 1:
+            var_obj = var_iter.Next()
+            if not var_obj: break
+            key.append((var_obj.GetName(), var_obj.getBins(),
+                        var_obj.getMin(), var_obj.getMax()))
+        key = tuple(key)
+        if key not in self.template_cache:
+            expected = pdf.generateBinned(observables,
+                                          ROOT.RooFit.NumEvents(1),
+                                          ROOT.RooFit.ExpectedData())
+            template = self.get_bin_contents(expected)
+            expected.IsA().Destructor(expected)
+            if template.sum() > 0: template /= template.sum()
+            self.template_cache[key] = template
+        return self.template_cache[key]
+
+    def get_templates(self, observables):
+        """
+        Returns the (components x bins) array of the templates of
+        the components.
+        """
+        pdf_list = self.list_components[0]
+        return numpy.array([self.get_template(pdf_list.at(i), observables)
+                            for i in range(pdf_list.getSize())])
+
+    def set_bank_binning(self, binned_data, variables):
+        """
+        Saves the binning used to histogram the events of the toy
+        bank, the bin edges of each observable and the map from the
+        index of a numpy histogram to the index of a bin in
+        binned_data, found from the centre of the bin.
+        """
+        bank, energy, time, weighting = self.toy_bank
+        columns = []
+        edges = []
+        for column, var in [('energy', energy), ('time', time)]:
+            if not variables.find(var.GetName()): continue
+            binning = var.getBinning()
+            columns.append((column, var.GetName()))
+            edges.append(numpy.array([binning.binLow(j)
+                                      for j in range(binning.numBins())] +
+                                     [binning.highBound()]))
+        shape = [len(bin_edges) - 1 for bin_edges in edges]
+        mapping = numpy.zeros(binned_data.numEntries(), dtype=int)
+        for i in range(len(mapping)):
+            row = binned_data.get(i)
+            index = [numpy.searchsorted(bin_edges, row.getRealValue(name),
+                                        side='right') - 1
+                     for bin_edges, (column, name) in zip(edges, columns)]
+            mapping[numpy.ravel_multi_index(index, shape)] = i
+        self.bank_binning = (columns, edges, mapping)
+
+    def get_bank_counts(self, toy_index):
+        """
+        Returns the array of the counts in each bin of toy toy_index
+        of the toy bank, see set_bank_binning.
+        """
+        bank = self.toy_bank[0]
+        columns, edges, mapping = self.bank_binning
+        toy = bank.get_toy(toy_index)
+        sample = numpy.array([toy[column] for column, name in columns]).T
+        histogram = numpy.histogramdd(sample, bins=edges, weights=toy['weight'])[0]
+        counts = numpy.zeros(len(mapping))
+        counts[mapping] = histogram.ravel()
+        return counts
+
+    def template_nll(self, templates, counts, yields):
+        """
+        Returns the extended Poisson NLLs (without the constant
+        log(n!) terms) of each row of counts given the rows of yields
+        of templates.  The NLL is inf if the expected counts are
+        negative or vanish in a bin with counts.
+        """
+        expected = numpy.dot(yields, templates)
+        has_counts = counts > 0
+        invalid = numpy.any((expected < 0) | ((expected == 0) & has_counts), axis=1)
+        log_expected = numpy.log(numpy.where(has_counts,
+                                             numpy.maximum(expected, 1e-300), 1.))
+        nll = expected.sum(axis=1) - (counts*log_expected).sum(axis=1)
+        nll[invalid] = numpy.inf
+        return nll
+
+    def minimize_nll(self, templates, counts, yields, free, lower, upper,
+                     max_iterations = 100, tolerance = 1e-8):
+        """
+        Minimizes the NLLs of the toys (rows of counts) over the yields
+        of the components where free is set, within the bounds lower
+        and upper, starting at the rows of yields.  Each iteration is a
+        Newton step for all toys with a batched linear solve; the step
+        of a toy is halved until its NLL decreases, and a toy stops
+        once its NLL changes by less than tolerance.  Returns (yields,
+        nll, hessian), hessian being the Hessians of the free yields.
+        """
+        yields = numpy.array(yields, dtype=float)
+        nll = self.template_nll(templates, counts, yields)
+        free_index = numpy.flatnonzero(free)
+        if len(free_index) == 0: return yields, nll, None
+        free_templates = templates[free_index]
+        free_lower, free_upper = lower[free_index], upper[free_index]
+        hessian = numpy.zeros((len(yields), len(free_index), len(free_index)))
+        identity = numpy.identity(len(free_index))
+        active = numpy.ones(len(yields), dtype=bool)
+        for iteration in range(max_iterations):
+            index = numpy.flatnonzero(active)
+            if len(index) == 0: break
+            toy_yields, toy_counts = yields[index], counts[index]
+            expected = numpy.maximum(numpy.dot(toy_yields, templates), 1e-300)
+            ratio = toy_counts/expected
+            gradient = numpy.dot(1 - ratio, free_templates.T)
+            toy_hessian = numpy.dot((ratio/expected)[:, numpy.newaxis, :]*free_templates,
+                                    free_templates.T)
+            hessian[index] = toy_hessian
+            # Regularize templates which only populate empty bins
+            diagonal = numpy.diagonal(toy_hessian, axis1=1, axis2=2)
+            scale = 1e-12*(diagonal.max(axis=1) + 1)
+            regular = toy_hessian + scale[:, numpy.newaxis, numpy.newaxis]*identity
+            try:
+                step = -numpy.linalg.solve(regular, gradient[:, :, numpy.newaxis])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                step = -gradient/numpy.maximum(diagonal, 1e-12)
+
+            damping = numpy.ones(len(index))
+            searching = numpy.ones(len(index), dtype=bool)
+            new_yields, new_nll = toy_yields.copy(), nll[index]
+            for halving in range(35):
+                search = numpy.flatnonzero(searching)
+                if len(search) == 0: break
+                trial = toy_yields[search]
+                trial[:, free_index] = numpy.clip(trial[:, free_index] +
+                    damping[search, numpy.newaxis]*step[search], free_lower, free_upper)
+                trial_nll = self.template_nll(templates, toy_counts[search], trial)
+                improved = trial_nll <= nll[index[search]]
+                new_yields[search[improved]] = trial[improved]
+                new_nll[search[improved]] = trial_nll[improved]
+                searching[search[improved]] = False
+                damping[search[~improved]] /= 2.
+            # Toys where no step improves the NLL are at the minimum
+            converged = searching | (nll[index] - new_nll < tolerance)
+            yields[index], nll[index] = new_yields, new_nll
+            active[index[converged]] = False
+        return yields, nll, hessian
+
+    def find_crossings(self, func, start, f_start, step, lower_bound = None,
+                       upper_bound = 1e16, tolerance = 0.001,
+                       max_iterations = 100):
+        """
+        Vectorized version of find_crossing.  func(values, index)
+        returns the function for the toys index at values.  Starting
+        at start (where func is negative), steps outward in the
+        direction of step, doubling the step of each toy until func
+        changes sign, and then solves for the crossings with the
+        Illinois method.  Toys reaching lower_bound before a sign
+        change get lower_bound, toys exceeding upper_bound get nan.
+        Returns None if an exit was requested.
+        """
+        number_of_toys = len(start)
+        near, f_near = numpy.array(start, dtype=float), numpy.array(f_start, dtype=float)
+        far, f_far = near.copy(), f_near.copy()
+        step = numpy.array(step, dtype=float)
+        x_tolerance = 1e-6*numpy.fabs(step)
+        crossing = numpy.zeros(number_of_toys)*numpy.nan
+        bracketed = numpy.zeros(number_of_toys, dtype=bool)
+        searching = numpy.ones(number_of_toys, dtype=bool)
+        while searching.any():
+            index = numpy.flatnonzero(searching)
+            test = near[index] + step[index]
+            at_bound = numpy.zeros(len(index), dtype=bool)
+            if lower_bound is not None:
+                at_bound = test <= lower_bound
+                test[at_bound] = lower_bound
+            f_test = func(test, index)
+            crossed = f_test >= 0
+            far[index[crossed]], f_far[index[crossed]] = test[crossed], f_test[crossed]
+            bracketed[index[crossed]] = True
+            crossing[index[~crossed & at_bound]] = lower_bound
+            moving = ~crossed & ~at_bound & (test <= upper_bound)
+            near[index[moving]], f_near[index[moving]] = test[moving], f_test[moving]
+            step[index[moving]] *= 2
+            searching[index[~moving]] = False
+            if self.is_exit_requested(): return None
+
+        # Illinois method, the side which was kept last has its
+        # function value halved to avoid the slow convergence of
+        # regula falsi
+        side = numpy.zeros(number_of_toys, dtype=int)
+        for iteration in range(max_iterations):
+            index = numpy.flatnonzero(bracketed)
+            if len(index) == 0: break
+            a, b, f_a, f_b = near[index], far[index], f_near[index], f_far[index]
+            test = (a*f_b - b*f_a)/(f_b - f_a)
+            # Fall back to bisection if the secant leaves the bracket
+            bisect = ~numpy.isfinite(test) | ((test - a)*(test - b) > 0)
+            test[bisect] = 0.5*(a + b)[bisect]
+            f_test = func(test, index)
+            done = ((numpy.fabs(f_test) <= tolerance) |
+                    (numpy.fabs(b - a) <= x_tolerance[index]))
+            crossing[index] = test
+            below = f_test < 0
+            keep_far = index[below]
+            near[keep_far], f_near[keep_far] = test[below], f_test[below]
+            f_far[keep_far[side[keep_far] == -1]] /= 2.
+            side[keep_far] = -1
+            keep_near = index[~below]
+            far[keep_near], f_far[keep_near] = test[~below], f_test[~below]
+            f_near[keep_near[side[keep_near] == 1]] /= 2.
+            side[keep_near] = 1
+            bracketed[index[done]] = False
+            if self.is_exit_requested(): return None
+        return crossing
+
+    def find_confidence_values_for_batch(self, templates, counts, amp,
+                                         start_yields, lower, upper,
+                                         conf_level, tolerance = 0.001):
+        """
+        Calculates the limits for each row of counts, amp being the
+        index of the model_amplitude in the components.  Returns a
+        dictionary with arrays of the unbounded_lower_limit,
+        unbounded_upper_limit and bounded_limit of the yield of amp
+        (nan where a limit wasn't found), of the yields at the
+        bounded_limit and the list of the (amplitude, NLL) points of
+        the profile likelihood evaluated for each toy, or None if an
+        exit was requested.
+        """
+        number_of_toys = len(counts)
+        yields = numpy.tile(start_yields, (number_of_toys, 1))
+        yields[:, amp] = 0
+        nuisance = numpy.ones(len(templates), dtype=bool)
+        nuisance[amp] = False
+        # The profile likelihood isn't bounded by the range of the
+        # amplitude
+        profile_lower, profile_upper = lower.copy(), upper.copy()
+        profile_lower[amp], profile_upper[amp] = -numpy.inf, numpy.inf
+
+        # Background-only fit, then the fit with the model_amplitude
+        zero_yields, zero_nll, hessian = self.minimize_nll(templates, counts,
+            yields, nuisance, profile_lower, profile_upper)
+        best_yields, min_nll, hessian = self.minimize_nll(templates, counts,
+            zero_yields, numpy.ones(len(templates), dtype=bool), lower, upper)
+        best_fit = best_yields[:, amp]
+
+        # The step to the crossings assumes a parabolic likelihood,
+        # with the error from the Hessian
+        try:
+            variance = numpy.linalg.inv(hessian)[:, amp, amp]
+        except numpy.linalg.LinAlgError:
+            variance = 1./numpy.maximum(hessian[:, amp, amp], 1e-300)
+        step = numpy.ones(number_of_toys)
+        good = numpy.isfinite(variance) & (variance > 0)
+        step[good] = numpy.sqrt(2*conf_level*variance[good])
+
+        # The points of the profile likelihood curve of each toy
+        evaluated_points = [[(best_fit[i], min_nll[i])]
+                            for i in range(number_of_toys)]
+        # Warm start each profile fit from the last fit of the toy
+        seeds = best_yields.copy()
+        def profile_nll(values, index):
+            toy_yields = seeds[index]
+            toy_yields[:, amp] = values
+            toy_yields, nll, toy_hessian = self.minimize_nll(templates,
+                counts[index], toy_yields, nuisance, profile_lower, profile_upper)
+            seeds[index] = toy_yields
+            for i, value, toy_nll in zip(index, values, nll):
+                evaluated_points[i].append((value, toy_nll))
+            return nll
+
+        def unbounded_func(values, index):
+            return profile_nll(values, index) - min_nll[index] - conf_level
+
+        # finding unbounded, upper limit
+        unbounded_upper_limit = self.find_crossings(unbounded_func,
+            best_fit, -conf_level*numpy.ones(number_of_toys), step,
+            tolerance = tolerance)
+        if unbounded_upper_limit is None: return None
+
+        # finding unbounded, lower limit, this is not searched for below 0
+        unbounded_lower_limit = best_fit.copy()
+        positive = numpy.flatnonzero(best_fit > 0)
+        if len(positive):
+            seeds[positive] = best_yields[positive]
+            lower_limit = self.find_crossings(
+                lambda values, index: unbounded_func(values, positive[index]),
+                best_fit[positive], -conf_level*numpy.ones(len(positive)),
+                -numpy.minimum(step, best_fit)[positive],
+                lower_bound = 0, tolerance = tolerance)
+            if lower_limit is None: return None
+            unbounded_lower_limit[positive] = lower_limit
+
+        # We only calculate the bounded upper limit if the best fit is below 0,
+        # otherwise it's exactly the same as the unbounded limit
+        bounded_limit = unbounded_upper_limit.copy()
+        negative = numpy.flatnonzero(best_fit < 0)
+        if len(negative):
+            bounded_min_nll = profile_nll(numpy.zeros(len(negative)), negative)
+            limit = self.find_crossings(
+                lambda values, index: profile_nll(values, negative[index]) -
+                                      bounded_min_nll[index] - conf_level,
+                numpy.zeros(len(negative)), -conf_level*numpy.ones(len(negative)),
+                step[negative], tolerance = tolerance)
+            if limit is None: return None
+            bounded_limit[negative] = limit
+
+        found = numpy.flatnonzero(numpy.isfinite(bounded_limit))
+        profile_nll(bounded_limit[found], found)
+        return {'unbounded_lower_limit' : unbounded_lower_limit,
+                'unbounded_upper_limit' : unbounded_upper_limit,
+                'bounded_limit' : bounded_limit,
+                'yields' : seeds,
+                'min_nll' : min_nll,
+                'evaluated_points' : evaluated_points}
+
+    def get_component_ranges(self, model_amplitude):
+        """
+        Returns (yield_vars, amp, lower, upper, start) of the
+        components, amp being the index of model_amplitude.
+        """
+        yield_list = self.list_components[1]
+        yield_vars = [yield_list.at(i) for i in range(yield_list.getSize())]
+        amp = [var.GetName() for var in yield_vars].index(model_amplitude.GetName())
+        lower = numpy.array([var.getMin() for var in yield_vars])
+        upper = numpy.array([var.getMax() for var in yield_vars])
+        start = numpy.array([var.getVal() for var in yield_vars])
+        return yield_vars, amp, lower, upper, start
+
+    def find_confidence_value_for_model(self,
+                                        model,
+                                        data,
+                                        model_amplitude,
+                                        conf_level,
+                                        mult_factor,
+                                        print_level = -1,
+                                        verbose = False,
+                                        debug = False,
+                                        tolerance = 0.001):
+
+        if not self.list_components or not isinstance(data, ROOT.RooDataHist):
+            parent = RootFindingExclusionCalculation.RootFindingExclusionCalculation
+            return parent.find_confidence_value_for_model(self, model, data,
+                model_amplitude, conf_level, mult_factor, print_level,
+                verbose, debug, tolerance)
+        if conf_level == 0: return None
+        tolerance = math.fabs(tolerance)
+
+        yield_vars, amp, lower, upper, start = \
+            self.get_component_ranges(model_amplitude)
+        limits = self.find_confidence_values_for_batch(
+            self.get_templates(model.getObservables(data)),
+            self.get_bin_contents(data)[numpy.newaxis, :],
+            amp, start, lower, upper, conf_level, tolerance)
+        if limits is None or not numpy.isfinite(limits['bounded_limit'][0]):
+            return None
+
+        output_dict = compact_curve(limits['evaluated_points'][0],
+                                    limits['min_nll'][0])
+
+        # Save these bounds in the output dictionary
+        for name in ['unbounded_lower_limit', 'unbounded_upper_limit',
+                     'bounded_limit']:
+            output_dict[name] = limits[name][0]*mult_factor
+        output_dict['mult_factor'] = mult_factor
+
+        # Leave the model at the fit of the bounded limit
+        for var, val in zip(yield_vars, limits['yields'][0]):
+            if val > var.getMax(): var.setMax(val*2)
+            var.setVal(val)
+        return output_dict
+
+    def scan_confidence_value_space_for_model(self,
+                                              model,
+                                              data_model,
+                                              model_amplitude,
+                                              mult_factor,
+                                              variables,
+                                              do_bin_data,
+                                              number_iterations,
+                                              cl):
+
+        if self.asimov or self.show_plots or not do_bin_data or \
+           not self.list_components or self.batch_size <= 1:
+            parent = RootFindingExclusionCalculation.RootFindingExclusionCalculation
+            return parent.scan_confidence_value_space_for_model(self, model,
+                data_model, model_amplitude, mult_factor, variables,
+                do_bin_data, number_iterations, cl)
+
+        confidence_value = ROOT.TMath.ChisquareQuantile(cl, 1)
+        model_amplitude.setVal(0)
+        yield_vars, amp, lower, upper, start = \
+            self.get_component_ranges(model_amplitude)
+
+        expected_data = self.get_asimov_data_set(data_model, variables)
+        expected = self.get_bin_contents(expected_data)
+        if self.toy_bank: self.set_bank_binning(expected_data, variables)
+        expected_data.IsA().Destructor(expected_data)
+        if not self.toy_bank and expected.sum() <= 0:
+            print "Background entries are much too low, need to estimate with FC or Rolke."
+            return []
+
+        hypotheses = self.hypotheses
+        if not hypotheses: hypotheses = [(None, {})]
+        list_of_values = []
+        # Iterations of toys without limits, which are done again
+        retries = []
+        last_iteration = None
+        while 1:
+            batch = retries[:self.batch_size]
+            retries = retries[len(batch):]
+            while len(batch) < self.batch_size:
+                last_iteration = self.get_next_iteration(last_iteration,
+                                                         number_iterations)
+                if last_iteration is None: break
+                batch.append(last_iteration)
+            if self.toy_bank:
+                # The toy of the bank is the one of the iteration
+                number_of_toys = self.toy_bank[0].get_number_of_toys()
+                for iteration in batch:
+                    if iteration >= number_of_toys:
+                        self.logging("Toy (%i) is not in the toy bank." % iteration)
+                        self.finish_iteration(iteration, None, None)
+                batch = [iteration for iteration in batch
+                         if iteration < number_of_toys]
+            if not batch: break
+
+            # Each toy is generated from its own seed, so that it
+            # can be reproduced
+            seeds = self.get_random_state().randint(1, 2147483647, len(batch))
+            if self.toy_bank:
+                counts = numpy.array([self.get_bank_counts(iteration)
+                                      for iteration in batch])
+            else:
+                counts = numpy.array([numpy.random.RandomState(seed).poisson(expected)
+                                      for seed in seeds], dtype=float)
+            self.logging("Process %s: Iterations (%i) to (%i), %i toys"
+                    % (os.getpid(), batch[0], batch[-1], len(batch)))
+
+            # Perform the fits and find the limits for every hypothesis
+            found = numpy.ones(len(batch), dtype=bool)
+            results = []
+            for set_hypothesis, outputs in hypotheses:
+                factor = mult_factor
+                if set_hypothesis: factor = set_hypothesis()
+                limits = self.find_confidence_values_for_batch(
+                    self.get_templates(variables), counts, amp,
+                    start, lower, upper, confidence_value/2)
+                if limits is None: return list_of_values
+                found &= numpy.isfinite(limits['bounded_limit'])
+                results.append((factor, outputs, limits))
+
+            # Store the results.  Toys without limits are generated
+            # again in the next batch, toys of the bank are skipped
+            for k, iteration in enumerate(batch):
+                if not found[k]:
+                    if self.toy_bank:
+                        self.logging("Skipping toy (%i)" % iteration)
+                        self.finish_iteration(iteration, int(seeds[k]), None)
+                    else:
+                        retries.append(iteration)
+                    continue
+                toy_values = []
+                for factor, outputs, limits in results:
+                    output_dict = compact_curve(limits['evaluated_points'][k],
+                                                limits['min_nll'][k])
+                    for name in ['unbounded_lower_limit', 'unbounded_upper_limit',
+                                 'bounded_limit']:
+                        output_dict[name] = limits[name][k]*factor
+                    output_dict['mult_factor'] = factor
+                    output_dict.update(outputs)
+                    if self.toy_bank: output_dict['toy_index'] = iteration
+                    toy_values.append(output_dict)
+                list_of_values.extend(toy_values)
+                self.finish_iteration(iteration, int(seeds[k]), toy_values)
+            if self.is_exit_requested(): break
+
+        return list_of_values
@@ -4,6 +4,7 @@ import os
 import math
 from exceptions import Exception
 from ..utilities.utilities import rescale_frame
+from ..utilities.profile_limits import get_limits_at_level
 import numpy
 
 class DataCalcVerification(DataCalculation.DataCalculation):
@@ -56,9 +57,8 @@ class DataCalcVerification(DataCalculation.DataCalculation):
         #model_amplitude.setMin(-10)
         model_amplitude.setConstant(True)
 
-        nll = model.createNLL(data, ROOT.RooFit.Verbose((print_level > 0)))
+        nll, minuit = self.get_fit_context(model, data, (print_level > 0))
        
-        minuit = ROOT.RooMinuit(nll)
         minuit.setPrintLevel(print_level)
         minuit.migrad()
 
@@ -114,67 +114,35 @@ class DataCalcVerification(DataCalculation.DataCalculation):
         
         model_amplitude.setConstant(True)
         
-        output_list = numpy.zeros((number_of_points, 2)) 
-        j = 0
         step_size = (max_range - min_value)/number_of_points
-        test_value = min_value
-        min_nll = 1e15
-        min_point = 0
-        for j in range(number_of_points): 
-            model_amplitude.setVal(test_value)
-            if self.debug:  
-                self.logging("Performing: ", model_amplitude.getVal())
-            minuit_val = minuit.migrad()
-            saved = minuit.save('temp')
-            
-            if self.debug:  
-                self.logging("Saved: ", saved.minNll())
-                self.logging("Minuit: ", minuit_val)
-                self.logging("Test value: ", test_value)
-                self.logging("NLL: ", nll.getVal())
-            min_val = saved.minNll()
-            output_list[j] = [test_value, min_val]
-            if min_val < min_nll:  
-                min_nll = min_val 
-                min_point = j
-            test_value += step_size
-            saved.IsA().Destructor(saved)
+        test_points = min_value + step_size*numpy.arange(number_of_points)
+        output_list, fit_results = self.scan_profile_likelihood(
+            minuit, model, data, model_amplitude, test_points, 
+            model_amplitude.getVal())
+        if output_list is None: return None
+        min_point = output_list[:,1].argmin()
+        min_nll = output_list[min_point][1]
             
         output_list -= [0, min_nll]
 
         # Now find the confidence_level using unbounded and bounded PLL
         
         best_fit = output_list[min_point][0]
-        unbounded_list = output_list
-        bounded_list = unbounded_list.copy() 
-        if best_fit < 0:
-            bounded_list = output_list[numpy.where(bounded_list[:,0] >= 0)]
-        bounded_list -= [0, bounded_list[0][1]]
-        
-
-        unbounded_curve = ROOT.RooCurve()
-        [unbounded_curve.addPoint(x,y) for x, y in unbounded_list]
-        bounded_curve = ROOT.RooCurve()
-        [bounded_curve.addPoint(x,y) for x, y in bounded_list]
-        # Now find where each rises to the particular value
-        step_size = 0.01
+        # The bounded curve starts at the first point at or above 0
+        zero_nll = output_list[numpy.flatnonzero(output_list[:,0] >= 0)[0]][1]
         
-        unbounded_start = best_fit 
-        while (unbounded_curve.Eval(unbounded_start) < conf_level and 
-               unbounded_start <= model_amplitude.getMax()): unbounded_start += step_size
-        unbounded_upper_limit = unbounded_start 
 
-        unbounded_start =  best_fit
-        while (unbounded_curve.Eval(unbounded_start) < conf_level and unbounded_start >= 0): unbounded_start -= step_size
-        unbounded_lower_limit = unbounded_start 
-
-       
-        bounded_limit = unbounded_upper_limit
-        if best_fit < 0:
-            bounded_start = bounded_curve.Eval(0) 
-            while (bounded_curve.Eval(bounded_start) < conf_level and 
-                   bounded_start <= model_amplitude.getMax()): bounded_start += step_size
-            bounded_limit = bounded_start 
+        # Now find where each rises to the particular value, solving
+        # for the crossing on a parabola through the scan points around
+        # it (see profile_limits)
+        limits = get_limits_at_level(output_list[:,0], output_list[:,1],
+                                     conf_level, zero_nll)
+        unbounded_upper_limit = limits['unbounded_upper_limit'][0]
+        unbounded_lower_limit = limits['unbounded_lower_limit'][0]
+        bounded_limit = limits['bounded_limit'][0]
+        if numpy.isnan(bounded_limit) or numpy.isnan(unbounded_upper_limit):
+            self.logging("The profile likelihood doesn't reach the confidence level in the scan")
+            return self.retry_error
         
         # Now the first value in each of these should be the calculated limit
 
@@ -183,11 +151,7 @@ class DataCalcVerification(DataCalculation.DataCalculation):
             model_amplitude.setVal(bounded_limit)
             minuit.migrad()
             self.print_plot(model, data)
-            minuit.IsA().Destructor(minuit)
-            nll.IsA().Destructor(nll)
             return (best_fit, unbounded_upper_limit, unbounded_lower_limit, bounded_limit, output_list)
-        minuit.IsA().Destructor(minuit)
-        nll.IsA().Destructor(nll)
         return (best_fit, unbounded_upper_limit, unbounded_lower_limit, bounded_limit)
  
  
@@ -218,8 +182,8 @@ class DataCalcVerification(DataCalculation.DataCalculation):
 
         # Perform the fit and find the limits
         list_of_values = []
-        iter = 1
-        for iter in range(number_iterations):
+        iter = 0
+        while iter < number_iterations:
             if self.debug: self.logging("Iteration: %i of %i" % (iter+1, number_iterations))
             data_model = model.generate(variables,  
                             ROOT.RooFit.NumEvents(number_of_events),
@@ -241,8 +205,14 @@ class DataCalcVerification(DataCalculation.DataCalculation):
                 # or an interrupt was signalled
                 # Get out
                 break
+            elif get_val == self.retry_error:
+                # The limits weren't found, try another toy
+                continue
             # Store the results
             list_of_values.append(get_val)
+            if self.result_callback:
+                self.result_callback(iter, None, [get_val])
+            iter += 1
     
         # Reset the variables
         return list_of_values
@@ -4,6 +4,8 @@ import os
 import math
 from exceptions import Exception
 from ..utilities.utilities import rescale_frame
+from ..utilities.compact_results import compact_scan, compact_fit_result
+from ..utilities.profile_limits import get_limits_at_level
 import numpy
 class DataCalculation(ExclusionCalculation.ExclusionCalculation):
 
@@ -28,13 +30,10 @@ class DataCalculation(ExclusionCalculation.ExclusionCalculation):
         number_of_points = 100
         distance_from_min = 20.
         #pars = model.getParameters(data)
-        nll = model.createNLL(data, ROOT.RooFit.Verbose(verbose))
+        nll, minuit = self.get_fit_context(model, data, verbose)
        
         #model_amplitude.setVal(model_amplitude.getMin())
-        model_amplitude.setVal(0)
-        model_amplitude.setConstant(True)
-        minuit = ROOT.RooMinuit(nll)
-        minuit.migrad()
+        self.fit_background_only(minuit, model, data, model_amplitude)
 
         # Now fit with the model_amplitude
         model_amplitude.setVal(0)
@@ -71,42 +70,22 @@ class DataCalculation(ExclusionCalculation.ExclusionCalculation):
         minuit.migrad()
 
 
-        output_list = []
-        pll_curve = ROOT.RooCurve()
-        pll_curve.SetName("pll_frac_plot") 
-
         output_dict = {}
         
-        output_list = numpy.zeros((number_of_points, 2)) 
         model_amplitude.setConstant(True)
 
-        orig = 1e15 
-        min_point = 0
-        j = 0
         step_size = (max_range - min_value)/(number_of_points-1)
         test_points = numpy.arange(min_value, max_range + step_size*0.5, step_size)
-        for test_val in test_points: 
-            print "Performing: ", test_val 
-            model_amplitude.setVal(test_val)
-            minuit.migrad()
-            res = minuit.save(str(test_val)) 
-            min_val = res.minNll()
-                
-            if debug:
-                self.print_plot(model, data, str(test_val))
-            if min_val < orig:  
-                orig = min_val 
-                min_point = j
-            output_dict[str(test_val)] = res 
-            output_list[j] = [test_val, min_val]
-            j += 1
-            #var_cache = ROOT.ostringstream()
-            #model.getVariables().writeToStream(var_cache, False)
-            #output_dict[str(i) + 'vars'] = ROOT.TObjString(var_cache.str())
+        output_list, fit_results = self.scan_profile_likelihood(
+            minuit, model, data, model_amplitude, test_points, 
+            model_amplitude.getVal(), keep_results = True, plot_points = debug)
+        if output_list is None: return None
+        # Only the numbers of the fits are kept (see compact_results)
+        output_dict.update(compact_scan(test_points, fit_results))
+        for res in fit_results: res.IsA().Destructor(res)
+        min_point = output_list[:,1].argmin()
             
-        [pll_curve.addPoint(output_list[i][0], output_list[i][1] - orig) 
-             for i in range(len(output_list))]
-        output_dict['pll_curve'] = pll_curve
+        output_dict['scan_delta_nll'] = output_list[:,1] - min_nll
 
        
         # Now find the confidence_level using unbounded and bounded PLL
@@ -116,57 +95,32 @@ class DataCalculation(ExclusionCalculation.ExclusionCalculation):
         bounded_min_nll = min_nll
         unbounded_list = output_list.copy()
         unbounded_list -= [0, min_nll]
-        bounded_list = output_list.copy() 
         if best_fit < 0:
             # Means the best fit was less than 0, in which case, we need to 
             # bound the lower limit, taking the point where the model_amplitude
             # is equal to 0 
-            bounded_list = output_list[numpy.where(bounded_list[:,0] >= 0)]
             model_amplitude.setVal(0)
             minuit.migrad()
             res = minuit.save()
             bounded_min_nll = res.minNll()
-        # Now this list is shifted correctly
-        bounded_list -= [0, bounded_min_nll]
-        
-
-        # Generate *helper* curves, these allow us to extrapolate
-        # between points assuming that the likelihood is reasonably 
-        # smooth
-        unbounded_curve = ROOT.RooCurve()
-        [unbounded_curve.addPoint(x,y) for x, y in unbounded_list]
-        bounded_curve = ROOT.RooCurve()
-        [bounded_curve.addPoint(x,y) for x, y in bounded_list]
-
-        # Now find where each rises to the particular confidence level value
-        step_size = 0.01
-        
-        # finding unbounded, upper limit
-        unbounded_start = best_fit 
-        while (unbounded_curve.Eval(unbounded_start) < conf_level and 
-               unbounded_start <= model_amplitude.getMax()): unbounded_start += step_size
-        unbounded_upper_limit = unbounded_start 
-
-        # finding unbounded, lower limit
-        unbounded_start =  best_fit
-        while (unbounded_curve.Eval(unbounded_start) < conf_level and 
-               unbounded_start >= 0): unbounded_start -= step_size
-        unbounded_lower_limit = unbounded_start 
-
-       
-        # We only calculate the bounded upper limit if the best fit is below 0,
-        # otherwise it's exactly the same as the unbounded limit
-        bounded_limit = unbounded_upper_limit
-        if best_fit < 0:
-            bounded_start = bounded_curve.Eval(0) 
-            while (bounded_curve.Eval(bounded_start) < conf_level and 
-                   bounded_start <= model_amplitude.getMax()): bounded_start += step_size
-            bounded_limit = bounded_start 
+            res.IsA().Destructor(res)
+        # Now find where each rises to the particular confidence level
+        # value, solving for the crossing on a parabola through the
+        # scan points around it (see profile_limits)
+        limits = get_limits_at_level(unbounded_list[:,0], unbounded_list[:,1],
+                                     conf_level, bounded_min_nll - min_nll)
+        unbounded_upper_limit = limits['unbounded_upper_limit'][0]
+        unbounded_lower_limit = limits['unbounded_lower_limit'][0]
+        bounded_limit = limits['bounded_limit'][0]
+        if numpy.isnan(bounded_limit) or numpy.isnan(unbounded_upper_limit):
+            self.logging("The profile likelihood doesn't reach the confidence level in the scan")
+            return None
         
         # Save these bounds in the output dictionary
         output_dict['unbounded_lower_limit'] = unbounded_lower_limit*mult_factor
         output_dict['unbounded_upper_limit'] = unbounded_upper_limit*mult_factor
         output_dict['bounded_limit'] = bounded_limit*mult_factor
+        output_dict['mult_factor'] = mult_factor
         
 
         # Ok now generate the fits at the bounded points to more easily access them
@@ -174,20 +128,23 @@ class DataCalculation(ExclusionCalculation.ExclusionCalculation):
         model_amplitude.setVal(unbounded_upper_limit)
         minuit.migrad()
         res = minuit.save("unbounded_upper_limit") 
-        output_dict['unbounded_upper_limit_fit_results'] = res
+        output_dict.update(compact_fit_result(res, 'unbounded_upper_limit_fit'))
+        res.IsA().Destructor(res)
 
         # Then at the bounded upper limit 
         model_amplitude.setVal(bounded_limit)
         minuit.migrad()
         res = minuit.save("bounded_limit") 
-        output_dict['bounded_limit_fit_results'] = res
+        output_dict.update(compact_fit_result(res, 'bounded_limit_fit'))
+        res.IsA().Destructor(res)
 
         # And finally get the best fit results, but bounding at 0 if it is below 0
         if best_fit < 0: best_fit = 0
         model_amplitude.setVal(best_fit)
         minuit.migrad()
         res = minuit.save("best_fit") 
-        output_dict['best_fit_fit_results'] = res
+        output_dict.update(compact_fit_result(res, 'best_fit_fit'))
+        res.IsA().Destructor(res)
         
         # Reset the model to be the state of the limit, which is expected by the
         # calling function 
@@ -211,6 +168,25 @@ class DataCalculation(ExclusionCalculation.ExclusionCalculation):
         if self.debug: print_level = 3
         show_plots = self.show_plots or self.print_out_plots
 
+        if self.asimov:
+            # The Asimov data set is built from the background-only 
+            # fit to the data
+            model_amplitude.setVal(0)
+            model_amplitude.setConstant(True)
+            result = model.fitTo(data_model, 
+                                 ROOT.RooFit.Save(True),
+                                 ROOT.RooFit.PrintLevel(print_level),
+                                 ROOT.RooFit.Verbose(verbose))
+            result.IsA().Destructor(result)
+            model_amplitude.setConstant(False)
+            return self.asimov_confidence_values_for_model(
+                model, 
+                model, 
+                variables,
+                model_amplitude, 
+                mult_factor, 
+                cl)
+
         list_of_values = []
         i = 0
         confidence_value = ROOT.TMath.ChisquareQuantile(cl, 1) 
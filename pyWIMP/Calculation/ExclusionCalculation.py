@@ -2,6 +2,8 @@ import BaseCalculation
 import ROOT
 import numpy
 import math
+from ..utilities.compact_results import compact_curve
+from ..utilities.profile_limits import get_limits_at_level
 
 class ExclusionCalculation(BaseCalculation.BaseCalculation):
     """
@@ -25,13 +27,10 @@ class ExclusionCalculation(BaseCalculation.BaseCalculation):
         number_of_points = 50
         distance_from_min = 20.
         #pars = model.getParameters(data)
-        nll = model.createNLL(data, ROOT.RooFit.Verbose(verbose))
+        nll, minuit = self.get_fit_context(model, data, verbose)
        
         #model_amplitude.setVal(model_amplitude.getMin())
-        model_amplitude.setVal(0)
-        model_amplitude.setConstant(True)
-        minuit = ROOT.RooMinuit(nll)
-        minuit.migrad()
+        self.fit_background_only(minuit, model, data, model_amplitude)
 
         # Now fit with the model_amplitude
         model_amplitude.setVal(0)
@@ -91,44 +90,22 @@ class ExclusionCalculation(BaseCalculation.BaseCalculation):
         minuit.migrad()
 
 
-        output_list = []
-
         output_dict = {}
         
-        output_list = numpy.zeros((number_of_points, 2)) 
         model_amplitude.setConstant(True)
 
-        orig = 1e15 
-        min_point = 0
-        j = 0
         step_size = float(max_range - min_value)/(number_of_points-1)
         test_points = numpy.arange(min_value, max_range + step_size*0.5, step_size)
-        pll_curve = ROOT.RooCurve()
-        pll_curve.SetName("pll_frac_plot") 
-        for test_val in test_points: 
-            if self.debug:
-                print "Performing: ", test_val 
-            model_amplitude.setVal(test_val)
-            minuit.migrad()
-            res = minuit.save(str(test_val)) 
-            min_val = res.minNll()
-            res.IsA().Destructor(res)
-                
-            if self.print_out_plots:
-                self.print_plot(model, data, str(test_val))
-            if min_val < orig:  
-                orig = min_val 
-                min_point = j
-            output_list[j] = [test_val, min_val]
-            j += 1
-            # This is the most dense loop, so checking if we should get out
-            if self.is_exit_requested(): return None
-            
+        output_list, fit_results = self.scan_profile_likelihood(
+            minuit, model, data, model_amplitude, test_points, 
+            model_amplitude.getVal(), plot_points = self.print_out_plots)
+        if output_list is None: return None
+        min_point = output_list[:,1].argmin()
+        orig = output_list[min_point][1]
        
-        if self.debug:
-            [pll_curve.addPoint(output_list[i][0], output_list[i][1] - orig) 
-                 for i in range(len(output_list))]
-            output_dict['pll_curve'] = pll_curve
+        # Keep the profile likelihood curve, so that limits at other
+        # confidence levels can be found later (see profile_limits)
+        output_dict.update(compact_curve(output_list, min_nll))
         # Now find the confidence_level using unbounded and bounded PLL
         
         # Grab the best fit value (at the min_point)
@@ -136,73 +113,26 @@ class ExclusionCalculation(BaseCalculation.BaseCalculation):
         bounded_min_nll = min_nll
         unbounded_list = output_list.copy()
         unbounded_list -= [0, min_nll]
-        bounded_list = output_list.copy() 
         if best_fit < 0:
             # Means the best fit was less than 0, in which case, we need to 
             # bound the lower limit, taking the point where the model_amplitude
             # is equal to 0 
-            bounded_list = output_list[numpy.where(bounded_list[:,0] >= 0)]
             model_amplitude.setVal(0)
             minuit.migrad()
             res = minuit.save()
             bounded_min_nll = res.minNll()
             res.IsA().Destructor(res)
-        # Now this list is shifted correctly
-        bounded_list -= [0, bounded_min_nll]
-        
-
-        # Generate *helper* curves, these allow us to extrapolate
-        # between points assuming that the likelihood is reasonably 
-        # smooth
-        unbounded_curve = ROOT.RooCurve()
-        [unbounded_curve.addPoint(x,y) for x, y in unbounded_list]
-        bounded_curve = ROOT.RooCurve()
-        [bounded_curve.addPoint(x,y) for x, y in bounded_list]
-
-        # Now find where each rises to the particular confidence level value
-        # We actually have to be dynamic about the stepsize since we could
-        step_size = 0.01
-        
-        # finding unbounded, upper limit
-        #self.logging("Finding unbound upper")
-        unbounded_start = best_fit 
-        while (unbounded_start <= model_amplitude.getMax()): 
-            # If we overshoot, check it.
-            while (unbounded_curve.Eval(unbounded_start + step_size) >= conf_level and
-                   unbounded_curve.Eval(unbounded_start + step_size) - conf_level > tolerance): 
-                   step_size /= 2.
-            unbounded_start += step_size
-            if math.fabs(unbounded_curve.Eval(unbounded_start) - conf_level) < tolerance: break 
-
-        unbounded_upper_limit = unbounded_start 
-
-        step_size = 0.01
-        # finding unbounded, lower limit
-        unbounded_start =  best_fit
-        #self.logging("Finding unbound lower")
-        while (unbounded_start >= 0): 
-            while (unbounded_curve.Eval(unbounded_start - step_size) >= conf_level and
-                   unbounded_curve.Eval(unbounded_start - step_size) - conf_level > tolerance): 
-                   step_size /= 2.
-            unbounded_start -= step_size
-            if math.fabs(unbounded_curve.Eval(unbounded_start) - conf_level) < tolerance: break 
-        unbounded_lower_limit = unbounded_start 
-
-       
-        # We only calculate the bounded upper limit if the best fit is below 0,
-        # otherwise it's exactly the same as the unbounded limit
-        step_size = 0.01
-        bounded_limit = unbounded_upper_limit
-        if best_fit < 0:
-            bounded_start = bounded_curve.Eval(0) 
-            while (bounded_start <= model_amplitude.getMax()): 
-                # If we overshoot, check it.
-                while (bounded_curve.Eval(bounded_start + step_size) >= conf_level and
-                       bounded_curve.Eval(bounded_start + step_size) - conf_level > tolerance): 
-                       step_size /= 2.
-                bounded_start += step_size
-                if math.fabs(bounded_curve.Eval(bounded_start) - conf_level) < tolerance: break 
-            bounded_limit = bounded_start 
+        # Now find where each rises to the particular confidence level
+        # value, solving for the crossing on a parabola through the
+        # scan points around it (see profile_limits)
+        limits = get_limits_at_level(unbounded_list[:,0], unbounded_list[:,1],
+                                     conf_level, bounded_min_nll - min_nll)
+        unbounded_upper_limit = limits['unbounded_upper_limit'][0]
+        unbounded_lower_limit = limits['unbounded_lower_limit'][0]
+        bounded_limit = limits['bounded_limit'][0]
+        if numpy.isnan(bounded_limit) or numpy.isnan(unbounded_upper_limit):
+            self.logging("The profile likelihood doesn't reach the confidence level in the scan")
+            return self.retry_error
 
         #self.logging("Exiting")
         # Save these bounds in the output dictionary
@@ -215,7 +145,5 @@ class ExclusionCalculation(BaseCalculation.BaseCalculation):
         minuit.migrad()
 
         # Return the results
-        for obj in [nll, minuit]:
-            obj.IsA().Destructor(obj)
         return output_dict
  
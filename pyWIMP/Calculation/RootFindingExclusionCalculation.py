@@ -0,0 +1,150 @@
+import ExclusionCalculation
+import ROOT
+import math
+from ..utilities.utilities import find_root_brent
+from ..utilities.compact_results import compact_curve
+
+class RootFindingExclusionCalculation(ExclusionCalculation.ExclusionCalculation):
+    """
+    Calculates the same limits as ExclusionCalculation, but instead
+    of scanning the profile likelihood on a fixed grid and stepping
+    along an interpolated curve, it brackets the point where the
+    profile likelihood crosses conf_level and solves for it with
+    Brent's method directly on the profile NLL.  This needs only a
+    handful of conditional fits per limit.
+    """
+
+    def profile_nll(self, minuit, nll, model_amplitude, value, record = True):
+        """
+        Returns the value of the NLL minimized over all parameters
+        except the model_amplitude, which is fixed at value.  If 
+        record is set, the point is saved in evaluated_points.
+        """
+        if value > model_amplitude.getMax():
+            self.logging("Resetting maximum:", model_amplitude.getMax() )
+            model_amplitude.setMax(value*2)
+        model_amplitude.setVal(value)
+        minuit.migrad()
+        self.number_of_fits += 1
+        if record: self.evaluated_points.append((value, nll.getVal()))
+        return nll.getVal()
+
+    def find_crossing(self, func, start, f_start, step, lower_bound = None,
+                      upper_bound = 1e16, tolerance = 0.001):
+        """
+        Starting at start (where func is negative), steps outward in
+        the direction of step, doubling the step until func changes
+        sign, and then solves for the crossing.  If lower_bound is
+        reached before a sign change, lower_bound is returned.  Returns
+        None if an exit was requested, upper_bound was exceeded or func
+        is NaN (e.g. a failed fit), see get_crossing_failure.
+        """
+        while 1:
+            test = start + step
+            if lower_bound is not None and test <= lower_bound:
+                test = lower_bound
+            f_test = func(test)
+            if math.isnan(f_test): return None
+            if f_test >= 0: break
+            if test == lower_bound: return lower_bound
+            if test > upper_bound: return None
+            start, f_start = test, f_test
+            step *= 2
+            if self.is_exit_requested(): return None
+        return find_root_brent(func, start, test, f_start, f_test,
+                               tolerance = 1e-4*math.fabs(step),
+                               f_tolerance = tolerance)
+
+    def get_crossing_failure(self):
+        """
+        Returns what find_confidence_value_for_model returns when
+        find_crossing didn't find a crossing: None if an exit was 
+        requested, so that the toys stop, otherwise retry_error, so
+        that only this toy is replaced.
+        """
+        if self.is_exit_requested(): return None
+        return self.retry_error
+
+    def find_confidence_value_for_model(self,
+                                        model,
+                                        data,
+                                        model_amplitude,
+                                        conf_level,
+                                        mult_factor,
+                                        print_level = -1,
+                                        verbose = False,
+                                        debug = False,
+                                        tolerance = 0.001):
+
+        tolerance = math.fabs(tolerance)
+        nll, minuit = self.get_fit_context(model, data, verbose)
+
+        self.fit_background_only(minuit, model, data, model_amplitude)
+
+        # Now fit with the model_amplitude
+        model_amplitude.setVal(0)
+        model_amplitude.setConstant(False)
+        minuit.migrad()
+        min_nll = nll.getVal()
+        best_fit = model_amplitude.getVal()
+        best_fit_error = model_amplitude.getError()
+
+        if conf_level == 0: return None
+
+        # The first guess of the distance to the crossing assumes a
+        # parabolic likelihood, 0.5*((x - best_fit)/error)**2
+        step = best_fit_error*math.sqrt(2*conf_level)
+        if step <= 0: step = 1.
+
+        self.evaluated_points = []
+        self.number_of_fits = 2
+        model_amplitude.setConstant(True)
+        def unbounded_func(value):
+            return self.profile_nll(minuit, nll, model_amplitude, value) - \
+                   min_nll - conf_level
+
+        # finding unbounded, upper limit
+        unbounded_upper_limit = self.find_crossing(unbounded_func,
+            best_fit, -conf_level, step, tolerance = tolerance)
+        if unbounded_upper_limit is None: return self.get_crossing_failure()
+
+        # finding unbounded, lower limit, this is not searched for below 0
+        unbounded_lower_limit = best_fit
+        if best_fit > 0:
+            unbounded_lower_limit = self.find_crossing(unbounded_func,
+                best_fit, -conf_level, -min(step, best_fit),
+                lower_bound = 0, tolerance = tolerance)
+            if unbounded_lower_limit is None: 
+                return self.get_crossing_failure()
+
+        # We only calculate the bounded upper limit if the best fit is below 0,
+        # otherwise it's exactly the same as the unbounded limit
+        bounded_limit = unbounded_upper_limit
+        if best_fit < 0:
+            bounded_min_nll = self.profile_nll(minuit, nll, model_amplitude, 0)
+            def bounded_func(value):
+                return self.profile_nll(minuit, nll, model_amplitude, value) - \
+                       bounded_min_nll - conf_level
+            bounded_limit = self.find_crossing(bounded_func,
+                0, -conf_level, step, tolerance = tolerance)
+            if bounded_limit is None: return self.get_crossing_failure()
+
+        # Keep the points of the profile likelihood curve evaluated
+        # while searching, so that limits at nearby confidence levels
+        # can be found later (see profile_limits)
+        output_dict = compact_curve(self.evaluated_points + 
+                                    [(best_fit, min_nll)], min_nll)
+
+        # Save these bounds in the output dictionary
+        output_dict['unbounded_lower_limit'] = unbounded_lower_limit*mult_factor
+        output_dict['unbounded_upper_limit'] = unbounded_upper_limit*mult_factor
+        output_dict['bounded_limit'] = bounded_limit*mult_factor
+        output_dict['mult_factor'] = mult_factor
+        output_dict['number_of_fits'] = self.number_of_fits
+
+        model_amplitude.setVal(bounded_limit)
+        minuit.migrad()
+
+        # Return the results
+        return output_dict
+
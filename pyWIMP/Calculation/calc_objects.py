@@ -6,10 +6,23 @@ import ROOT
 import ExclusionCalculation as ec
 import OscillationSensitivityCalculation as osc
 import DataCalculation as dat
-from  ..utilities.utilities import unroll_RooAbsPdf
+import RootFindingExclusionCalculation as rfec
+import AsymptoticCalculation as asym
+import BinnedTemplateCalculation as btc
+from  ..utilities.utilities import unroll_RooAbsPdf, get_rss
+from  ..utilities.toy_bank import ToyBank
+from  ..utilities.framing import write_message
 from pyWIMP.DMModels.gaussian_signal import GaussianSignalModel 
 from pyWIMP.DMModels.tritium_decay_model import TritiumDecayModel 
 
+# Calculations available to perform the limit, selected
+# with the 'calculation_method' input variable
+limit_calculations = { 'scan' : ec.ExclusionCalculation,
+                       'root_finding' : rfec.RootFindingExclusionCalculation,
+                       'asymptotic' : asym.AsymptoticCalculation,
+                       'asymptotic_cls' : asym.AsymptoticCLsCalculation,
+                       'binned_numpy' : btc.BinnedTemplateCalculation }
+
 class WIMPModel:
     """
     Class handles performing a sensitivity calculation
@@ -17,6 +30,10 @@ class WIMPModel:
     FixME: This class uses AllWIMPModels class, but doesn't
     allow an interface to change those values.
     """
+    # Input variables which can be changed without building the
+    # model again (see update_input_variables)
+    reusable_variables = ['wimp_mass', 'wimp_masses', 'confidence_level']
+
     def get_requested_values(cls):
         """
         Returns requested values plus defaults
@@ -31,7 +48,26 @@ class WIMPModel:
                 'tritium_activation_rate' : ('Tritium activation rate (counts/kg/day)', 200),
                 'tritium_exposure_time' : ('Tritium exposure time days', 0),
                 'wimp_mass' : ('WIMP mass (GeV/c^-2)', 10),
+                'wimp_masses' : ("""Comma-separated list of WIMP masses 
+(GeV/c^-2) each toy is fitted against, 
+empty means only wimp_mass 
+                                 """, ''),
                 'confidence_level' : ('Confidence level (0 -> 1)', 0.9),
+                'calculation_method' : ("""Method used to calculate the limit: 
+scan (fixed grid of fits), 
+root_finding (Brent's method on the profile likelihood),
+asymptotic (one-sided q_mu, CLs+b), 
+asymptotic_cls (one-sided q_mu, CLs), or 
+binned_numpy (numpy likelihood of binned data)
+                                        """, 'scan'),
+                'asimov' : ("""Calculate the median limit and +-1, +-2 sigma
+bands from the Asimov (expected background) 
+data set instead of generating toys
+                            """, False),
+                'toy_bank' : ("""Directory of a background toy bank (see 
+make_toy_bank.py) to replay instead of 
+generating toys, empty means generate
+                              """, ''),
                 'variable_quenching' : ('Set to use variable quenching', False),
                 'constant_time' : ('Set time as constant', False),
                 'constant_energy' : ('Set energy as constant', False),
@@ -63,6 +99,7 @@ will be displayed during the program.
         self.output_pipe = output_pipe
         self.exit_now = False
         self.is_initialized = False
+        self.is_prepared = False
         self.exit_manager = exit_manager 
         if self.debug:
             self.print_level = 3
@@ -73,6 +110,182 @@ will be displayed during the program.
 
         self.do_bin_data = False
         if self.num_energy_bins != 0 and self.num_time_bins != 0: self.do_bin_data = True
+        self.first_iteration = 0
+        self.result_callback = None
+        self.completed_iterations = set()
+        self.task_queue = None
+        self.stream_results = False
+        self.deadline = None
+        self.recycle_toys = 0
+        self.max_rss = 0
+        self.stop_precision = 0
+        self.min_toys = 20
+
+    def set_output_pipe(self, output_pipe):
+        """
+        Sets the file descriptor the results are written to, e.g. 
+        in a process forked from the one that called prepare.
+        """
+        self.output_pipe = output_pipe
+
+    def set_result_callback(self, callback):
+        """
+        Sets a function called with (iteration, seed, results) each
+        time an iteration has finished (see 
+        BaseCalculation.set_result_callback).
+        """
+        self.result_callback = callback
+
+    def set_completed_iterations(self, iterations):
+        """
+        Sets the iterations which were already completed and are 
+        skipped.
+        """
+        self.completed_iterations = iterations
+
+    def set_task_queue(self, queue):
+        """
+        Sets a TaskQueue the iterations are pulled from, instead of 
+        performing number_iterations iterations from first_iteration.
+        """
+        self.task_queue = queue
+
+    def set_stream_results(self, stream = True):
+        """
+        Sets sending the results on output_pipe as messages (see 
+        utilities.framing), ('result', iteration, seed, results) as 
+        each iteration finishes, instead of the whole list at the end.
+        With a task queue, ('request',) is sent before an iteration
+        is taken from the queue.
+        """
+        self.stream_results = stream
+
+    def set_deadline(self, deadline):
+        """
+        Sets the time (as from time.time()) by which the toys must 
+        have finished, toys are only started if they are predicted to
+        finish before it (see BaseCalculation.set_deadline).
+        """
+        self.deadline = deadline
+
+    def set_recycling(self, recycle_toys, max_rss):
+        """
+        Sets stopping to take iterations from the task queue after
+        recycle_toys iterations, or once the resident memory is above 
+        max_rss (MB), 0 disables either.  ('recycle',) is then sent 
+        on output_pipe (with stream_results), so that a new process 
+        can take over.
+        """
+        self.recycle_toys = recycle_toys
+        self.max_rss = max_rss
+
+    def set_stop_precision(self, precision, min_toys = 20):
+        """
+        Sets stopping the toys once the quantiles of the limit are 
+        known to the relative precision (see 
+        BaseCalculation.set_stop_precision).  With a task queue shared
+        by several processes, the process handing out the iterations 
+        should decide this instead, from the results of all of them.
+        """
+        self.stop_precision = precision
+        self.min_toys = min_toys
+
+    def is_recycle_needed(self, toys_done):
+        """
+        Returns True if this process should be replaced after 
+        toys_done iterations (see set_recycling).
+        """
+        if self.recycle_toys and toys_done >= self.recycle_toys: 
+            return True
+        if self.max_rss and get_rss() > self.max_rss: return True
+        return False
+
+    def set_number_iterations(self, num_iterations):
+        """
+        Sets the number of iterations (toys) performed by run.
+        """
+        self.number_iterations = num_iterations
+
+    def update_input_variables(self, input_variables):
+        """
+        Updates the input variables for another calculation with the
+        same model, e.g. the next point of a sweep.  The built model is
+        reused if only reusable_variables change, the mass of the WIMP
+        is then set in the model.  Returns False, changing nothing, if
+        the model has to be built again.
+        """
+        changed = [akey for akey in self.get_requested_values().keys()
+                   if akey in input_variables.keys() and 
+                      input_variables[akey] != getattr(self, akey)]
+        for akey in changed:
+            if akey not in self.reusable_variables: return False
+        if self.is_initialized and 'wimp_mass' in changed and \
+           not hasattr(self.wimpClass, 'set_mass_of_wimp'):
+            return False
+        self.input_variables = input_variables
+        for akey in changed:
+            setattr(self, akey, input_variables[akey])
+        if self.is_initialized and hasattr(self, 'wimpClass') and \
+           hasattr(self.wimpClass, 'set_mass_of_wimp'):
+            # The hypotheses of the last run could have changed the mass
+            self.wimpClass.set_mass_of_wimp(self.wimp_mass)
+            self.norm = self.wimpClass.get_normalization().getVal()
+            # Check the normalization of the new mass
+            self.is_prepared = False
+        return True
+
+    def set_first_iteration(self, first):
+        """
+        Sets the index of the first toy this object calculates, 
+        used to choose toys from a toy bank.
+        """
+        self.first_iteration = first
+
+    def get_hypotheses(self):
+        """
+        Returns the list of hypotheses (see 
+        BaseCalculation.set_hypotheses), one for each of wimp_masses, 
+        or None if only wimp_mass is fitted.  The hypotheses change 
+        the mass of the WIMP in the model, so that the same model (and
+        the background-only fit) is used for every mass.
+        """
+        if not getattr(self, 'wimp_masses', '') or self.do_axioelectric: 
+            return None
+        hypotheses = []
+        for mass in [float(m) for m in str(self.wimp_masses).split(',')]:
+            def set_hypothesis(mass = mass):
+                self.wimpClass.set_mass_of_wimp(mass)
+                self.norm = self.wimpClass.get_normalization().getVal()
+                return self.norm
+            hypotheses.append((set_hypothesis, {'fit_wimp_mass' : mass}))
+        return hypotheses
+
+    def get_list_components(self):
+        """
+        Returns (pdf_list, yield_list), the extended components of 
+        the fitting model, or None if the model doesn't have a
+        TritiumDecayModel background.
+        """
+        if not hasattr(self, 'backgroundClass'): return None
+        pdf_list, yield_list = self.backgroundClass.get_list_components()
+        pdf_list = ROOT.RooArgList(pdf_list)
+        yield_list = ROOT.RooArgList(yield_list)
+        pdf_list.add(self.model)
+        yield_list.add(self.model_normal)
+        return (pdf_list, yield_list)
+
+    def background_configuration(self):
+        """
+        Returns a dictionary of the input variables which define the
+        data_set_model (i.e. the background) used to generate toys.
+        """
+        adict = {}
+        for akey in ['total_time', 'threshold', 'energy_max', 
+                     'mass_of_detector', 'background_rate', 
+                     'tritium_activation_rate', 'tritium_exposure_time', 
+                     'constant_time', 'constant_energy']:
+            if hasattr(self, akey): adict[akey] = getattr(self, akey)
+        return adict
 
     # overload this function for derived classes.
     def initialize(self):
@@ -103,8 +316,12 @@ will be displayed during the program.
             self.variables.add(self.basevars.get_energy())
 
 
+        if self.calculation_method not in limit_calculations.keys():
+            print "Requested: %s, isn't one of: %s" % (self.calculation_method,
+                                                       limit_calculations.keys())
+            raise TypeError
         self.calculation_class = \
-            ec.ExclusionCalculation(self.exit_manager)
+            limit_calculations[self.calculation_method](self.exit_manager)
  
         # This is where we define our models
         self.backgroundClass = TritiumDecayModel(self.basevars, 
@@ -166,31 +383,21 @@ will be displayed during the program.
         self.fitting_model = self.added_pdf
         self.is_initialized = True
     
-    def run(self):
+    def prepare(self):
         """
-        Do the work.  Perform the fits, and return the results
-        This function runs from the base class, so derived classes should
-        not need to overload it.
+        Builds the model (see initialize) and checks its normalization
+        integral.  This is called by run, or can be called before 
+        forking so that the forked processes share the built model,
+        each process should then call reseed before run.  Returns 
+        False if the integral is 0.
         """
-        import pickle
-        import signal
-        import os
-
+        if self.is_prepared: return self.norm_integral_val != 0.0
         ROOT.RooRandom.randomGenerator().SetSeed(0)
         self.initialize()
-        ROOT.gROOT.SetBatch()
-        if self.show_plots or self.print_out_plots:
-            self.calculation_class.set_canvas(ROOT.TCanvas())
-        if self.show_plots and not self.print_out_plots:
-            ROOT.gROOT.SetBatch(0)
-
         if not self.debug:
             ROOT.RooMsgService.instance().setSilentMode(True)
             ROOT.RooMsgService.instance().setGlobalKillBelow(4)
 
-        # Open the pipe to write back on
-        write_pipe = os.fdopen(self.output_pipe, 'w') 
-
         # Set the numeric integration properties, this is important
         # since some of these integrals are difficult to do
         precision = ROOT.RooNumIntConfig.defaultConfig()
@@ -204,13 +411,44 @@ will be displayed during the program.
 
         # FixME, this integral sometimes doesn't converge, set a timeout?
         # This integral is in units of pb^{-1} 
-        norm_integral_val = norm_integral.getVal()
+        self.norm_integral_val = norm_integral.getVal()
+
+        print self.norm_integral_val
+        self.is_prepared = True
+        return self.norm_integral_val != 0.0
+
+    def reseed(self, seed = 0):
+        """
+        Reseeds the random number generator, called in each process 
+        forked after prepare with a different seed so that the 
+        processes don't generate the same toys.  0 seeds with a TUUID.
+        """
+        ROOT.RooRandom.randomGenerator().SetSeed(seed)
+
+    def run(self):
+        """
+        Do the work.  Perform the fits, and return the results
+        This function runs from the base class, so derived classes should
+        not need to overload it.
+        """
+        import pickle
+        import signal
+        import os
 
-        print norm_integral_val
-        if norm_integral_val == 0.0:
+        integral_ok = self.prepare()
+        ROOT.gROOT.SetBatch()
+        if self.show_plots or self.print_out_plots:
+            self.calculation_class.set_canvas(ROOT.TCanvas())
+        if self.show_plots and not self.print_out_plots:
+            ROOT.gROOT.SetBatch(0)
+
+        # Open the pipe to write back on
+        write_pipe = os.fdopen(self.output_pipe, 'w') 
+
+        if not integral_ok:
             print "Integral defined as 0, meaning it is below numerical precision"
             print "Aborting further calculation"
-            write_pipe.write(pickle.dumps({}))
+            if not self.stream_results: write_pipe.write(pickle.dumps({}))
             write_pipe.close()
             return
  
@@ -224,6 +462,49 @@ will be displayed during the program.
         self.calculation_class.set_show_plots(self.show_plots)
         self.calculation_class.set_print_out_plots(self.print_out_plots)
         self.calculation_class.set_input_variables(self.input_variables)
+        self.calculation_class.set_asimov(self.asimov)
+        self.calculation_class.set_first_iteration(self.first_iteration)
+        self.calculation_class.set_result_callback(self.result_callback)
+        self.calculation_class.set_completed_iterations(self.completed_iterations)
+        self.calculation_class.set_deadline(self.deadline)
+        self.calculation_class.set_stop_precision(self.stop_precision, 
+                                                  self.min_toys)
+        if self.task_queue:
+            self.calculation_class.set_iteration_source(self.task_queue.get)
+        streamed = set()
+        if self.stream_results:
+            toys_done = []
+            def send_result(iteration, seed, results):
+                streamed.update([id(result) for result in results])
+                write_message(self.output_pipe, 
+                              ('result', iteration, seed, results))
+                toys_done.append(get_rss())
+            self.calculation_class.set_result_callback(send_result)
+            if self.task_queue:
+                recycling = []
+                def request_iteration():
+                    if recycling: return None
+                    if self.is_recycle_needed(len(toys_done)):
+                        print "Process %i: Recycling after %i toys, RSS %g MB (%g MB after the first)" % \
+                              (os.getpid(), len(toys_done), get_rss(), 
+                               (toys_done or [0])[0])
+                        recycling.append(True)
+                        write_message(self.output_pipe, ('recycle',))
+                        return None
+                    write_message(self.output_pipe, ('request',))
+                    return self.task_queue.get()
+                self.calculation_class.set_iteration_source(request_iteration)
+        self.calculation_class.set_hypotheses(self.get_hypotheses())
+        components = self.get_list_components()
+        if components: self.calculation_class.set_list_components(*components)
+        # Not all models have the toy_bank option
+        if getattr(self, 'toy_bank', ''):
+            bank = ToyBank(self.toy_bank)
+            bank.check_configuration(self.background_configuration())
+            self.calculation_class.set_toy_bank(bank, 
+                                                self.basevars.get_energy(), 
+                                                self.basevars.get_time(),
+                                                self.basevars.get_weighting())
         self.calculation_class.set_plot_base_name(
             "%s WIMP Mass: %g GeV" % (self.__class__.__name__,
                                   self.wimp_mass))
@@ -237,8 +518,20 @@ will be displayed during the program.
                 self.do_bin_data, 
                 self.number_iterations, 
                 self.confidence_level)
-
-        write_pipe.write(pickle.dumps(results_list))
+        toys_per_hour = self.calculation_class.get_toys_per_hour()
+        if toys_per_hour:
+            print "Process %i: Finished with %g toys/hour projected" % \
+                  (os.getpid(), toys_per_hour)
+
+        if self.stream_results:
+            # Send the results which weren't sent with an iteration
+            results_list = [result for result in results_list 
+                            if id(result) not in streamed]
+            if results_list:
+                write_message(self.output_pipe, 
+                              ('result', None, None, results_list))
+        else:
+            write_pipe.write(pickle.dumps(results_list))
         write_pipe.close()
 
 class DataExclusion(WIMPModel):
@@ -247,6 +540,9 @@ class DataExclusion(WIMPModel):
         del adict['constant_energy']
         del adict['constant_time']
         del adict['background_rate']
+        del adict['calculation_method']
+        del adict['toy_bank']
+        del adict['wimp_masses']
         adict['fix_l_line_ratio'] = ('Fix ratio of the Ge and Zn L-lines', False)
         adict['data_file'] = ('Name of data root file', 'temp.root')
         adict['object_name'] = ("""Name of object inside data file. 
@@ -457,6 +753,9 @@ class OscillationSignalDetection(WIMPModel):
         del adict['constant_time']
         del adict['wimp_mass']
         del adict['variable_quenching']
+        del adict['calculation_method']
+        del adict['toy_bank']
+        del adict['wimp_masses']
         adict['model_amplitude'] = ('Initial model amplitude', 0.1)
         return adict
     get_requested_values = classmethod(get_requested_values)
@@ -93,5 +93,8 @@ class TritiumDecayModel(BaseModel):
 
     def get_model(self):
         return self.total_background
+    def get_list_components(self):
+        return (ROOT.RooArgList(self.flat_model, self.beta_model),
+                ROOT.RooArgList(self.flat_amp, self.beta_model_amp))
 
 
@@ -229,6 +229,9 @@ class WIMPModel(BaseModel):
     def get_normalization(self):
         return self.normalization
 
+    def set_mass_of_wimp(self, mass_of_wimp):
+        self.mass_of_wimp.setVal(mass_of_wimp)
+
     def get_helm_form_factor(self):
         return self.woods_saxon_helm_ff_squared
 
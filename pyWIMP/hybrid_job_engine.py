@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Runs job_engine on several nodes, with one MPI rank per node, e.g.
+
+mpirun -npernode 1 -hostfile $PBS_NODEFILE python hybrid_job_engine.py WIMPModel [options]
+
+Each rank builds the model once (see job_engine.run_pool with
+prefork) and forks num_cpus processes sharing it, so that the model
+building, library loading and reading of input data are done once
+per node instead of once per core.  The iterations are handed out in
+blocks to the ranks as they finish their last block (see TaskFarm),
+the results are gathered on rank 0, which writes the output.
+"""
+import sys
+import time
+import optparse
+import pyWIMP.Calculation.calc_objects as co
+from pyWIMP.utilities import utilities
+from pyWIMP.utilities.result_writer import ColumnBuffer
+from pyWIMP.job_engine import run_pool, prepare_model, write_output, \
+                              get_available_models, usage, add_model_options
+import ROOT
+ROOT.RooCurve() # Apparently important, this blows away
+                # some MPI things if it is instantiated later
+from mpi4py import MPI
+from pyWIMP.utilities.task_farm import TaskFarm
+
+def get_iteration_blocks(number_of_ranks, num_cpus, num_iter, block_iter):
+    """
+    Returns the blocks of the num_iter iterations per cpu of
+    number_of_ranks ranks, each (first iteration, iterations per cpu),
+    with at most block_iter iterations per cpu.
+    """
+    blocks = []
+    first = 0
+    iterations_left = number_of_ranks*num_iter
+    while iterations_left > 0:
+        number = min(block_iter, iterations_left)
+        blocks.append((first, number))
+        first += num_cpus*number
+        iterations_left -= number
+    return blocks
+
+def hybrid_job_engine(output_file,
+                      num_cpus,
+                      num_iter,
+                      max_time,
+                      model_factory,
+                      input_variables,
+                      checkpoint_file = None,
+                      resume = False,
+                      comm = MPI.COMM_WORLD,
+                      root = 0,
+                      block_iter = 1):
+    """
+    Runs the blocks of iterations (see get_iteration_blocks) on the
+    ranks, each block with the pool of forked processes of the rank,
+    and gathers the results on root, which writes them to
+    output_file.  The finished blocks are saved in checkpoint_file on
+    root, a block stopped by a signal or max_time is written to the
+    output but done again on resume.  In asimov mode all the ranks
+    would find the same result, so only root runs.
+    """
+    rank = comm.Get_rank()
+    if input_variables.get('asimov', False):
+        if rank != root: return
+        results = run_pool(num_cpus, num_iter, max_time, model_factory,
+                           input_variables, prefork = True)
+        if len(results) == 0:
+            print "No results, exiting."
+            return
+        write_output(output_file, model_factory.__name__,
+                     input_variables, results)
+        return
+
+    blocks = get_iteration_blocks(comm.Get_size(), num_cpus, 
+                                  num_iter, block_iter)
+    farm = TaskFarm(comm, root, checkpoint_file, 
+                    {'model' : model_factory.__name__,
+                     'input_variables' : input_variables,
+                     'blocks' : blocks}, resume)
+    start_time = time.time()
+    sighand = utilities.SignalHandler
+    model = prepare_model(model_factory, block_iter, input_variables)
+    def run_block(block):
+        first_iteration, number = block
+        time_left = 0
+        if max_time:
+            time_left = int(max_time - (time.time() - start_time))
+            if time_left <= 0: return {}, {}, 0, False
+        if sighand.is_exit_requested(): return {}, {}, 0, False
+        results = run_pool(num_cpus, number, time_left, model_factory,
+                           input_variables, model = model,
+                           first_iteration = first_iteration,
+                           service = farm.service)
+        print "Rank %i finished iterations from %i with %i results." % \
+              (rank, first_iteration, len(results))
+        sys.stdout.flush()
+        columns, objects = results.get_columns()
+        finished = results.number_of_iterations == num_cpus*number
+        return columns, objects, len(results), finished
+    block_results = farm.run(blocks, run_block, 
+                             save_if = lambda results: results[3])
+    if rank != root: return
+
+    results = ColumnBuffer()
+    for columns, objects, number_of_rows, finished in block_results:
+        results.add_columns(columns, objects, number_of_rows)
+    if len(results) == 0:
+        print "No results, exiting."
+        return
+    write_output(output_file, model_factory.__name__,
+                 input_variables, results)
+
+if __name__ == "__main__":
+    available_models = get_available_models()
+
+    if (len(sys.argv) < 2):
+        usage(available_models)
+        sys.exit(1)
+
+    model_name = sys.argv[1]
+    if not model_name in available_models:
+        print "Error finding model: ", model_name
+        usage(available_models)
+        sys.exit(1)
+    obj_factory = getattr(co, model_name)
+
+    parser = optparse.OptionParser(usage="usage: %prog model [options]")
+    req_items = add_model_options(parser, obj_factory)
+
+    parser.add_option("-o", "--output_file", dest="output_file",\
+                      help="Define the output file name (full path)",\
+                      default="temp.root")
+    parser.add_option("-n", "--num_cpus", dest="numprocessors",\
+                      help="Define the number of cpus used on each node",\
+                      default=utilities.detectCPUs())
+    parser.add_option("-a", "--max_time", dest="max_time",\
+                      help="Set the max time [seconds] until this program shuts down",\
+                      default=0)
+    parser.add_option("-i", "--num_iter", dest="num_iter",\
+                      help="Number of iterations per cpu of each node",\
+                      default=10)
+    parser.add_option("-b", "--block_iter", dest="block_iter",\
+                      help="Number of iterations per cpu in each block handed out to a node",\
+                      default=1)
+    parser.add_option("-c", "--checkpoint_file", dest="checkpoint_file",\
+                      help="Define the file the finished blocks of iterations are saved to (default: output_file.checkpoint)",\
+                      default="")
+    parser.add_option("--resume", dest="resume",\
+                      help="Resume from the checkpoint file, skipping the blocks already finished",\
+                      action="store_true",\
+                      default=False)
+
+    (options, args) = parser.parse_args()
+
+    output_file = options.output_file
+    checkpoint_file = options.checkpoint_file
+    if not checkpoint_file: checkpoint_file = output_file + ".checkpoint"
+
+    output_dict = {}
+    for key in req_items.keys():
+        output_dict[key] = getattr(options, key)
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() == 0:
+        print "Using number of nodes: %i, cpus per node: %i" % \
+              (comm.Get_size(), int(options.numprocessors))
+        sys.stdout.flush()
+
+    hybrid_job_engine(output_file,
+                      int(options.numprocessors),
+                      int(options.num_iter),
+                      int(options.max_time),
+                      obj_factory,
+                      output_dict,
+                      checkpoint_file,
+                      options.resume,
+                      comm,
+                      block_iter = int(options.block_iter))
@@ -6,9 +6,15 @@ import types
 import inspect
 import pyWIMP.Calculation.calc_objects as co
 from pyWIMP.utilities import utilities
-import array
+from pyWIMP.utilities.checkpoint import Checkpoint
+from pyWIMP.utilities.task_queue import TaskQueue
+from pyWIMP.utilities.framing import MessageReader
+from pyWIMP.utilities.convergence import QuantileMonitor
+from pyWIMP.utilities import result_writer
 import signal
 import errno
+import select
+import time
 import cPickle as pickle
 
 def job_engine( output_file,\
@@ -16,9 +22,48 @@ def job_engine( output_file,\
                 num_iter, \
                 max_time, \
                 model_factory, \
-                input_variables):
+                input_variables, \
+                checkpoint_file = None, \
+                resume = False, \
+                prefetch_depth = 2, \
+                prefork = False, \
+                recycle_toys = 0, \
+                max_rss = 0, \
+                stop_precision = 0, \
+                min_toys = 20):
+    """
+    Runs the iterations with a pool of forked processes (see run_pool) 
+    and writes the results to output_file.
+    """
+    results = run_pool(num_cpus, num_iter, max_time, model_factory, 
+                       input_variables, checkpoint_file, resume, 
+                       prefetch_depth, prefork, 
+                       recycle_toys = recycle_toys, max_rss = max_rss,
+                       stop_precision = stop_precision, 
+                       min_toys = min_toys)
+    if len(results) == 0:
+        print "No results, exiting."
+        return
 
+    write_output(output_file, model_factory.__name__, 
+                 input_variables, results)
 
+def run_pool( num_cpus, \
+              num_iter, \
+              max_time, \
+              model_factory, \
+              input_variables, \
+              checkpoint_file = None, \
+              resume = False, \
+              prefetch_depth = 2, \
+              prefork = False, \
+              first_iteration = 0, \
+              recycle_toys = 0, \
+              max_rss = 0, \
+              stop_precision = 0, \
+              min_toys = 20, \
+              model = None, \
+              service = None):
     """
     ROOT doesn't play well in threads, and so we brute force
     our way out of this by using forks and passing information back and force
@@ -28,6 +73,52 @@ def job_engine( output_file,\
     program is forked, which each forked process is completely
     independent.  Random number generators are seeded with TUIDs
     in their respective processes. 
+
+    The num_cpus*num_iter iterations (counted from first_iteration)
+    are handed out through a TaskQueue, each process pulls the next
+    iteration when it has finished the last one, so that processes 
+    with slow fits don't hold up the others.  The processes send each result as a message
+    as soon as it is finished, and request their next iteration, the
+    parent keeps at most prefetch_depth*num_cpus iterations waiting
+    on the queue.
+
+    With max_time, the processes only start an iteration if it is
+    predicted to finish before max_time (see ToyBudget), the alarm 
+    at max_time stops the ones which don't.
+
+    If checkpoint_file is given, the parent appends the results of
+    every finished iteration to it.  With resume, the iterations 
+    already in checkpoint_file are skipped and their results are
+    added to the output.
+
+    With prefork, one model is built and prepared (see 
+    WIMPModel.prepare) in the parent before forking, the processes
+    share it copy-on-write and only reseed their random number 
+    generators, instead of each building the model and computing its
+    normalization integral.  A model returned by prepare_model can be
+    given as model, it is then used instead of building one (e.g. 
+    when run_pool is called several times).
+
+    A process is replaced by a newly forked one after recycle_toys
+    iterations, or once its resident memory is above max_rss (MB),
+    so that memory leaked by ROOT doesn't build up (0 disables 
+    either).  The new process carries on pulling iterations from the
+    queue.
+
+    With stop_precision, the parent stops handing out iterations once
+    the median and the +-1 and +-2 sigma quantiles of the 
+    bounded_limit of all the iterations finished so far (at least
+    min_toys) are known to this relative precision (see 
+    QuantileMonitor).  The iterations already on the queue are still
+    performed.
+
+    service, if given, is called at least every second while the 
+    parent waits for the processes (e.g. TaskFarm.service, so that the
+    root of a farm answers the other ranks during its own pool).
+
+    Returns the results, as a result_writer.ColumnBuffer, with the
+    number of iterations finished (including those resumed) as its
+    attribute number_of_iterations.
     """
 
     # Setup: 
@@ -35,32 +126,107 @@ def job_engine( output_file,\
     # Grab the object which will perform the 
     # calculation
    
+    if input_variables.get('asimov', False):
+        # The Asimov data set is the same in every process,
+        # so only one is needed.
+        num_cpus = 1
+
+    checkpoint = None
+    completed_iterations = set()
+    if checkpoint_file:
+        checkpoint = Checkpoint(checkpoint_file, 
+                                {'model' : model_factory.__name__,
+                                 'input_variables' : input_variables},
+                                resume)
+        completed_iterations = checkpoint.get_completed_iterations()
+        if resume:
+            print "Resuming from %s, %i iterations completed." % \
+                  (checkpoint_file, len(completed_iterations))
+
+    # The results are added to the columns as they arrive (they hold
+    # only numbers and numpy arrays, see compact_results), the parent
+    # doesn't keep the result dictionaries
+    results = result_writer.ColumnBuffer()
+    monitor = None
+    if stop_precision:
+        monitor = QuantileMonitor(stop_precision, min_toys = min_toys)
+    if checkpoint:
+        # Results of the iterations before resuming
+        for iteration, a_list in checkpoint.iterate_results():
+            results.extend(a_list)
+            if monitor: monitor.add(a_list)
+        checkpoint.release_records()
+
     # Step 1: Instantiate child processes.  i call them 'threads', but there
     # are actually a forked process.
     thread_list = []
     sighand = utilities.SignalHandler
+    task_queue = TaskQueue()
+    start_time = time.time()
+    # The processes only start toys which finish before max_time
+    deadline = None
+    if max_time: deadline = start_time + max_time
+    shared_thread = model
+    if prefork and not shared_thread:
+        shared_thread = prepare_model(model_factory, num_iter, input_variables)
+    if shared_thread:
+        import ROOT
+        random = ROOT.RooRandom.randomGenerator()
+    def make_thread():
+        seed = 0
+        if shared_thread:
+            thread = shared_thread
+            seed = random.Integer(2147483646) + 1
+        else:
+            thread = model_factory(None, sighand, num_iter, input_variables)
+        # The processes pull their iterations from the queue
+        # and send back each result when it's finished
+        thread.set_task_queue(task_queue)
+        thread.set_stream_results()
+        thread.set_deadline(deadline)
+        thread.set_recycling(recycle_toys, max_rss)
+        return (thread,seed)
     for i in range(num_cpus):
-        r, w = os.pipe()
-        thread_list.append(\
-            (r,w,model_factory(w, sighand, num_iter, input_variables)))
+        thread_list.append(make_thread())
 
     # Step2: Scatter, opening and closing the relevant
     # pipes in the parent and child process
     # now start the threads
     open_threads = []
-    print "Scattering %i processes..." % num_cpus
-    sys.stdout.flush()
-    for read_des,write_des,thread in thread_list:
+    readers = {}
+    def start_thread(thread, seed):
+        # The pipe is only opened now, so that the processes forked
+        # before don't hold it
+        read_des, write_des = os.pipe()
+        # Don't leave buffered output to be written again by the child
+        sys.stdout.flush()
+        sys.stderr.flush()
         pid = os.fork() 
         if pid: # parent
             os.close(write_des)
-            read_pipe = os.fdopen(read_des) 
-            open_threads.append((pid, read_pipe)) 
+            open_threads.append((pid, read_des)) 
+            readers[read_des] = (pid, MessageReader(read_des))
+            return pid, read_des
         else: # child process
             os.close(read_des)
+            task_queue.close_writer()
+            # Don't hold the pipes of the other processes or the
+            # checkpoint (replacement processes are forked later)
+            for fd in readers.keys(): os.close(fd)
+            if checkpoint: checkpoint.close()
+            thread.set_output_pipe(write_des)
+            if shared_thread: thread.reseed(seed)
             thread.run()
-            sys.exit(0)
+            # Leave without the exit handlers of the parent (e.g.
+            # MPI_Finalize of mpi4py), which aren't for this process
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
             # stop here for the child process
+    print "Scattering %i processes..." % num_cpus
+    sys.stdout.flush()
+    for thread,seed in thread_list:
+        start_thread(thread, seed)
         
     
     print "Parent (%i) setting signal handlers." % os.getpid()
@@ -69,156 +235,163 @@ def job_engine( output_file,\
     signal.alarm(max_time)
     print "Parent (%i) waiting for processes..." % os.getpid()
     # Parent only
-    # Step 3: Gather, sucking on the pipes until close
-    # and waiting for all child processes to clean up 
-    import ROOT
-    ROOT.TTree # This forces the module to be loaded, otherwise there are issues with unpickling.
-    results_list = [] 
-    for pid, read_pipe in open_threads:
-        while 1:
+    # Step 3: Gather, reading the messages of the processes as they 
+    # arrive and handing out an iteration for each request, until
+    # all the pipes are closed 
+    # The results hold only numbers and numpy arrays (see
+    # compact_results), so the parent doesn't need ROOT to unpickle them
+    if not (recycle_toys or max_rss):
+        # Replacement processes need to read the queue
+        task_queue.close_reader()
+    iterations = [iteration for iteration in 
+                  range(first_iteration, first_iteration + num_cpus*num_iter)
+                  if iteration not in completed_iterations]
+    iterations.reverse()
+    def stop_if_converged():
+        if not (monitor and iterations and monitor.is_converged()): return
+        print "Parent (%i) stopping, the quantiles of the limit are known to %g after %i toys" % \
+              (os.getpid(), monitor.get_relative_precision(), 
+               monitor.number_of_toys)
+        del iterations[:]
+        task_queue.close_writer()
+    stop_if_converged()
+    def issue_iterations(number):
+        # Keeps at most number iterations waiting on the queue
+        while number > 0 and iterations:
             try:
-                print "Parent (%i) waiting for process: %i" % (os.getpid(), pid)
-                read_on_pipe = read_pipe.read()
+                task_queue.put(iterations[-1])
+            except OSError, e:
+                # EPIPE means all the processes have stopped 
+                if e.errno != errno.EPIPE: raise
+                del iterations[:]
+                break
+            iterations.pop()
+            number -= 1
+        if not iterations: task_queue.close_writer()
+    issue_iterations(prefetch_depth*num_cpus)
+
+    number_finished = 0
+    timeout = None
+    if service: timeout = 1
+    while readers:
+        if service: service()
+        try:
+            ready = select.select(readers.keys(), [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR: raise
+            print "Parent (%i) received signal" % os.getpid()
+            # Stop handing out iterations
+            del iterations[:]
+            task_queue.close_writer()
+            for apid, arp in open_threads:
+                # Make sure they got the signal
                 try:
-                    a_list = pickle.loads(read_on_pipe)
-                except TypeError:
-                    print read_on_pipe
-                    raise
+                    os.kill(apid, signal.SIGUSR1)
+                except: pass
+            continue
+        for fd in ready:
+            pid, reader = readers[fd]
+            messages, eof = reader.read()
+            for message in messages:
+                if message[0] == 'request': 
+                    issue_iterations(1)
+                    continue
+                if message[0] == 'recycle':
+                    if sighand.is_exit_requested(): continue
+                    # The process stops after this message, the
+                    # new one pulls the next iterations
+                    new_pid, new_des = start_thread(*make_thread())
+                    print "Parent (%i) replaced process %i with %i" % \
+                          (os.getpid(), pid, new_pid)
+                    continue
+                kind, iteration, seed, a_list = message
+                results.extend(a_list)
+                if iteration is None: continue
+                if checkpoint: checkpoint.append(iteration, seed, a_list)
+                if monitor: 
+                    monitor.add(a_list)
+                    stop_if_converged()
+                number_finished += 1
+                print "Parent (%i) collected iteration %i from process %i (%i finished, %g toys/hour)" % \
+                      (os.getpid(), iteration, pid, number_finished,
+                       number_finished*3600./max(time.time() - start_time, 1))
+            if eof: 
                 print "Parent (%i) collected for process: %i" % (os.getpid(), pid)
-                break
-            except IOError, e:
-                print "Parent (%i) received signal" % os.getpid()
-                if e.args[0] == errno.EINTR:
-                    for apid, arp in open_threads:
-                        # Make sure they got the signal
-                        try:
-                            os.kill(apid, signal.SIGUSR1)
-                        except: pass
-                else: 
-                    print "Caught IOError: ", e
-                    raise e
-                pass
-                
-        for val in a_list: results_list.append(val)
+                reader.close()
+                del readers[fd]
+    task_queue.close_writer()
 
     signal.alarm(0)
     for i in range(len(open_threads)):
         os.waitpid(-1, 0)
-    print "Gathered %i processes." % num_cpus
-    if len(results_list) == 0:
-        print "No results, exiting."
-        return
+    if checkpoint: checkpoint.close()
+    print "Gathered %i processes." % len(open_threads)
+    results.number_of_iterations = number_finished + len(completed_iterations)
+    return results
+   
+def prepare_model(model_factory, num_iter, input_variables):
+    """
+    Builds and prepares (see WIMPModel.prepare) the model shared by
+    the processes of run_pool with prefork.
+    """
+    model = model_factory(None, utilities.SignalHandler, num_iter, 
+                          input_variables)
+    print "Parent (%i) preparing the model." % os.getpid()
+    sys.stdout.flush()
+    model.prepare()
+    return model
 
+def write_output(output_file, model_name, input_variables, results):
+    """
+    Writes results, the result dictionaries of the iterations (a list,
+    or a result_writer.ColumnBuffer they were added to), to a TTree in
+    output_file, together with the input_variables and the name of
+    the model.  The numeric outputs are also written to a numpy file,
+    output_file with the extension .npz.
+    """
     ###########################
     # Save the output to a tree
     ###########################
     print "Writing TTree output."
-    open_file = ROOT.TFile(output_file, "recreate")
-    output_tree = ROOT.TTree("sensitivity_tree", "sensitivity_tree")
-
-    branch_list = []
-    string_list = []
-    for key, val in input_variables.items(): 
-        # Arg, checking types, shouldn't have to do this 
-        root_type = ''
-        array_type = ''
-        if isinstance(val, types.FloatType): 
-            root_type = 'D'
-            array_type = 'd'
-        elif isinstance(val, types.StringType):
-            root_type='string'
-            # Do nothing
-        else: # Assume integer
-            root_type = 'I'
-            array_type = 'l'
-
-        if root_type == 'string':
-            string_list.append(ROOT.string(val))
-            output_tree.Branch(key, string_list[-1])
-        else:
-            # We have to hold a reference to make sure
-            # the array doesn't get killed
-            branch_list.append(array.array(array_type, [val]))
-            output_tree.Branch(key, \
-                               branch_list[-1],\
-                               "%s/%s" % (key,root_type))
-    modelstring = ROOT.string(model_factory.__name__)
-    output_tree.Branch("CalculationName", modelstring)
-
-    # Now we deal with the list output 
-    # it is a dictionary, but we don't know the names, or numbers of entries
-    # each entry's value, 
-    # It is either a ROOT object or a double, ROOT objects are a little
-    # delicate to deal with.
-    array_dict = {}
-    for key, val in results_list[0].items():
-        root_object = False
-        try:
-            # Check to see if it's a ROOT object which we can save 
-            # in a branch
-            root_object = val.InheritsFrom(ROOT.TObject.Class())
-        except AttributeError: pass
-        if root_object:
-            array_dict[key] = "root_object"
-            output_tree.Branch(key, val)
-        else:
-            array_dict[key] = array.array('d', [0])
-            output_tree.Branch(key, array_dict[key], "%s/D" % key)
-
-    # No iterating over the results, storing each dictionary in 
-    # the tree.
-    for dict in results_list:
-        for key in dict.keys():
-            if array_dict[key] == "root_object":
-                output_tree.SetBranchAddress(key, dict[key]) 
-            else:
-                array_dict[key][0] = dict[key]
-        output_tree.Fill()
-
-    output_tree.Write()
-    open_file.Close()
+    if isinstance(results, result_writer.ColumnBuffer):
+        columns, objects = results.get_columns()
+    else:
+        columns, objects = result_writer.collect_columns(results)
+    result_writer.write_tree(output_file, model_name, input_variables, 
+                             columns, objects)
+    npz_file = os.path.splitext(output_file)[0] + ".npz"
+    print "Writing numpy output: %s" % npz_file
+    result_writer.write_npz(npz_file, model_name, input_variables, columns)
     print "Done."
    
-if __name__ == "__main__":
+def get_available_models():
     """
-    This is the main set of commands called when this python module is executed.
-    Following are command line options for the script.
+    Returns the names of the models (classes) in calc_objects.
     """
-
-    # Assume the first argument is the 
-    # name of the processor to use
     available_models = []
     for name in co.__dict__.keys():
         if name in ['ROOT']: continue # avoid loading ROOT
         if inspect.isclass(getattr(co, name)):
             available_models.append(name) 
+    return available_models
 
-    def usage(available_models):
-        print 
-        print "Available models: "
-        for amodel in available_models:
-            print "  ", amodel
-        print "For help with a particular model, type:"
-        print
-        print "%s model --help" % sys.argv[0]
-        print
-        print "Exiting..."
-
-    if (len(sys.argv) < 2):
-        usage(available_models)
-        sys.exit(1)
-
-    model_name = sys.argv[1]
-    if not model_name in available_models:
-        print "Error finding model: ", model_name
-        usage(available_models)
-        sys.exit(1)
-    obj_factory = getattr(co, model_name) 
- 
-    parser = optparse.OptionParser(usage="usage: %prog model [options]")
+def usage(available_models):
+    print 
+    print "Available models: "
+    for amodel in available_models:
+        print "  ", amodel
+    print "For help with a particular model, type:"
+    print
+    print "%s model --help" % sys.argv[0]
+    print
+    print "Exiting..."
 
-    # Dynamically set the options for this 
-    # particular computation model
+def add_model_options(parser, obj_factory):
+    """
+    Dynamically sets the options of the parser for the requested
+    values of a particular computation model.  Returns the 
+    requested values.
+    """
     req_items = obj_factory.get_requested_values()
     for key, val in req_items.items():
         found_type = ''
@@ -238,6 +411,34 @@ if __name__ == "__main__":
                           help=val[0], \
                           type=found_type, \
                           default=val[1])
+    return req_items
+
+if __name__ == "__main__":
+    """
+    This is the main set of commands called when this python module is executed.
+    Following are command line options for the script.
+    """
+
+    # Assume the first argument is the 
+    # name of the processor to use
+    available_models = get_available_models()
+
+    if (len(sys.argv) < 2):
+        usage(available_models)
+        sys.exit(1)
+
+    model_name = sys.argv[1]
+    if not model_name in available_models:
+        print "Error finding model: ", model_name
+        usage(available_models)
+        sys.exit(1)
+    obj_factory = getattr(co, model_name) 
+ 
+    parser = optparse.OptionParser(usage="usage: %prog model [options]")
+
+    # Dynamically set the options for this 
+    # particular computation model
+    req_items = add_model_options(parser, obj_factory)
 
     # Set the other options that we know are required
     parser.add_option("-o", "--output_file", dest="output_file",\
@@ -252,6 +453,29 @@ if __name__ == "__main__":
     parser.add_option("-i", "--num_iter", dest="num_iter",\
                       help="Number of iterations per cpu",\
                       default=10)
+    parser.add_option("-c", "--checkpoint_file", dest="checkpoint_file",\
+                      help="Define the file the finished iterations are saved to (default: output_file.checkpoint)",\
+                      default="")
+    parser.add_option("--resume", dest="resume",\
+                      help="Resume from the checkpoint file, skipping the iterations already finished",\
+                      action="store_true",\
+                      default=False)
+    parser.add_option("--recycle_toys", dest="recycle_toys",\
+                      help="Replace a process with a new one after this number of iterations (0: never)",\
+                      default=0)
+    parser.add_option("--max_rss", dest="max_rss",\
+                      help="Replace a process with a new one once its resident memory is above this (MB, 0: never)",\
+                      default=0)
+    parser.add_option("--stop_precision", dest="stop_precision",\
+                      help="Stop once the median and +-1, +-2 sigma quantiles of the bounded limit are known to this relative precision (0: never)",\
+                      default=0)
+    parser.add_option("--min_toys", dest="min_toys",\
+                      help="Minimum number of iterations before stopping with stop_precision",\
+                      default=20)
+    parser.add_option("--prefork", dest="prefork",\
+                      help="Build the model once in the parent and share it with the forked processes",\
+                      action="store_true",\
+                      default=False)
 
     (options, args) = parser.parse_args()
     
@@ -260,6 +484,8 @@ if __name__ == "__main__":
     num_cpus = int(options.numprocessors)
     max_time = int(options.max_time)
     num_iter = int(options.num_iter)
+    checkpoint_file = options.checkpoint_file
+    if not checkpoint_file: checkpoint_file = output_file + ".checkpoint"
 
     # Now grab the others
     output_dict = {}
@@ -283,11 +509,15 @@ Calculation:
 
 Process:
     Using cpu number: %i
-    Iterations on each cpu: %i
+    Iterations per cpu: %i
     Output file: %s
     Max time (seconds): %s
+    Checkpoint file: %s (resume: %s)
+    Prefork: %s
+    Stop precision: %s
     """ % ( num_cpus, num_iter, output_file,\
-            max_string )
+            max_string, checkpoint_file, options.resume, options.prefork,\
+            options.stop_precision )
 
     print output_string
     # Force flush so we only see this once
@@ -299,5 +529,12 @@ Process:
                num_iter,\
                max_time, \
                obj_factory,\
-               output_dict)
+               output_dict,\
+               checkpoint_file,\
+               options.resume,\
+               prefork=options.prefork,\
+               recycle_toys=int(options.recycle_toys),\
+               max_rss=float(options.max_rss),\
+               stop_precision=float(options.stop_precision),\
+               min_toys=int(options.min_toys))
          
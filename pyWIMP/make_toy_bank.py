@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Generates a bank of background toys once for a background
+configuration, so that every job of a sweep (e.g. over WIMP masses)
+can replay the same toys with the --toy_bank option of job_engine.py,
+instead of generating its own.  The options are the same as those
+of job_engine.py for the model.
+"""
+import sys
+import optparse
+import pyWIMP.Calculation.calc_objects as co
+from pyWIMP.utilities import utilities
+from pyWIMP.utilities.toy_bank import ToyBank
+from pyWIMP.job_engine import get_available_models, usage, add_model_options
+
+if __name__ == "__main__":
+
+    available_models = get_available_models()
+    if (len(sys.argv) < 2):
+        usage(available_models)
+        sys.exit(1)
+
+    model_name = sys.argv[1]
+    if not model_name in available_models:
+        print "Error finding model: ", model_name
+        usage(available_models)
+        sys.exit(1)
+    obj_factory = getattr(co, model_name)
+
+    parser = optparse.OptionParser(usage="usage: %prog model [options]")
+    req_items = add_model_options(parser, obj_factory)
+    parser.add_option("-b", "--bank_directory", dest="bank_directory",\
+                      help="Define the directory of the toy bank",\
+                      default="toy_bank")
+    parser.add_option("-t", "--num_toys", dest="num_toys",\
+                      help="Number of toys to generate",\
+                      default=1000)
+    (options, args) = parser.parse_args()
+
+    input_variables = {}
+    for key in req_items.keys():
+        input_variables[key] = getattr(options, key)
+
+    import ROOT
+    ROOT.RooRandom.randomGenerator().SetSeed(0)
+    ROOT.RooMsgService.instance().setSilentMode(True)
+    ROOT.RooMsgService.instance().setGlobalKillBelow(4)
+
+    model = obj_factory(None, utilities.SignalHandler, 0, input_variables)
+    model.initialize()
+    print "Generating %i toys in: %s" % (int(options.num_toys),
+                                          options.bank_directory)
+    sys.stdout.flush()
+    ToyBank.generate(options.bank_directory,
+                     model.background_configuration(),
+                     model.data_set_model,
+                     model.variables,
+                     model.basevars.get_energy(),
+                     model.basevars.get_time(),
+                     int(options.num_toys),
+                     model.calculation_class.logging)
+    print "Done."
@@ -11,6 +11,8 @@ from pyWIMP.DMModels.base_model import BaseVariables
 from pyWIMP.DMModels.wimp_model import WIMPModel
 from pyWIMP.DMModels.low_energy_background import TestModel
 import pyWIMP.Calculation.DataCalcVerification as dcv 
+from pyWIMP.utilities.task_farm import TaskFarm, split_into_batches, \
+                                       merge_batches
 
 
 if len(sys.argv) != 2: 
@@ -104,39 +106,43 @@ MPI stuff
 """
 #####################################
 comm = MPI.COMM_WORLD
-sendbuf=[]
-root=0
-
-
-if comm.Get_rank()==0:
-    print("Using number of nodes: ", comm.Get_size())
-    step_size = float(exponential_total)/(comm.Get_size()-1)
-    m=[(i-1)*step_size if i > 0 else 0 for i in range(comm.Get_size())]
-    sendbuf=m
-
-print "Scatter for: ", comm.Get_rank()
-v=comm.scatter(sendbuf,root)
-print "Go for: ", comm.Get_rank()
-results = []
-if comm.Get_rank() != 0:
+output_file = 'output_WM_%g.pkl' % wimp_mass
+batch_size = 100
+
+# The grid doesn't depend on the number of ranks, the farm hands
+# out its points to however many there are
+number_of_points = 31
+step_size = float(exponential_total)/number_of_points
+points = [i*step_size for i in range(number_of_points)]
+units = split_into_batches(points, total_mc_entries, batch_size)
+farm = TaskFarm(comm, 
+                checkpoint_file=output_file + ".checkpoint",
+                header={'wimp_mass' : wimp_mass, 'units' : units},
+                resume=True)
+# Let rank 0 answer the other ranks between its toys
+calc_system.set_result_callback(lambda *args: farm.service())
+
+def calculate_unit(unit):
+    index, v, number_iterations = unit
     test_variable.setVal(v/scaler)
     exp_coef.setVal(exponential_total-v)
-    results = calc_system.scan_confidence_value_space_for_model(
+    return calc_system.scan_confidence_value_space_for_model(
                       fit_model, 
                       test_variable,
                       variables,
                       total_entries,
-                      total_mc_entries,
+                      number_iterations,
                       0.9)
-results = (v, v/scaler, exponential_total-v, results)
 
+print "Go for: ", comm.Get_rank()
+unit_results = farm.run(units, calculate_unit)
 print "Finished: ", comm.Get_rank()
-recvbuf = comm.gather(results,root)
-print "Sent: ", comm.Get_rank()
 
-if comm.Get_rank()==0:
+if farm.is_root():
     print "Finishing"
-    afile = open('output_WM_%g.pkl' % wimp_mass, 'wb')
-    recvbuf = recvbuf[1:]
+    recvbuf = [(v, v/scaler, exponential_total-v, results) 
+               for v, results in zip(points, 
+                   merge_batches(units, unit_results, len(points)))]
+    afile = open(output_file, 'wb')
     pickle.dump(recvbuf, afile)
     afile.close()
@@ -11,6 +11,10 @@ from pyWIMP.DMModels.base_model import BaseVariables
 from pyWIMP.DMModels.wimp_model import WIMPModel
 from pyWIMP.DMModels.low_energy_background import TestModel
 import pyWIMP.Calculation.DataCalcVerification as dcv 
+from pyWIMP.utilities.compact_results import read_tree_entry, \
+                                            get_variable_string
+from pyWIMP.utilities.task_farm import TaskFarm, split_into_batches, \
+                                       merge_batches
 from pyWIMP.DMModels.low_energy_background import LowEnergyBackgroundModel
 
 
@@ -23,26 +27,11 @@ test_tree.GetEntry(0)
 
 wimp_mass = test_tree.wimp_mass 
 
-adict = {}
-list_of_branches = test_tree.GetListOfBranches()
-for i in range(list_of_branches.GetEntries()):
-    branch = list_of_branches.At(i)
-    try:
-        temp = float(branch.GetName())
-    except ValueError:
-        continue
-    adict[float(branch.GetName())] = (str(getattr(test_tree, branch.GetName()+'vars')),
-                                      getattr(test_tree, branch.GetName()).minNll())
-
-keys = adict.keys()
-keys.sort()
-
-var_string_list = []
-array_list = []
-for akey in keys:
-    astring, minNLL = adict[akey]
-    array_list.append((akey, minNLL))
-    var_string_list.append(astring) 
+# The scan of the fit to the data (see compact_results)
+result = read_tree_entry(test_tree)
+var_string_list = [get_variable_string(result, j) 
+                   for j in range(len(result['scan_points']))]
+array_list = zip(result['scan_points'], result['scan_min_nll'])
 
 # No get the index of the minimum ll above model_amplitude of 0
 ll_array = numpy.array(array_list)
@@ -153,47 +142,49 @@ MPI stuff
 """
 #####################################
 comm = MPI.COMM_WORLD
-sendbuf=[]
-root=0
-
+output_file = 'output_WM_%g.pkl' % wimp_mass
+batch_size = 100
 
 if comm.Get_rank()==0:
     print "Using number of nodes: ", comm.Get_size()
 
-    number = comm.Get_size()-1
-    step_size = int((len(string_np))/(number))
-    # The last slice just prunes the end
-    m =  string_np[0::step_size][:number]
-    temp =  string_np[0::len(string_np)+1]
-    print len(temp)
-    sendbuf = numpy.concatenate((temp, m))
-
-print "Scatter for: ", comm.Get_rank()
-var_cache=comm.scatter(sendbuf,root)
-print "Go for: ", comm.Get_rank(), '\n', var_cache
-results = []
-val_of_mod_amplitude = 0
-if comm.Get_rank() != 0:
+# The grid doesn't depend on the number of ranks, the farm hands
+# out its points to however many there are
+number = 15
+step_size = max(int((len(string_np))/(number)), 1)
+# The last slice just prunes the end
+points = [str(astring) for astring in string_np[0::step_size][:number]]
+units = split_into_batches(points, total_mc_entries, batch_size)
+farm = TaskFarm(comm, 
+                checkpoint_file=output_file + ".checkpoint",
+                header={'test_file' : sys.argv[1], 'units' : units},
+                resume=True)
+# Let rank 0 answer the other ranks between its toys
+calc_system.set_result_callback(lambda *args: farm.service())
+
+def calculate_unit(unit):
+    index, var_cache, number_iterations = unit
     temp = ROOT.istringstream(var_cache)
     fit_model.getVariables().readFromStream(temp, False)
-    val_of_mod_amplitude = model_normal.getVal()
-    total_entries = int(fit_model.expectedEvents(variables)) + 1
-    results = calc_system.scan_confidence_value_space_for_model(
+    return calc_system.scan_confidence_value_space_for_model(
                       fit_model, 
                       test_variable,
                       variables,
                       0,
-                      total_mc_entries,
+                      number_iterations,
                       0.9)
-results = (val_of_mod_amplitude, normalization, results)
 
+print "Go for: ", comm.Get_rank()
+unit_results = farm.run(units, calculate_unit)
 print "Finished: ", comm.Get_rank()
-recvbuf = comm.gather(results,root)
-print "Sent: ", comm.Get_rank()
 
-if comm.Get_rank()==0:
+if farm.is_root():
     print "Finishing"
-    afile = open('output_WM_%g.pkl' % wimp_mass, 'wb')
-    recvbuf = recvbuf[1:]
+    recvbuf = []
+    for var_cache, results in zip(points, 
+                                  merge_batches(units, unit_results, len(points))):
+        fit_model.getVariables().readFromStream(ROOT.istringstream(var_cache), False)
+        recvbuf.append((model_normal.getVal(), normalization, results))
+    afile = open(output_file, 'wb')
     pickle.dump(recvbuf, afile)
     afile.close()
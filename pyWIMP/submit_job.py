@@ -1,6 +1,13 @@
 #!/usr/bin/env python
-import os
-import time
+import optparse
+from pyWIMP.utilities.submission import Job, get_backend
+
+parser = optparse.OptionParser()
+parser.add_option("-b", "--backend", dest="backend",\
+                  help="Submission backend: pbs or local",\
+                  default="pbs")
+(options, args) = parser.parse_args()
+backend = get_backend(options.backend)
 
 # First the vitals of the job
 queue = ["default", "scavenge"]
@@ -17,8 +24,7 @@ wimp_list.extend(range(30, 100+1, 10))
 #Now the particulars of the calculations 
 
 file_basename = "mgm_wimp_many_two" 
-max_time = 3600*int(hours) + 60*int(minutes)
-max_time -= 60 # allow for some extra padding in the wall clock
+walltime = 3600*int(hours) + 60*int(minutes) + int(seconds)
 j = 0
 #wimp_list = [100, 80, 60, 40]
 for ajob in wimp_list:
@@ -28,23 +34,15 @@ for ajob in wimp_list:
 trap : SIGINT
 trap "echo TERM" SIGTERM
 cd %s
-time mpirun -np %i -hostfile $PBS_NODEFILE python %s/pyWIMP/mpi_job_engine.py %g 
-     """ % (sens_home, cores*nodes, sens_home, ajob)
+time mpirun -np $NUM_CORES -hostfile $PBS_NODEFILE python %s/pyWIMP/mpi_job_engine.py %g 
+     """ % (sens_home, sens_home, ajob)
     
-    print "Submitting job"
-    write_handle = os.popen("""
-qsub \\
-  -N %s_job_%s \\
-  -q %s \\
-  -l nodes=%i:ppn=%i\\
-  -l walltime=%s:%s:%s\\
-  -e %s/output_%s_job_%s.err\\
-  -o %s/output_%s_job_%s.out\\
-        """ % (file_basename, job, queue[j%2], nodes, cores,
-               hours, minutes, seconds,
-               path_of_results, file_basename, job,
-               path_of_results, file_basename, job), 
-            'w')
-    write_handle.write(execution_string)
-    write_handle.close()
+    backend.submit(Job("%s_job_%s" % (file_basename, job),
+                       execution_string,
+                       cores = cores,
+                       nodes = nodes,
+                       walltime = walltime,
+                       queue = queue[j%2],
+                       output_dir = path_of_results))
     j += 1
+backend.wait()
@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 import os
-import time
 import glob
 import numpy
+import optparse
+from pyWIMP.utilities.submission import Job, get_backend
+
+parser = optparse.OptionParser()
+parser.add_option("-b", "--backend", dest="backend",\
+                  help="Submission backend: pbs or local",\
+                  default="pbs")
+(options, args) = parser.parse_args()
+backend = get_backend(options.backend)
 
 # First the vitals of the job
 queue = ["scavenge", "scavenge", "scavenge"]
@@ -20,8 +28,7 @@ all_root_files = all_root_files[0::2] # split the size in two
 #Now the particulars of the calculations 
 
 file_basename = "mgm_wimp_data_verify" 
-max_time = 3600*int(hours) + 60*int(minutes)
-max_time -= 60 # allow for some extra padding in the wall clock
+walltime = 3600*int(hours) + 60*int(minutes) + int(seconds)
 #wimp_list = [100, 80, 60, 40]
 job = 0
 
@@ -38,23 +45,15 @@ for afile in all_root_files:
 trap : SIGINT
 trap "echo TERM" SIGTERM
 cd %s
-time mpirun -np %i -hostfile $PBS_NODEFILE python %s/pyWIMP/mpi_job_engine_test_model.py %s 
-     """ % (output_dir, cores*nodes, sens_home, afile)
+time mpirun -np $NUM_CORES -hostfile $PBS_NODEFILE python %s/pyWIMP/mpi_job_engine_test_model.py %s 
+     """ % (output_dir, sens_home, afile)
     
-    print "Submitting job"
-    write_handle = os.popen("""
-qsub \\
-  -N %s_job_%s \\
-  -q %s \\
-  -l nodes=%i:ppn=%i\\
-  -l walltime=%s:%s:%s\\
-  -e %s/output_%s_job_%s.err\\
-  -o %s/output_%s_job_%s.out\\
-        """ % (file_basename, job, queue[job%2], nodes, cores,
-               hours, minutes, seconds,
-               path_of_results, file_basename, job,
-               path_of_results, file_basename, job), 
-            'w')
-    write_handle.write(execution_string)
-    write_handle.close()
+    backend.submit(Job("%s_job_%s" % (file_basename, job),
+                       execution_string,
+                       cores = cores,
+                       nodes = nodes,
+                       walltime = walltime,
+                       queue = queue[job%2],
+                       output_dir = path_of_results))
     job += 1
+backend.wait()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+import sys
+import os
+import optparse
+import signal
+import errno
+import select
+import itertools
+import pyWIMP.Calculation.calc_objects as co
+from pyWIMP.utilities import utilities
+from pyWIMP.utilities.result_writer import ColumnBuffer
+from pyWIMP.utilities.framing import write_message, MessageReader
+from pyWIMP.job_engine import write_output, get_available_models, \
+                              usage, add_model_options
+
+def get_sweep_points(input_variables, sweep_list):
+    """
+    Returns the list of input variables of each point of the sweep,
+    the product of the values of sweep_list, a list of strings
+    'key=value1,value2,...', with the other variables taken from
+    input_variables.  Values are converted to the type of the value
+    in input_variables.
+    """
+    keys = []
+    values = []
+    for asweep in sweep_list:
+        key, val = asweep.split('=', 1)
+        if key not in input_variables.keys():
+            raise KeyError("Unknown variable in sweep: %s" % key)
+        conv = type(input_variables[key])
+        if conv == bool: 
+            conv = lambda aval: aval.lower() in ['1', 'true', 'yes']
+        elif conv == int: conv = float
+        keys.append(key)
+        values.append([conv(aval) for aval in val.split(',')])
+    points = []
+    for avals in itertools.product(*values):
+        adict = input_variables.copy()
+        adict.update(zip(keys, avals))
+        points.append(adict)
+    return keys, points
+
+def get_output_file(output_file, keys, input_variables):
+    """
+    Returns the name of the output file of a point of the sweep,
+    output_file with the values of the swept keys appended.
+    """
+    base, ext = os.path.splitext(output_file)
+    for key in keys:
+        base += "_%s_%s" % (key, str(input_variables[key]))
+    return base + ext
+
+def sweep_worker(task_des, result_des, model_factory, exit_manager):
+    """
+    Runs the items sent on task_des by the parent, sending the
+    results on result_des as messages (see WIMPModel.set_stream_results)
+    followed by ('done', item) when an item is finished.  The model is
+    kept between items and reused when only its reusable variables
+    change (see WIMPModel.update_input_variables).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, exit_manager.exit_handler)
+    reader = MessageReader(task_des)
+    model = None
+    while not exit_manager.is_exit_requested():
+        message = reader.read_message()
+        if message is None: break
+        kind, item, input_variables, first_iteration, num_iter = message
+        if model is None or \
+           not model.update_input_variables(input_variables):
+            print "Process %i: Building model for item %i" % \
+                  (os.getpid(), item)
+            model = model_factory(None, exit_manager,
+                                  num_iter, input_variables)
+        model.set_number_iterations(num_iter)
+        model.set_first_iteration(first_iteration)
+        model.set_stream_results()
+        # run closes its pipe, so it gets a copy
+        model.set_output_pipe(os.dup(result_des))
+        model.run()
+        write_message(result_des, ('done', item))
+    reader.close()
+    os.close(result_des)
+
+def sweep_runner(output_file,
+                 num_cpus,
+                 num_iter,
+                 num_chunks,
+                 max_time,
+                 model_factory,
+                 sweep_keys,
+                 points):
+    """
+    Runs the sweep over points (a list of input variables) with a pool
+    of num_cpus forked processes which are kept for the whole sweep.
+    Each point is split into num_chunks items of num_iter iterations,
+    an item is sent to a process as soon as it has finished its last
+    one, preferring an item which only changes the reusable variables
+    of the model the process has built.  The output of each point is
+    written to its own file (see get_output_file) once all its items
+    have finished.
+    """
+    items = []
+    for chunk in range(num_chunks):
+        for index in range(len(points)):
+            items.append((index, chunk*num_iter))
+    chunks_left = [num_chunks]*len(points)
+    # The results of each point are added to its columns as they arrive
+    results = [ColumnBuffer() for apoint in points]
+
+    def model_key(index):
+        # Points with the same key can reuse the same model
+        return [(akey, val) for akey, val in sorted(points[index].items())
+                if akey not in model_factory.reusable_variables]
+
+    sighand = utilities.SignalHandler
+    workers = {}
+    print "Scattering %i processes..." % num_cpus
+    sys.stdout.flush()
+    for i in range(num_cpus):
+        task_read, task_write = os.pipe()
+        result_read, result_write = os.pipe()
+        pid = os.fork()
+        if pid: # parent
+            os.close(task_read)
+            os.close(result_write)
+            workers[result_read] = [pid, task_write,
+                                    MessageReader(result_read), None]
+        else: # child process
+            os.close(task_write)
+            os.close(result_read)
+            # Don't hold the pipes of the other processes
+            for apid, atask, areader, aitem in workers.values():
+                os.close(atask)
+                areader.close()
+            sweep_worker(task_read, result_write, model_factory, sighand)
+            sys.exit(0)
+
+    def send_item(worker):
+        pid, task_des, reader, last_item = worker
+        if task_des is None: return
+        if not items:
+            os.close(task_des)
+            worker[1] = None
+            return
+        next_item = items[0]
+        if last_item is not None:
+            for an_item in items:
+                if model_key(an_item[0]) == model_key(last_item[0]):
+                    next_item = an_item
+                    break
+        items.remove(next_item)
+        index, first_iteration = next_item
+        worker[3] = next_item
+        item_id = item_ids.next()
+        sent[item_id] = next_item
+        write_message(task_des, ('item', item_id, points[index],
+                                 first_iteration, num_iter))
+
+    sent = {}
+    item_ids = itertools.count()
+    print "Parent (%i) setting signal handlers." % os.getpid()
+    signal.signal(signal.SIGINT, sighand.exit_handler)
+    signal.signal(signal.SIGALRM, sighand.exit_handler)
+    signal.alarm(max_time)
+    for worker in workers.values(): send_item(worker)
+    readers = workers.copy()
+    while readers:
+        try:
+            ready = select.select(readers.keys(), [], [])[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR: raise
+            print "Parent (%i) received signal" % os.getpid()
+            # Stop sending items
+            del items[:]
+            for worker in workers.values():
+                try:
+                    os.kill(worker[0], signal.SIGUSR1)
+                except: pass
+                send_item(worker)
+            continue
+        for fd in ready:
+            worker = readers[fd]
+            messages, eof = worker[2].read()
+            for message in messages:
+                if message[0] == 'result':
+                    index = worker[3][0]
+                    results[index].extend(message[3])
+                    continue
+                index, first_iteration = sent.pop(message[1])
+                chunks_left[index] -= 1
+                print "Parent (%i) collected point %i, iteration %i from process %i" % \
+                      (os.getpid(), index, first_iteration, worker[0])
+                if chunks_left[index] == 0 and not results[index]:
+                    print "Point %i has no results." % index
+                elif chunks_left[index] == 0:
+                    write_output(get_output_file(output_file, sweep_keys,
+                                                 points[index]),
+                                 model_factory.__name__, points[index],
+                                 results[index])
+                    results[index] = ColumnBuffer()
+                send_item(worker)
+            if eof:
+                print "Parent (%i) collected for process: %i" % \
+                      (os.getpid(), worker[0])
+                worker[2].close()
+                del readers[fd]
+    signal.alarm(0)
+    for i in range(len(workers)):
+        os.waitpid(-1, 0)
+    # Write what was finished of the points which were stopped
+    for index in range(len(points)):
+        if chunks_left[index] == 0 or not results[index]: continue
+        print "Point %i stopped, %i items unfinished." % \
+              (index, chunks_left[index])
+        write_output(get_output_file(output_file, sweep_keys, points[index]),
+                     model_factory.__name__, points[index], results[index])
+    print "Done."
+
+if __name__ == "__main__":
+    """
+    Runs a sweep of the input variables of a model, e.g.
+
+    sweep_runner.py WIMPModel --sweep wimp_mass=4,6,8,10 --sweep threshold=0.5,1
+    """
+    available_models = get_available_models()
+
+    if (len(sys.argv) < 2):
+        usage(available_models)
+        sys.exit(1)
+
+    model_name = sys.argv[1]
+    if not model_name in available_models:
+        print "Error finding model: ", model_name
+        usage(available_models)
+        sys.exit(1)
+    obj_factory = getattr(co, model_name)
+
+    parser = optparse.OptionParser(usage="usage: %prog model [options]")
+    req_items = add_model_options(parser, obj_factory)
+
+    parser.add_option("-s", "--sweep", dest="sweep",\
+                      help="Variable and values swept, e.g. wimp_mass=4,6,8 (can be repeated)",\
+                      action="append",\
+                      default=[])
+    parser.add_option("-o", "--output_file", dest="output_file",\
+                      help="Define the output file name (full path), the swept values are appended",\
+                      default="temp.root")
+    parser.add_option("-n", "--num_cpus", dest="numprocessors",\
+                      help="Define the number of cpus used",\
+                      default=utilities.detectCPUs())
+    parser.add_option("-a", "--max_time", dest="max_time",\
+                      help="Set the max time [seconds] until this program shuts down",\
+                      default=0)
+    parser.add_option("-i", "--num_iter", dest="num_iter",\
+                      help="Number of iterations per item",\
+                      default=10)
+    parser.add_option("-k", "--num_chunks", dest="num_chunks",\
+                      help="Number of items each point is split into",\
+                      default=1)
+
+    (options, args) = parser.parse_args()
+
+    output_dict = {}
+    for key in req_items.keys():
+        output_dict[key] = getattr(options, key)
+    sweep_keys, points = get_sweep_points(output_dict, options.sweep)
+
+    print "Sweeping %i points of %s with %i cpus." % \
+          (len(points), ", ".join(sweep_keys), int(options.numprocessors))
+    sys.stdout.flush()
+
+    sweep_runner(options.output_file,
+                 int(options.numprocessors),
+                 int(options.num_iter),
+                 int(options.num_chunks),
+                 int(options.max_time),
+                 obj_factory,
+                 sweep_keys,
+                 points)
@@ -6,6 +6,8 @@ import sys
 import cPickle as pickle
 from mpi4py import MPI
 import pyWIMP.Calculation.DataCalcVerification as dcv 
+from pyWIMP.utilities.task_farm import TaskFarm, split_into_batches, \
+                                       merge_batches
 import math
 
 
@@ -97,49 +99,49 @@ MPI stuff
 """
 #####################################
 comm = MPI.COMM_WORLD
-sendbuf=[]
-root=0
-
+output_file = 'output_Rolke_Test_%i.pkl' % job_number
+batch_size = 100
+
+# The grid doesn't depend on the number of ranks, the farm hands
+# out its points to however many there are
+number_of_iter_bkg = 8 
+number_of_iter_signal = 12
+step_size_bkg = float(10)/(number_of_iter_bkg-1)
+step_size_signal = float(10)/(number_of_iter_signal-1)
+points = [(i*step_size_signal+0.1, j*step_size_bkg) 
+          for j in xrange(number_of_iter_bkg)
+          for i in xrange(number_of_iter_signal)]
+units = split_into_batches(points, total_MC_iterations, batch_size)
 if comm.Get_rank()==0:
     print("Using number of nodes: ", comm.Get_size())
-    number_of_jobs = comm.Get_size() - 1
-    number_of_iter = int(math.sqrt(number_of_jobs))
-    number_of_iter_bkg = 8 
-    number_of_iter_signal = number_of_jobs/number_of_iter_bkg
-    step_size_bkg = float(10)/(number_of_iter_bkg-1)
-    step_size_signal = float(10)/(number_of_iter_signal-1)
-    m= numpy.array([[(i*step_size_signal+0.1, j*step_size_bkg) 
-       for i in xrange(number_of_iter_signal)] 
-       for j in xrange(number_of_iter_bkg)])
-
-
-    m.shape=(number_of_jobs, 2)
-    test = numpy.zeros((1,2))
-    sendbuf = numpy.concatenate((test, m))
-
-v = comm.scatter(sendobj=sendbuf,root=root)
-results = []
-if comm.Get_rank() != 0:
-    test_value, bgd_value = v
+farm = TaskFarm(comm, 
+                checkpoint_file=output_file + ".checkpoint",
+                header={'job_number' : job_number, 'units' : units},
+                resume=True)
+# Let rank 0 answer the other ranks between its toys
+calc_system.set_result_callback(lambda *args: farm.service())
+
+def calculate_unit(unit):
+    index, (test_value, bgd_value), number_iterations = unit
     print comm.Get_rank(), ": ", test_value, bgd_value
     test_variable.setVal(test_value)
     background.setVal(bgd_value)
-
-    results = calc_system.scan_confidence_value_space_for_model(
+    return calc_system.scan_confidence_value_space_for_model(
                       fit_model, 
                       test_variable,
                       variables,
                       100,
-                      total_MC_iterations,
+                      number_iterations,
                       0.9)
-    results = (test_value, bgd_value, results)
-    print "Finished: ", comm.Get_rank()
-                      
-recvbuf = comm.gather(results,root=root)
 
-if comm.Get_rank()==0:
-    recvbuf = recvbuf[1:]
+unit_results = farm.run(units, calculate_unit)
+print "Finished: ", comm.Get_rank()
+
+if farm.is_root():
+    recvbuf = [(test_value, bgd_value, results) 
+               for (test_value, bgd_value), results in zip(points, 
+                   merge_batches(units, unit_results, len(points)))]
     print "Finishing"
-    afile = open('output_Rolke_Test_%i.pkl' % job_number, 'wb')
+    afile = open(output_file, 'wb')
     pickle.dump(recvbuf, afile)
     afile.close()
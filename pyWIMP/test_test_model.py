@@ -10,6 +10,8 @@ from pyWIMP.DMModels.base_model import BaseVariables
 from pyWIMP.DMModels.wimp_model import WIMPModel
 from pyWIMP.DMModels.low_energy_background import TestModel
 import pyWIMP.Calculation.DataCalcVerification as dcv 
+from pyWIMP.utilities.compact_results import read_tree_entry, \
+                                            get_variable_string
 from pyWIMP.DMModels.low_energy_background import LowEnergyBackgroundModel
 
 
@@ -23,26 +25,11 @@ test_tree.GetEntry(0)
 
 wimp_mass = test_tree.wimp_mass 
 
-adict = {}
-list_of_branches = test_tree.GetListOfBranches()
-for i in range(list_of_branches.GetEntries()):
-    branch = list_of_branches.At(i)
-    try:
-        temp = float(branch.GetName())
-    except ValueError:
-        continue
-    adict[float(branch.GetName())] = (str(getattr(test_tree, branch.GetName()+'vars')),
-                                      getattr(test_tree, branch.GetName()).minNll())
-
-keys = adict.keys()
-keys.sort()
-
-var_string_list = []
-array_list = []
-for akey in keys:
-    astring, minNLL = adict[akey]
-    array_list.append((akey, minNLL))
-    var_string_list.append(astring) 
+# The scan of the fit to the data (see compact_results)
+result = read_tree_entry(test_tree)
+var_string_list = [get_variable_string(result, j) 
+                   for j in range(len(result['scan_points']))]
+array_list = zip(result['scan_points'], result['scan_min_nll'])
 
 # Now get the index of the minimum ll above model_amplitude of 0
 ll_array = numpy.array(array_list)
@@ -0,0 +1,53 @@
+import time
+
+class ToyBudget:
+    """
+    Measures the time toys take while they are performed, to only
+    start a toy if it is predicted to finish before deadline (a time
+    as from time.time()), instead of losing it when the job is
+    stopped.  The cost of a toy is the time since the first toy was
+    started divided by the number of toys finished, so toys performed
+    together (e.g. in a batch) are counted correctly.  The predicted
+    time of the toys started but not finished is multiplied by safety.
+    """
+    def __init__(self, deadline, safety = 1.2):
+        self.deadline = deadline
+        self.safety = safety
+        self.first_start = None
+        self.last_finish = None
+        self.started = 0
+        self.finished = 0
+
+    def get_toy_cost(self):
+        """
+        Returns the time (seconds) a toy takes, or None if no toy has
+        finished yet.
+        """
+        if not self.finished: return None
+        return (self.last_finish - self.first_start)/self.finished
+
+    def get_toys_per_hour(self):
+        cost = self.get_toy_cost()
+        if not cost: return None
+        return 3600./cost
+
+    def can_start(self):
+        """
+        Returns True if one more toy is predicted to finish, together
+        with the toys already started, before the deadline.  Before a
+        toy has finished, there is nothing to predict from and this is
+        True while the deadline hasn't passed.
+        """
+        now = time.time()
+        cost = self.get_toy_cost()
+        if cost is None: return now < self.deadline
+        in_flight = self.started - self.finished
+        return now + self.safety*cost*(in_flight + 1) < self.deadline
+
+    def start(self):
+        if self.first_start is None: self.first_start = time.time()
+        self.started += 1
+
+    def finish(self):
+        self.last_finish = time.time()
+        self.finished += 1
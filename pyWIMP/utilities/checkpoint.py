@@ -0,0 +1,125 @@
+import os
+import cPickle as pickle
+
+class Checkpoint:
+    """
+    An append-only file of the results of the iterations (toys) of a
+    job, written as each iteration finishes, so that a job which is
+    stopped (e.g. at the walltime of a queue) can be resumed without
+    repeating the iterations it finished.
+
+    The first record of the file is a header describing the job, the
+    following records are (iteration, seed, results), the results
+    holding only numbers and numpy arrays (see compact_results).  The
+    results are pickled separately inside the record, so that the
+    finished iterations can be read without unpickling them, they
+    are unpickled when they are needed (see iterate_results).  Each
+    record is written with a single write to a file opened in append
+    mode, so the file can be shared by forked processes.
+    """
+    def __init__(self, path, header = None, resume = False):
+        """
+        Opens the checkpoint at path.  If resume is set and the file
+        exists, the records are read and new records are appended,
+        otherwise a new file is started with header.  Raises
+        ValueError if the header of the file doesn't match header.
+        """
+        self.path = path
+        self.records = []
+        if resume and os.path.exists(path):
+            self.read(header)
+        else:
+            self.start(header)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+    def start(self, header):
+        """
+        Starts a new file with header.
+        """
+        afile = open(self.path, 'wb')
+        pickle.dump(('header', header), afile, 2)
+        afile.close()
+
+    def read(self, header):
+        """
+        Reads the records of the file.  A record which was only partly
+        written (e.g. the job was killed while writing) is cut off the
+        end of the file.
+        """
+        afile = open(self.path, 'rb')
+        try:
+            file_header = pickle.load(afile)
+        except (EOFError, pickle.UnpicklingError):
+            # Not even the header was written
+            afile.close()
+            self.start(header)
+            return
+        if file_header != ('header', header):
+            afile.close()
+            raise ValueError("Checkpoint (%s) is of a different job: %s" %
+                             (self.path, str(file_header[1])))
+        end_of_records = afile.tell()
+        while 1:
+            try:
+                self.records.append(pickle.load(afile))
+            except (EOFError, pickle.UnpicklingError, ValueError,
+                    IndexError, AttributeError):
+                # End of file, or a partly written record
+                break
+            end_of_records = afile.tell()
+        afile.close()
+        if end_of_records != os.path.getsize(self.path):
+            afile = open(self.path, 'r+b')
+            afile.truncate(end_of_records)
+            afile.close()
+
+    def append(self, iteration, seed, results):
+        """
+        Appends the results of iteration, generated from seed.
+        """
+        os.write(self.fd, pickle.dumps((iteration, seed,
+                                        pickle.dumps(results, 2)), 2))
+
+    def get_completed_iterations(self):
+        """
+        Returns the set of iterations read from the file.
+        """
+        return set([iteration for iteration, seed, results in self.records])
+
+    def get_results(self):
+        """
+        Returns the list of results read from the file, the results
+        of each iteration are added to the list.
+        """
+        results_list = []
+        for iteration, seed, results in self.records:
+            results_list.extend(pickle.loads(results))
+        return results_list
+
+    def get_results_by_iteration(self):
+        """
+        Returns a dictionary of the results read from the file, keyed
+        by iteration.
+        """
+        adict = {}
+        for iteration, seed, results in self.records:
+            adict[iteration] = pickle.loads(results)
+        return adict
+
+    def iterate_results(self):
+        """
+        Yields (iteration, results) of each record read from the file,
+        ordered by iteration, unpickling the results one at a time.
+        """
+        for iteration, seed, results in sorted(self.records):
+            yield iteration, pickle.loads(results)
+
+    def release_records(self):
+        """
+        Drops the records read from the file, e.g. once their results
+        have been collected.
+        """
+        self.records = []
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,130 @@
+"""
+The results of the calculations only hold numbers and fixed-dtype
+numpy arrays (no ROOT objects), so that they are small to pickle
+and can be read and aggregated without loading ROOT.  A fit
+(RooFitResult) is stored as its minimum NLL, status and the values
+and errors of the floating parameters, a scan of fits as arrays
+with one entry per scan point:
+
+  scan_points            the values of the tested amplitude
+  scan_min_nll           the minimum NLL at each point
+  scan_status            the status of the fit at each point
+  scan_value_<name>      the value of parameter name at each point
+  scan_error_<name>      the error of parameter name at each point
+
+and a profile likelihood curve as scan_points and scan_delta_nll,
+the NLL less its minimum at each point.
+"""
+import numpy
+
+def get_fit_result_arrays(fit_result):
+    """
+    Returns (names, values, errors) of the floating parameters of the
+    RooFitResult fit_result after the fit, values and errors as arrays.
+    """
+    pars = fit_result.floatParsFinal()
+    number_of_pars = pars.getSize()
+    names = []
+    values = numpy.zeros(number_of_pars)
+    errors = numpy.zeros(number_of_pars)
+    for i in range(number_of_pars):
+        var = pars.at(i)
+        names.append(var.GetName())
+        values[i] = var.getVal()
+        errors[i] = var.getError()
+    return names, values, errors
+
+def compact_fit_result(fit_result, prefix):
+    """
+    Returns a dictionary of the numbers of the RooFitResult fit_result,
+    with keys prefix_min_nll, prefix_status, prefix_<name> and
+    prefix_<name>_error for each floating parameter.
+    """
+    output_dict = {}
+    output_dict[prefix + '_min_nll'] = fit_result.minNll()
+    output_dict[prefix + '_status'] = float(fit_result.status())
+    names, values, errors = get_fit_result_arrays(fit_result)
+    for name, val, err in zip(names, values, errors):
+        output_dict['%s_%s' % (prefix, name)] = val
+        output_dict['%s_%s_error' % (prefix, name)] = err
+    return output_dict
+
+def compact_scan(test_points, fit_results):
+    """
+    Returns a dictionary of the arrays (see above) of the list of
+    RooFitResults fit_results, one at each of test_points.
+    """
+    number_of_points = len(test_points)
+    output_dict = {}
+    output_dict['scan_points'] = numpy.array(test_points, dtype=float)
+    output_dict['scan_min_nll'] = numpy.array(
+      [res.minNll() for res in fit_results], dtype=float)
+    output_dict['scan_status'] = numpy.array(
+      [res.status() for res in fit_results], dtype=float)
+    for j, res in enumerate(fit_results):
+        names, values, errors = get_fit_result_arrays(res)
+        for name, val, err in zip(names, values, errors):
+            if 'scan_value_' + name not in output_dict:
+                output_dict['scan_value_' + name] = \
+                  numpy.zeros(number_of_points)*float('nan')
+                output_dict['scan_error_' + name] = \
+                  numpy.zeros(number_of_points)*float('nan')
+            output_dict['scan_value_' + name][j] = val
+            output_dict['scan_error_' + name][j] = err
+    return output_dict
+
+def compact_curve(points, min_nll):
+    """
+    Returns a dictionary of the arrays scan_points and scan_delta_nll
+    of points, a list of (amplitude, NLL), sorted by the amplitude.
+    """
+    curve = numpy.array(points, dtype=float).reshape(-1, 2)
+    curve = curve[curve[:,0].argsort()]
+    return { 'scan_points' : curve[:,0],
+             'scan_delta_nll' : curve[:,1] - min_nll }
+
+def get_scan_parameters(result):
+    """
+    Returns the sorted names of the parameters stored in the scan of
+    result (a dictionary of the scan arrays, e.g. a result or the
+    columns of a file).
+    """
+    names = [key[len('scan_value_'):] for key in result.keys()
+             if key.startswith('scan_value_')]
+    names.sort()
+    return names
+
+def get_variable_string(result, j):
+    """
+    Returns the values and errors of the parameters at point j of the
+    scan in result, in the format read by RooArgSet.readFromStream.
+    """
+    lines = []
+    for name in get_scan_parameters(result):
+        val = result['scan_value_' + name][j]
+        if numpy.isnan(val): continue
+        lines.append("%s = %.17g +/- %.17g" %
+                     (name, val, result['scan_error_' + name][j]))
+    return '\n'.join(lines) + '\n'
+
+def read_tree_entry(tree, entry = 0):
+    """
+    Returns a dictionary of the numbers and arrays of entry of the
+    TTree tree written by result_writer.write_tree.  String branches
+    are left out.
+    """
+    tree.GetEntry(entry)
+    result = {}
+    list_of_branches = tree.GetListOfBranches()
+    for i in range(list_of_branches.GetEntries()):
+        branch = list_of_branches.At(i)
+        leaf = branch.GetLeaf(branch.GetName())
+        if not leaf or leaf.GetTypeName() not in ('Double_t', 'Int_t',
+                                                  'Long_t', 'Long64_t'):
+            continue
+        if '[' in branch.GetTitle():
+            result[branch.GetName()] = numpy.array(
+              [leaf.GetValue(j) for j in range(leaf.GetLen())])
+        else:
+            result[branch.GetName()] = leaf.GetValue()
+    return result
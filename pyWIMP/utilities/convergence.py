@@ -0,0 +1,87 @@
+import math
+import numpy
+
+def get_sigma_quantiles():
+    """
+    Returns the quantiles of the -2, -1, 0, 1 and 2 sigma points of
+    a normal distribution (the median and the +-1 and +-2 sigma
+    bands).
+    """
+    return [0.5*(1 + math.erf(n_sigma/math.sqrt(2)))
+            for n_sigma in [-2, -1, 0, 1, 2]]
+
+def get_quantile_interval(sorted_values, quantile, z = 1.):
+    """
+    Returns (lower, estimate, upper) of quantile of the distribution
+    sorted_values were drawn from, lower and upper being the order
+    statistics bounding it at z sigma: the number of values below
+    the quantile is binomial, (n, quantile).  Returns None if there
+    are too few values for the interval.
+    """
+    n = len(sorted_values)
+    if n == 0: return None
+    mean = n*quantile
+    width = z*math.sqrt(n*quantile*(1 - quantile))
+    lower = int(math.floor(mean - width))
+    upper = int(math.ceil(mean + width))
+    if lower < 0 or upper > n - 1: return None
+    estimate = sorted_values[min(int(mean), n - 1)]
+    return sorted_values[lower], estimate, sorted_values[upper]
+
+class QuantileMonitor:
+    """
+    Follows the median and the +-1 and +-2 sigma quantiles of key
+    (e.g. bounded_limit) in the results of the toys as they arrive,
+    to stop performing toys once each quantile is known to precision,
+    relative to its value.  The uncertainty of a quantile is the
+    half-width of its z sigma interval (see get_quantile_interval).
+    The k-th result of each toy (e.g. of the k-th hypothesis, see
+    BaseCalculation.set_hypotheses) is followed separately, and all
+    have to be known to precision, with at least min_toys toys.
+    """
+    def __init__(self, precision, key = 'bounded_limit',
+                 min_toys = 20, z = 1.):
+        self.precision = precision
+        self.key = key
+        self.min_toys = min_toys
+        self.z = z
+        self.quantiles = get_sigma_quantiles()
+        self.values = []
+        self.number_of_toys = 0
+
+    def add(self, results):
+        """
+        Adds the list of results of a toy.
+        """
+        self.number_of_toys += 1
+        for k, result in enumerate(results):
+            if k >= len(self.values): self.values.append([])
+            val = result.get(self.key)
+            if val is None or numpy.isnan(val): continue
+            self.values[k].append(val)
+
+    def get_relative_precision(self):
+        """
+        Returns the largest uncertainty of the quantiles relative to
+        their values, or None while an interval can't be found (or
+        a quantile with an uncertainty is 0).
+        """
+        if not self.values: return None
+        worst = 0
+        for values in self.values:
+            sorted_values = numpy.sort(values)
+            for quantile in self.quantiles:
+                interval = get_quantile_interval(sorted_values, quantile,
+                                                 self.z)
+                if interval is None: return None
+                lower, estimate, upper = interval
+                half_width = 0.5*(upper - lower)
+                if half_width == 0: continue
+                if estimate == 0: return None
+                worst = max(worst, half_width/math.fabs(estimate))
+        return worst
+
+    def is_converged(self):
+        if self.number_of_toys < self.min_toys: return False
+        precision = self.get_relative_precision()
+        return precision is not None and precision <= self.precision
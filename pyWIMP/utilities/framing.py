@@ -0,0 +1,74 @@
+"""
+Length-prefixed messages on pipes.  Each message is a pickled object
+preceded by its length as an 8-byte integer, so that a stream of
+messages can be read back one at a time as the data arrives.
+"""
+import os
+import errno
+import struct
+import cPickle as pickle
+
+header = struct.Struct('<Q')
+
+def write_message(fd, obj):
+    """
+    Writes obj as a message on the file descriptor fd.
+    """
+    data = pickle.dumps(obj, 2)
+    data = header.pack(len(data)) + data
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError, e:
+            if e.errno == errno.EINTR: continue
+            raise
+        data = data[written:]
+
+class MessageReader:
+    """
+    Reads the messages written with write_message on the file
+    descriptor fd without blocking on incomplete messages, e.g. when
+    fd is multiplexed with select.
+    """
+    def __init__(self, fd, read_size = 65536):
+        self.fd = fd
+        self.read_size = read_size
+        self.buffer = ''
+        self.messages = []
+
+    def fileno(self): return self.fd
+
+    def read(self):
+        """
+        Reads the data available on fd (this blocks if there is none).
+        Returns (messages, eof), messages being the list of messages
+        completed by the data, and eof if the pipe was closed.
+        """
+        try:
+            data = os.read(self.fd, self.read_size)
+        except OSError, e:
+            if e.errno == errno.EINTR: return [], False
+            raise
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= header.size:
+            length = header.unpack(self.buffer[:header.size])[0]
+            end = header.size + length
+            if len(self.buffer) < end: break
+            messages.append(pickle.loads(self.buffer[header.size:end]))
+            self.buffer = self.buffer[end:]
+        return messages, len(data) == 0
+
+    def read_message(self):
+        """
+        Returns the next message, blocking until it has arrived, or
+        None if the pipe was closed.
+        """
+        while not self.messages:
+            messages, eof = self.read()
+            self.messages.extend(messages)
+            if eof and not self.messages: return None
+        return self.messages.pop(0)
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,194 @@
+"""
+Calculates limits from the profile likelihood curves stored in the
+results (scan_points and scan_delta_nll, see compact_results), so
+that the limits at any confidence level can be derived after the
+toys have been performed.  The curves of all the toys are handled
+at once, as 2-d arrays with one row per toy (e.g. the columns of
+the npz file written by job_engine), rows shorter than the others
+padded with NaN at the end.  No ROOT is needed.  The calculations
+use the same functions for the curve of each toy, instead of
+stepping along a RooCurve.
+"""
+import math
+import numpy
+from utilities import find_root_brent
+
+def get_delta_nll_level(cl):
+    """
+    Returns the rise of the NLL at which a limit at confidence level
+    cl is set, half of the chi^2 (1 degree of freedom) quantile of cl,
+    as in the calculations.
+    """
+    z = find_root_brent(lambda x: math.erf(x/math.sqrt(2)) - cl, 0, 40,
+                        tolerance = 1e-12)
+    return 0.5*z*z
+
+def interpolate_at(points, delta_nll, value):
+    """
+    Returns the linear interpolation of each curve at value (an array,
+    one per curve), NaN where value is outside the curve.
+    """
+    columns = numpy.arange(points.shape[1])
+    below = numpy.where(points <= value[:, numpy.newaxis], columns, -1).max(axis=1)
+    above = numpy.where(points >= value[:, numpy.newaxis],
+                        columns, points.shape[1]).min(axis=1)
+    output = numpy.zeros(len(value))*float('nan')
+    found = (below >= 0) & (above < points.shape[1])
+    rows = numpy.flatnonzero(found)
+    x0, x1 = points[rows, below[found]], points[rows, above[found]]
+    y0, y1 = delta_nll[rows, below[found]], delta_nll[rows, above[found]]
+    width = numpy.where(x1 > x0, x1 - x0, 1)
+    output[found] = y0 + (value[found] - x0)*(y1 - y0)/width
+    return output
+
+def solve_quadratic_crossing(x0, y0, x1, y1, x2, y2, level):
+    """
+    Returns where the parabola through (x0, y0), (x1, y1) and (x2, y2)
+    crosses level between x0 and x1 (arrays), using the straight line
+    through the first two points where the parabola doesn't cross
+    there (or x2 is NaN).
+    """
+    width = numpy.where(x1 != x0, x1 - x0, 1)
+    rise = numpy.where(y1 != y0, y1 - y0, 1)
+    linear = x0 + (level - y0)*width/rise
+    output = linear.copy()
+    with numpy.errstate(all = 'ignore'):
+        # Newton's divided differences, in t = x - x0 the parabola is
+        # a*t**2 + b*t + c = 0 at the crossing
+        f01 = (y1 - y0)/width
+        f012 = ((y2 - y1)/(x2 - x1) - f01)/(x2 - x0)
+        a = f012
+        b = f01 - f012*width
+        c = y0 - level
+        root = numpy.sqrt(b*b - 4*a*c)
+        q = -0.5*(b + numpy.where(b < 0, -root, root))
+        for t in [q/a, c/q]:
+            good = numpy.isfinite(t) & (t/width >= 0) & (t/width <= 1) & \
+                   (output == linear)
+            output = numpy.where(good, x0 + t, output)
+    return output
+
+def find_crossings(points, delta_nll, start, start_nll, level, direction):
+    """
+    Returns the point where each curve first rises to level (a number
+    or an array, one per curve), walking from start (with the value
+    start_nll there) in direction (1 up, -1 down).  Between the points
+    of the curve around the crossing, the curve is taken to be the
+    parabola through them and the next point (see
+    solve_quadratic_crossing).  NaN where the curve doesn't reach
+    level.
+    """
+    number_of_points = points.shape[1]
+    columns = numpy.arange(number_of_points)
+    level = level*numpy.ones(len(start))
+    valid = numpy.isfinite(points) & numpy.isfinite(delta_nll)
+    beyond = valid & (direction*(points - start[:, numpy.newaxis]) > 0)
+    crossed = beyond & (delta_nll >= level[:, numpy.newaxis])
+    if direction > 0:
+        index = numpy.where(crossed, columns, number_of_points).min(axis=1)
+        found = index < number_of_points
+    else:
+        index = numpy.where(crossed, columns, -1).max(axis=1)
+        found = index >= 0
+    output = numpy.zeros(len(start))*float('nan')
+    rows = numpy.flatnonzero(found)
+    index = index[found]
+    def get_point(at):
+        inside = (at >= 0) & (at < number_of_points)
+        at = numpy.clip(at, 0, number_of_points - 1)
+        use = inside & beyond[rows, at]
+        return (numpy.where(use, points[rows, at], numpy.nan),
+                numpy.where(use, delta_nll[rows, at], numpy.nan))
+    x1, y1 = points[rows, index], delta_nll[rows, index]
+    # The point before the crossing is the last point of the curve
+    # beyond start, or start itself
+    x0, y0 = get_point(index - direction)
+    use_start = numpy.isnan(x0)
+    x0 = numpy.where(use_start, start[found], x0)
+    y0 = numpy.where(use_start, start_nll[found], y0)
+    # The third point of the parabola is the next one after the
+    # crossing, or else the one before x0 (or start)
+    x2, y2 = get_point(index + direction)
+    before_x, before_y = get_point(index - 2*direction)
+    before_x = numpy.where(numpy.isnan(before_x), start[found], before_x)
+    before_y = numpy.where(numpy.isnan(before_y), start_nll[found], before_y)
+    use_before = numpy.isnan(x2) & ~use_start
+    x2 = numpy.where(use_before, before_x, x2)
+    y2 = numpy.where(use_before, before_y, y2)
+    output[found] = solve_quadratic_crossing(x0, y0, x1, y1, x2, y2,
+                                             level[found])
+    return output
+
+def get_limits_at_level(points, delta_nll, level, zero_nll = None):
+    """
+    Returns a dictionary of the arrays unbounded_lower_limit,
+    unbounded_upper_limit, bounded_limit and best_fit of the curves
+    (points and delta_nll, 2-d arrays with one row per toy, or 1-d
+    for a single curve) where they rise by level above the minimum.
+    As in the calculations, the bounded limit is found from the curve
+    shifted by zero_nll (the value at an amplitude of 0, interpolated
+    from the curve if not given) if the best fit is below 0, and the
+    lower limit isn't searched for below 0 (it is the best fit if
+    that is below 0).  The upper limits are NaN where the curve
+    doesn't reach the level.
+    """
+    points = numpy.atleast_2d(numpy.asarray(points, dtype=float))
+    delta_nll = numpy.atleast_2d(numpy.asarray(delta_nll, dtype=float))
+    valid = numpy.isfinite(points) & numpy.isfinite(delta_nll)
+    number_of_toys = points.shape[0]
+    rows = numpy.arange(number_of_toys)
+
+    # The minimum of each curve
+    best = numpy.where(valid, delta_nll, numpy.inf).argmin(axis=1)
+    best_fit = points[rows, best]
+    best_nll = delta_nll[rows, best]
+    best_fit[~valid.any(axis=1)] = numpy.nan
+
+    unbounded_upper_limit = find_crossings(points, delta_nll,
+        best_fit, best_nll, level, 1)
+    unbounded_lower_limit = find_crossings(points, delta_nll,
+        best_fit, best_nll, level, -1)
+    positive = best_fit > 0
+    unbounded_lower_limit = numpy.where(
+        numpy.isnan(unbounded_lower_limit) | (unbounded_lower_limit < 0),
+        0, unbounded_lower_limit)
+    unbounded_lower_limit = numpy.where(positive, unbounded_lower_limit,
+                                        best_fit)
+
+    bounded_limit = unbounded_upper_limit.copy()
+    negative = numpy.flatnonzero(best_fit < 0)
+    if len(negative):
+        zero = numpy.zeros(len(negative))
+        if zero_nll is None:
+            zero_nll = interpolate_at(points[negative], delta_nll[negative], zero)
+        else:
+            zero_nll = (zero_nll*numpy.ones(number_of_toys))[negative]
+        bounded_limit[negative] = find_crossings(points[negative],
+            delta_nll[negative], zero, zero_nll, zero_nll + level, 1)
+
+    return { 'unbounded_lower_limit' : unbounded_lower_limit,
+             'unbounded_upper_limit' : unbounded_upper_limit,
+             'bounded_limit' : bounded_limit,
+             'best_fit' : best_fit }
+
+def get_limits(points, delta_nll, cl, mult_factor = 1.):
+    """
+    Returns the limits (see get_limits_at_level) of the curves at
+    confidence level cl, multiplied by mult_factor (a number or an
+    array, one per toy).
+    """
+    limits = get_limits_at_level(points, delta_nll, get_delta_nll_level(cl))
+    for name in limits.keys(): limits[name] = limits[name]*mult_factor
+    return limits
+
+def get_limits_from_columns(columns, cl):
+    """
+    Returns the limits (see get_limits) at confidence level cl of the
+    curves in columns, a dictionary of the columns of a file (see
+    result_writer.collect_columns), e.g. as loaded with numpy.load
+    from the npz file.
+    """
+    mult_factor = 1.
+    if 'mult_factor' in columns: mult_factor = columns['mult_factor']
+    return get_limits(columns['scan_points'], columns['scan_delta_nll'],
+                      cl, mult_factor)
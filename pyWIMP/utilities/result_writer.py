@@ -0,0 +1,277 @@
+import types
+import array
+import numpy
+
+def is_root_object(val):
+    """
+    Returns True if val is a ROOT object which can be saved in a branch.
+    """
+    if not hasattr(val, 'InheritsFrom'): return False
+    import ROOT
+    return bool(val.InheritsFrom(ROOT.TObject.Class()))
+
+class ColumnBuffer:
+    """
+    Collects results (dictionaries, which don't all need to have the
+    same keys) into columns as they arrive, so that only the numbers
+    are kept, in numpy arrays grown chunk_size rows at a time, and not
+    the dictionaries.  A numeric key gives a column of floats, with
+    NaN where a result doesn't have the key, a key holding 1-d arrays
+    (see compact_results) a 2-d column, one row per result, shorter
+    arrays padded with NaN, and a key holding ROOT objects a list,
+    with None where a result doesn't have the key.  Other keys aren't
+    saved.
+    """
+    def __init__(self, chunk_size = 1024):
+        self.chunk_size = chunk_size
+        self.number_of_rows = 0
+        self.capacity = 0
+        self.columns = {}
+        self.objects = {}
+        self.skipped = set()
+
+    def __len__(self): return self.number_of_rows
+
+    def reserve(self, number_of_rows):
+        """
+        Grows the columns to hold at least number_of_rows rows.
+        """
+        if number_of_rows <= self.capacity: return
+        capacity = max(number_of_rows, self.capacity + self.chunk_size)
+        for key, column in self.columns.items():
+            grown = numpy.zeros((capacity,) + column.shape[1:])*float('nan')
+            grown[:self.number_of_rows] = column[:self.number_of_rows]
+            self.columns[key] = grown
+        self.capacity = capacity
+
+    def get_column(self, key, width = None):
+        """
+        Returns the column of key, made (filled with NaN) if it is new,
+        and widened to width if it is a 2-d column.  A 1-d column is
+        made 2-d if width is given (the key held numbers in earlier
+        results and an array in this one), its numbers become the 
+        first element of each row.
+        """
+        column = self.columns.get(key)
+        if column is None:
+            shape = (self.capacity,)
+            if width is not None: shape = (self.capacity, width)
+            column = numpy.zeros(shape)*float('nan')
+            self.columns[key] = column
+        elif width is not None and column.ndim == 1:
+            promoted = numpy.zeros((self.capacity, max(width, 1)))*float('nan')
+            promoted[:, 0] = column
+            column = promoted
+            self.columns[key] = column
+        elif width is not None and column.shape[1] < width:
+            wider = numpy.zeros((self.capacity, width))*float('nan')
+            wider[:, :column.shape[1]] = column
+            column = wider
+            self.columns[key] = column
+        return column
+
+    def add(self, result):
+        """
+        Adds the result dictionary as the next row.
+        """
+        row = self.number_of_rows
+        self.reserve(row + 1)
+        for key, val in result.items():
+            if key in self.skipped: continue
+            if key in self.objects or is_root_object(val):
+                self.objects.setdefault(key, {})[row] = val
+                continue
+            if isinstance(val, numpy.ndarray) and val.ndim == 1:
+                self.get_column(key, len(val))[row, :len(val)] = val
+                continue
+            try:
+                val = float(val)
+            except (TypeError, ValueError):
+                print "Not saving %s, of type: %s" % (key, type(val).__name__)
+                self.skipped.add(key)
+                continue
+            column = self.get_column(key)
+            # A number after arrays is stored as an array of one
+            if column.ndim == 2: column[row, 0] = val
+            else: column[row] = val
+        self.number_of_rows += 1
+
+    def extend(self, results_list):
+        for result in results_list: self.add(result)
+
+    def add_columns(self, columns, objects, number_of_rows):
+        """
+        Adds the rows of columns and objects (as returned by 
+        get_columns, e.g. of another ColumnBuffer).
+        """
+        first = self.number_of_rows
+        self.reserve(first + number_of_rows)
+        for key, column in columns.items():
+            width = None
+            if column.ndim == 2: width = column.shape[1]
+            target = self.get_column(key, width)
+            if width is None and target.ndim == 2:
+                target[first:first + number_of_rows, 0] = column
+            elif width is None: target[first:first + number_of_rows] = column
+            else: target[first:first + number_of_rows, :width] = column
+        for key, a_list in objects.items():
+            rows = self.objects.setdefault(key, {})
+            for i, obj in enumerate(a_list):
+                if obj is not None: rows[first + i] = obj
+        self.number_of_rows += number_of_rows
+
+    def get_columns(self):
+        """
+        Returns (columns, objects): columns is a dictionary of the
+        numpy array of each numeric key, objects a dictionary of the
+        list of each key holding ROOT objects.
+        """
+        columns = {}
+        for key, column in self.columns.items():
+            columns[key] = column[:self.number_of_rows]
+        objects = {}
+        for key, rows in self.objects.items():
+            objects[key] = [rows.get(i) for i in range(self.number_of_rows)]
+        return columns, objects
+
+def collect_columns(results_list):
+    """
+    Collects the results (a list of dictionaries) into columns, see
+    ColumnBuffer.  Returns (columns, objects).
+    """
+    buffer = ColumnBuffer(max(len(results_list), 1))
+    buffer.extend(results_list)
+    return buffer.get_columns()
+
+fill_from_table_code = """
+#include "TTree.h"
+#include <cstring>
+void pywimp_fill_from_table(TTree* tree, Double_t* row, const Double_t* table,
+                            Long64_t number_of_entries, Long64_t width)
+{
+    for (Long64_t i = 0; i < number_of_entries; i++) {
+        std::memcpy(row, table + i*width, width*sizeof(Double_t));
+        tree->Fill();
+    }
+}
+"""
+
+def get_fill_from_table():
+    """
+    Returns the function fill(tree, row, table, number_of_entries,
+    width), which fills tree with number_of_entries entries, copying
+    each row of table (a C-contiguous 2-d array of doubles, width
+    columns) into row (the buffer the branches point into) before
+    filling.  The loop is compiled by the interpreter of ROOT, so the
+    entries aren't filled one by one from python.  (TTree::ReadStream
+    can't read the NaN which pad the columns.)
+    """
+    import ROOT
+    if not hasattr(ROOT, 'pywimp_fill_from_table'):
+        ROOT.gInterpreter.Declare(fill_from_table_code)
+    return ROOT.pywimp_fill_from_table
+
+def write_tree(output_file, model_name, input_variables, columns,
+               objects = {}, basket_size = 256000, compression = 1):
+    """
+    Writes the columns (see collect_columns) to the TTree
+    sensitivity_tree in output_file, one entry per result, together
+    with the input_variables and the name of the model (constant
+    branches).  The numeric and the array columns (fixed-length array
+    branches) are filled in one call from a table of all the entries
+    (see get_fill_from_table), entry by entry in python only if there
+    are ROOT objects.  basket_size (bytes) and compression (the compression
+    level of the file) are tuned for many small entries.
+    """
+    import ROOT
+    open_file = ROOT.TFile(output_file, "recreate", "", compression)
+    output_tree = ROOT.TTree("sensitivity_tree", "sensitivity_tree")
+
+    branch_list = []
+    string_list = []
+    for key, val in input_variables.items():
+        # Arg, checking types, shouldn't have to do this
+        root_type = ''
+        array_type = ''
+        if isinstance(val, types.FloatType):
+            root_type = 'D'
+            array_type = 'd'
+        elif isinstance(val, types.StringType):
+            root_type='string'
+            # Do nothing
+        else: # Assume integer
+            root_type = 'I'
+            array_type = 'l'
+
+        if root_type == 'string':
+            string_list.append(ROOT.string(val))
+            output_tree.Branch(key, string_list[-1])
+        else:
+            # We have to hold a reference to make sure
+            # the array doesn't get killed
+            branch_list.append(array.array(array_type, [val]))
+            output_tree.Branch(key, \
+                               branch_list[-1],\
+                               "%s/%s" % (key,root_type))
+    modelstring = ROOT.string(model_name)
+    output_tree.Branch("CalculationName", modelstring)
+
+    keys = sorted([key for key in columns.keys() if columns[key].ndim == 1])
+    array_keys = sorted([key for key in columns.keys()
+                         if columns[key].ndim == 2])
+    number_of_entries = 0
+    if keys: number_of_entries = len(columns[keys[0]])
+    for key in array_keys: number_of_entries = len(columns[key])
+    for key in objects.keys(): number_of_entries = len(objects[key])
+    # One table holds the numbers and the arrays of every entry, each
+    # branch points into a single row buffer, which is filled from 
+    # the table (see get_fill_from_table).
+    widths = [1]*len(keys) + [columns[key].shape[1] for key in array_keys]
+    offsets = numpy.concatenate(([0], numpy.cumsum(widths)))
+    table = numpy.empty((number_of_entries, offsets[-1]))
+    for i, key in enumerate(keys + array_keys):
+        table[:, offsets[i]:offsets[i+1]] = \
+          columns[key].reshape(number_of_entries, -1)
+    row = numpy.zeros(offsets[-1])
+    for i, key in enumerate(keys + array_keys):
+        leaf = "%s/D" % key
+        if key in array_keys: leaf = "%s[%i]/D" % (key, widths[i])
+        output_tree.Branch(key, row[offsets[i]:offsets[i+1]], leaf)
+
+    # ROOT objects are pointed to one by one, a default object
+    # stands in for missing ones
+    object_keys = objects.keys()
+    defaults = {}
+    for key in object_keys:
+        first = [obj for obj in objects[key] if obj is not None][0]
+        defaults[key] = first.__class__()
+        output_tree.Branch(key, first)
+    output_tree.SetBasketSize("*", basket_size)
+
+    if object_keys:
+        # The object branches have to be pointed at each entry's object
+        for i in range(number_of_entries):
+            row[:] = table[i]
+            for key in object_keys:
+                obj = objects[key][i]
+                if obj is None: obj = defaults[key]
+                output_tree.SetBranchAddress(key, obj)
+            output_tree.Fill()
+    else:
+        get_fill_from_table()(output_tree, row, table, 
+                              number_of_entries, len(row))
+
+    output_tree.Write()
+    open_file.Close()
+
+def write_npz(output_file, model_name, input_variables, columns):
+    """
+    Writes the columns (see collect_columns) to the numpy file
+    output_file, together with the input_variables and the name of
+    the model (stored as 0-d arrays, CalculationName for the model).
+    """
+    arrays = {}
+    for key, val in input_variables.items(): arrays[key] = numpy.array(val)
+    arrays['CalculationName'] = numpy.array(model_name)
+    arrays.update(columns)
+    numpy.savez(output_file, **arrays)
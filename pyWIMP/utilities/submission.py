@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+from utilities import detectCPUs
+
+class Job:
+    """
+    A batch job: the shell commands in script, run on nodes*cores
+    cores for at most walltime seconds.  memory (MB per job, 0 if
+    unknown), priority (higher starts first) and retries (times a
+    failed job is run again) are used by the LocalBackend.
+    """
+    def __init__(self, name, script,
+                 cores = 1, nodes = 1, walltime = 3600,
+                 memory = 0, priority = 0, retries = 0,
+                 queue = None, output_dir = '.'):
+        self.name = name
+        self.script = script
+        self.cores = cores
+        self.nodes = nodes
+        self.walltime = walltime
+        self.memory = memory
+        self.priority = priority
+        self.retries = retries
+        self.queue = queue
+        self.output_dir = output_dir
+
+    def get_output_file(self):
+        return os.path.join(self.output_dir, "output_%s.out" % self.name)
+    def get_error_file(self):
+        return os.path.join(self.output_dir, "output_%s.err" % self.name)
+
+class BaseBackend:
+    """
+    Submits Jobs, the backends define submit(job).  The jobs get the
+    environment variable MAX_TIME, the walltime less walltime_padding
+    seconds, the time the programs of the job should stop at (e.g.
+    job_engine --max_time $MAX_TIME) to leave time to write their
+    output before the job is killed, and NUM_CORES, the number of
+    cores the job is given (e.g. mpirun -np $NUM_CORES).
+    """
+    walltime_padding = 60
+
+    def get_max_time(self, job):
+        return max(job.walltime - self.walltime_padding, 0)
+
+    def get_job_cores(self, job):
+        return job.cores*job.nodes
+
+    def get_script(self, job):
+        """
+        Returns the script of job with the environment it expects.
+        """
+        return """
+export MAX_TIME=%i
+export NUM_CORES=%i
+%s""" % (self.get_max_time(job), self.get_job_cores(job), job.script)
+
+    def wait(self):
+        """
+        Waits for the submitted jobs, if this backend runs them.
+        """
+        pass
+
+class PBSBackend(BaseBackend):
+    """
+    Submits the jobs with qsub.
+    """
+    def submit(self, job):
+        hours = job.walltime/3600
+        minutes = (job.walltime % 3600)/60
+        seconds = job.walltime % 60
+        queue_string = ''
+        if job.queue: queue_string = "-q %s" % job.queue
+        print "Submitting job: %s" % job.name
+        write_handle = os.popen("""
+qsub \\
+  -N %s \\
+  %s \\
+  -l nodes=%i:ppn=%i\\
+  -l walltime=%i:%02i:%02i\\
+  -e %s\\
+  -o %s\\
+        """ % (job.name, queue_string, job.nodes, job.cores,
+               hours, minutes, seconds,
+               job.get_error_file(), job.get_output_file()),
+            'w')
+        write_handle.write(self.get_script(job))
+        write_handle.close()
+
+def get_total_memory():
+    """
+    Returns the memory of this machine in MB, or 0 if unknown.
+    """
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])/1024
+    except IOError: pass
+    return 0
+
+class LocalBackend(BaseBackend):
+    """
+    Runs the jobs on this machine, as many at a time as fit in cores
+    and memory (MB, 0 means no limit), the jobs with the highest
+    priority first.  A job is given nodes*cores cores (at most cores),
+    listed in a file in PBS_NODEFILE so that the scripts written for
+    PBS run unchanged.  A job which fails is run again up to its
+    retries, a job still running at its walltime is terminated.
+    """
+    def __init__(self, cores = None, memory = None, poll_interval = 1):
+        if cores is None: cores = detectCPUs()
+        if memory is None: memory = get_total_memory()
+        self.cores = cores
+        self.memory = memory
+        self.poll_interval = poll_interval
+        self.queued = []
+        self.running = []
+        self.failed = []
+        self.terminated = []
+        self.order = 0
+
+    def get_job_cores(self, job):
+        return min(job.cores*job.nodes, self.cores)
+
+    def submit(self, job):
+        print "Queueing job: %s" % job.name
+        # Highest priority first, then in the order submitted
+        self.queued.append((-job.priority, self.order, job, job.retries))
+        self.order += 1
+        self.queued.sort()
+
+    def start(self, job, retries_left):
+        node_file = os.path.join(job.output_dir, ".nodes_%s" % job.name)
+        afile = open(node_file, 'w')
+        afile.write("localhost\n"*self.get_job_cores(job))
+        afile.close()
+        env = os.environ.copy()
+        env['PBS_NODEFILE'] = node_file
+        print "Starting job: %s" % job.name
+        output = open(job.get_output_file(), 'a')
+        error = open(job.get_error_file(), 'a')
+        try:
+            process = subprocess.Popen(['/bin/sh', '-c', 
+                                        self.get_script(job)],
+                                       stdout=output, stderr=error,
+                                       cwd=job.output_dir, env=env)
+        finally:
+            # The job has its own copies
+            output.close()
+            error.close()
+        self.running.append((process, job, retries_left, time.time(),
+                             node_file))
+
+    def get_used(self):
+        cores = sum([self.get_job_cores(job)
+                     for process, job, r, t, f in self.running])
+        memory = sum([job.memory for process, job, r, t, f in self.running])
+        return cores, memory
+
+    def fits(self, job):
+        cores, memory = self.get_used()
+        if not self.running: return True # Always run at least one
+        if cores + self.get_job_cores(job) > self.cores: return False
+        if self.memory and memory + job.memory > self.memory: return False
+        return True
+
+    def poll(self):
+        """
+        Checks the running jobs, retrying the failed ones, and starts
+        queued jobs.  Returns True while jobs are left.
+        """
+        for entry in self.running[:]:
+            process, job, retries_left, start_time, node_file = entry
+            if process.poll() is None:
+                if time.time() - start_time > job.walltime + \
+                                              self.walltime_padding:
+                    process.kill()
+                elif time.time() - start_time > job.walltime and \
+                     process not in self.terminated:
+                    print "Job %s exceeded its walltime, terminating" % job.name
+                    process.send_signal(signal.SIGTERM)
+                    self.terminated.append(process)
+                continue
+            self.running.remove(entry)
+            os.remove(node_file)
+            over_time = process in self.terminated
+            if over_time: self.terminated.remove(process)
+            if process.returncode == 0:
+                print "Job %s finished" % job.name
+            elif retries_left > 0 and not over_time:
+                print "Job %s failed (%i), retrying" % \
+                      (job.name, process.returncode)
+                self.queued.append((-job.priority, self.order,
+                                    job, retries_left - 1))
+                self.order += 1
+                self.queued.sort()
+            else:
+                print "Job %s failed (%i)" % (job.name, process.returncode)
+                self.failed.append(job)
+        # Start jobs in order of priority while they fit
+        while self.queued and self.fits(self.queued[0][2]):
+            priority, order, job, retries_left = self.queued.pop(0)
+            self.start(job, retries_left)
+        return len(self.queued) + len(self.running) > 0
+
+    def wait(self):
+        """
+        Runs the queued jobs until all have finished.  Returns the list
+        of the jobs which failed.
+        """
+        while self.poll():
+            sys.stdout.flush()
+            time.sleep(self.poll_interval)
+        return self.failed
+
+available_backends = { 'pbs' : PBSBackend,
+                       'local' : LocalBackend }
+
+def get_backend(name, **kwargs):
+    """
+    Returns the backend called name (see available_backends).
+    """
+    if name not in available_backends.keys():
+        print "Requested: %s, isn't one of: %s" % (name,
+                                                   available_backends.keys())
+        raise TypeError
+    return available_backends[name](**kwargs)
@@ -0,0 +1,168 @@
+from mpi4py import MPI
+from checkpoint import Checkpoint
+
+def split_into_batches(points, number_iterations, batch_size):
+    """
+    Returns the units of number_iterations iterations (toys) at each
+    of points, in batches of at most batch_size iterations.  Each unit
+    is (index of the point, point, number of iterations).
+    """
+    units = []
+    for index, point in enumerate(points):
+        first = 0
+        while first < number_iterations:
+            number = min(batch_size, number_iterations - first)
+            units.append((index, point, number))
+            first += number
+    return units
+
+def merge_batches(units, results, number_of_points):
+    """
+    Returns the list of the results of each point, joining the lists 
+    of results of the units made by split_into_batches.
+    """
+    merged = [[] for i in range(number_of_points)]
+    for (index, point, number), unit_results in zip(units, results):
+        merged[index].extend(unit_results)
+    return merged
+
+class TaskFarm:
+    """
+    Hands out units of work (e.g. a batch of toys at one grid point)
+    to the ranks of an MPI communicator as they ask for them, instead
+    of scattering a fixed share to each rank, so that ranks with
+    cheap units do more of them.
+
+    The root rank holds the units and the results, and also works on
+    units, servicing the requests of the other ranks between its own
+    units (and whenever service is called, e.g. between toys).  Each
+    other rank holds one unit in advance, so that it doesn't wait for
+    the root while it is busy.  The results of each unit are appended
+    to a Checkpoint on the root as they arrive, and with resume the
+    units already in it are not done again.
+    """
+    result_tag = 1
+    unit_tag = 2
+
+    def __init__(self, comm = MPI.COMM_WORLD, root = 0,
+                 checkpoint_file = None, header = None, resume = False):
+        """
+        checkpoint_file, header and resume are only used on the root
+        (see Checkpoint).  Every rank has to make the farm: if the
+        checkpoint can't be opened (e.g. its header doesn't match), 
+        ValueError is raised on every rank, instead of only on the
+        root while the others wait for it.
+        """
+        self.comm = comm
+        self.root = root
+        self.checkpoint = None
+        self.results = {}
+        error = None
+        if self.is_root() and checkpoint_file:
+            try:
+                self.checkpoint = Checkpoint(checkpoint_file, header, resume)
+                self.results = self.checkpoint.get_results_by_iteration()
+                self.checkpoint.release_records()
+            except (ValueError, IOError, OSError), e:
+                error = str(e)
+        error = self.comm.bcast(error, root=root)
+        if error: raise ValueError(error)
+
+    def is_root(self): return self.comm.Get_rank() == self.root
+
+    def run(self, units, work_function, save_if = None):
+        """
+        Calls work_function(unit) for each of units, spread over the
+        ranks.  units is only needed on the root.  Returns on the root
+        the list of the results of each unit, None on the other ranks.
+        save_if(results), if given, decides whether the results of a
+        unit are saved to the checkpoint, e.g. not those of a unit
+        which was stopped before it finished, so that it is done again
+        on resume.
+        """
+        self.save_if = save_if
+        if not self.is_root():
+            self.run_worker(work_function)
+            return None
+
+        self.units = units
+        self.to_do = [index for index in range(len(units))
+                      if index not in self.results]
+        if self.results:
+            print "Resuming, %i units of %i done." % \
+                  (len(units) - len(self.to_do), len(units))
+        self.workers_left = self.comm.Get_size() - 1
+        while self.to_do:
+            index = self.to_do.pop(0)
+            self.store(index, work_function(self.units[index]))
+            self.service()
+        while self.workers_left:
+            self.service(True)
+        if self.checkpoint: self.checkpoint.close()
+        return [self.results[index] for index in range(len(units))]
+
+    def store(self, index, results):
+        self.results[index] = results
+        if not self.checkpoint: return
+        if self.save_if and not self.save_if(results): return
+        self.checkpoint.append(index, None, results)
+
+    def service(self, block = False):
+        """
+        Answers the messages of the other ranks, a result is stored
+        and answered with the next unit.  On the root this can be
+        called during a long unit, elsewhere it does nothing.  With
+        block, waits for at least one message.
+        """
+        if not self.is_root() or not hasattr(self, 'to_do'): return
+        status = MPI.Status()
+        while block or self.comm.Iprobe(source=MPI.ANY_SOURCE,
+                                        tag=self.result_tag,
+                                        status=status):
+            block = False
+            kind, index, results = self.comm.recv(source=MPI.ANY_SOURCE,
+                                                  tag=self.result_tag,
+                                                  status=status)
+            source = status.Get_source()
+            if kind == 'done':
+                self.workers_left -= 1
+                continue
+            number = 1
+            if kind == 'request': number = index
+            else: self.store(index, results)
+            send_units = []
+            while self.to_do and len(send_units) < number:
+                index = self.to_do.pop(0)
+                send_units.append((index, self.units[index]))
+            self.comm.send(send_units, dest=source, tag=self.unit_tag)
+
+    def run_worker(self, work_function):
+        """
+        Asks the root for units and works on them until the root has
+        none left.  The result of a unit is sent without waiting, and
+        the reply (the next unit) is only waited for once the unit
+        held in advance is done.
+        """
+        self.comm.send(('request', 2, None), dest=self.root,
+                       tag=self.result_tag)
+        outstanding = 1
+        pending = []
+        send_request = None
+        while 1:
+            while outstanding and (not pending or
+                                   self.comm.Iprobe(source=self.root,
+                                                    tag=self.unit_tag)):
+                pending.extend(self.comm.recv(source=self.root,
+                                              tag=self.unit_tag))
+                outstanding -= 1
+            if not pending: break
+            index, unit = pending.pop(0)
+            results = work_function(unit)
+            if send_request: send_request.Wait()
+            send_request = self.comm.isend(('result', index, results),
+                                           dest=self.root,
+                                           tag=self.result_tag)
+            outstanding += 1
+        if send_request: send_request.Wait()
+        self.comm.send(('done', None, None), dest=self.root,
+                       tag=self.result_tag)
@@ -0,0 +1,53 @@
+import os
+import errno
+import struct
+
+class TaskQueue:
+    """
+    A queue of iterations (toy indices) shared by forked processes
+    through a pipe.  The parent puts the iterations on the pipe (all
+    at once, or a few at a time as the workers ask for them) and
+    closes its write end, each worker gets the next iteration when it
+    has finished the last one, so that fast workers do more
+    iterations than slow ones.  Each iteration is an 8-byte integer
+    written and read in a single call, which the pipe keeps whole,
+    so several workers can read from the same pipe.
+    """
+    record = struct.Struct('<q')
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def put(self, iteration):
+        """
+        Puts iteration on the queue, blocks while the pipe is full.
+        """
+        os.write(self.write_fd, self.record.pack(iteration))
+
+    def get(self):
+        """
+        Returns the next iteration, or None if the queue was closed
+        and is empty, or the read was interrupted by a signal (e.g.
+        requesting an exit).
+        """
+        try:
+            data = os.read(self.read_fd, self.record.size)
+        except OSError, e:
+            if e.errno == errno.EINTR: return None
+            raise
+        if len(data) < self.record.size: return None
+        return self.record.unpack(data)[0]
+
+    def close_writer(self):
+        """
+        Closes the write end, once the workers have emptied the
+        queue they get None.
+        """
+        if self.write_fd is None: return
+        os.close(self.write_fd)
+        self.write_fd = None
+
+    def close_reader(self):
+        if self.read_fd is None: return
+        os.close(self.read_fd)
+        self.read_fd = None
@@ -0,0 +1,224 @@
+import os
+import json
+import StringIO
+import numpy
+
+class ToyBank:
+    """
+    A bank of toy data sets which can be generated once and replayed
+    by many calculations, e.g. all the WIMP masses of a sweep which
+    share the same background.  The bank is a directory holding one
+    raw file per column (energy, time, weight) with the events of all
+    toys one after another, plus the offsets of each toy and a json
+    header with the configuration the toys were generated with.  The
+    columns are memory-mapped when read, so only the toys being used
+    are loaded.
+    """
+    columns = ['energy', 'time', 'weight']
+    header_name = 'bank.json'
+    offsets_name = 'offsets.i8'
+    column_dtype = '<f8'
+    offsets_dtype = '<i8'
+
+    def __init__(self, path):
+        self.path = path
+        header_file = open(os.path.join(path, self.header_name))
+        header = json.load(header_file)
+        header_file.close()
+        self.configuration = header['configuration']
+        self.number_of_toys = header['number_of_toys']
+        self.offsets = numpy.memmap(os.path.join(path, self.offsets_name),
+                                    dtype=self.offsets_dtype, mode='r')
+        self.column_data = {}
+        for column in self.columns:
+            column_path = os.path.join(path, column + '.f8')
+            if os.path.getsize(column_path) == 0:
+                # memmap can't map empty files
+                self.column_data[column] = numpy.zeros(0)
+                continue
+            self.column_data[column] = numpy.memmap(column_path,
+                                                    dtype=self.column_dtype,
+                                                    mode='r')
+
+    def get_number_of_toys(self): return self.number_of_toys
+
+    def check_configuration(self, configuration):
+        """
+        Raises ValueError if configuration doesn't match the
+        configuration the bank was generated with.
+        """
+        for key, val in configuration.items():
+            if key not in self.configuration or self.configuration[key] != val:
+                raise ValueError("Toy bank (%s) was generated with %s = %s, not %s" %
+                                 (self.path, key, self.configuration.get(key), val))
+
+    def get_toy(self, index):
+        """
+        Returns a dictionary of the column arrays of toy index.
+        """
+        if index < 0 or index >= self.number_of_toys:
+            raise IndexError("Toy %i is not in bank with %i toys" %
+                             (index, self.number_of_toys))
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        adict = {}
+        for column in self.columns:
+            adict[column] = self.column_data[column][start:stop]
+        return adict
+
+    def get_data_set(self, index, variables, energy, time, weighting = None):
+        """
+        Returns toy index as a RooDataSet of variables.  energy and
+        time are the RooRealVars of the columns, they are only filled
+        if they are in variables.  weighting is used if the toy
+        has weights different from 1.  The events are read into a
+        TTree in one call (TTree.ReadStream) and the data set is built
+        from it, instead of being added one by one.
+        """
+        import ROOT
+        toy = self.get_toy(index)
+        name = "toy_bank_%i" % index
+        columns = [(column, var) for column, var in 
+                   [('energy', energy), ('time', time)]
+                   if variables.find(var.GetName())]
+        weights = toy['weight']
+        is_weighted = weighting is not None and numpy.any(weights != 1)
+        data_vars = ROOT.RooArgSet(variables)
+        if is_weighted: 
+            columns.append(('weight', weighting))
+            data_vars.add(weighting)
+        tree = ROOT.TTree(name + "_tree", name + "_tree")
+        tree.SetDirectory(0)
+        stream = StringIO.StringIO()
+        numpy.savetxt(stream, numpy.array([toy[column] for column, var 
+                                           in columns]).T, fmt='%.17g')
+        tree.ReadStream(ROOT.istringstream(stream.getvalue()),
+                        ':'.join(["%s/D" % var.GetName() 
+                                  for column, var in columns]))
+        if is_weighted:
+            data_set = ROOT.RooDataSet(name, name, tree, data_vars, "", 
+                                       weighting.GetName())
+        else:
+            data_set = ROOT.RooDataSet(name, name, tree, data_vars)
+        tree.IsA().Destructor(tree)
+        return data_set
+
+    def get_data_hist(self, index, variables, energy, time, weighting = None):
+        """
+        Returns toy index as a RooDataHist of variables, binned with
+        the binning of energy and time (only those in variables).  The
+        events are histogrammed with numpy and the histogram is copied
+        into a TH1D or TH2D in one call (SetContent), which the
+        RooDataHist is built from.  The weights are used if weighting
+        is given.
+        """
+        import ROOT
+        toy = self.get_toy(index)
+        name = "toy_bank_%i" % index
+        columns = [(column, var) for column, var in 
+                   [('energy', energy), ('time', time)]
+                   if variables.find(var.GetName())]
+        edges = []
+        for column, var in columns:
+            binning = var.getBinning()
+            edges.append(numpy.array([binning.binLow(j) 
+                                      for j in range(binning.numBins())] +
+                                     [binning.highBound()]))
+        weights = None
+        if weighting is not None: weights = toy['weight']
+        sample = numpy.array([toy[column] for column, var in columns]).T
+        contents = numpy.histogramdd(sample, bins=edges, weights=weights)[0]
+        errors = None
+        if weights is not None:
+            errors = numpy.sqrt(numpy.histogramdd(sample, bins=edges,
+                                                  weights=weights**2)[0])
+        # ROOT histograms include the under- and overflow bins and 
+        # have the first axis running fastest
+        def get_root_array(histogram):
+            padded = numpy.zeros([len(bin_edges) + 1 
+                                  for bin_edges in edges])
+            padded[tuple([slice(1, -1)]*len(edges))] = histogram
+            return numpy.ascontiguousarray(padded.T.ravel())
+        if len(edges) == 1:
+            hist = ROOT.TH1D(name + "_hist", name + "_hist",
+                             len(edges[0]) - 1, edges[0])
+        else:
+            hist = ROOT.TH2D(name + "_hist", name + "_hist",
+                             len(edges[0]) - 1, edges[0],
+                             len(edges[1]) - 1, edges[1])
+        hist.SetDirectory(0)
+        if errors is not None: hist.Sumw2()
+        hist.SetContent(get_root_array(contents))
+        if errors is not None: hist.SetError(get_root_array(errors))
+        var_list = ROOT.RooArgList()
+        for column, var in columns: var_list.add(var)
+        data_hist = ROOT.RooDataHist(name, name, var_list, hist)
+        hist.IsA().Destructor(hist)
+        return data_hist
+
+    def generate(cls, path, configuration, data_model, variables,
+                 energy, time, number_of_toys, logger = None):
+        """
+        Generates number_of_toys toys from data_model and writes them
+        into a new bank at path.  The variables of data_model are reset
+        before each toy.  Returns the ToyBank.
+        """
+        import ROOT
+        if not os.path.isdir(path): os.makedirs(path)
+        var_cache = ROOT.ostringstream()
+        data_model.getVariables().writeToStream(var_cache, False)
+        column_files = {}
+        for column in cls.columns:
+            column_files[column] = open(os.path.join(path, column + '.f8'), 'wb')
+        offsets = [0]
+        for i in range(number_of_toys):
+            if logger: logger("Generating toy (%i) of (%i)" % (i+1, number_of_toys))
+            data_model.getVariables().readFromStream(
+                ROOT.istringstream(var_cache.str()), False)
+            data_set = data_model.generate(variables)
+            toy = cls.get_columns(data_set, energy, time)
+            entries = len(toy['weight'])
+            for column in cls.columns:
+                toy[column].astype(cls.column_dtype).tofile(column_files[column])
+            offsets.append(offsets[-1] + entries)
+            data_set.IsA().Destructor(data_set)
+        for afile in column_files.values(): afile.close()
+        data_model.getVariables().readFromStream(
+            ROOT.istringstream(var_cache.str()), False)
+
+        numpy.array(offsets, dtype=cls.offsets_dtype).tofile(
+            os.path.join(path, cls.offsets_name))
+        header_file = open(os.path.join(path, cls.header_name), 'w')
+        json.dump({'configuration' : configuration,
+                   'number_of_toys' : number_of_toys}, header_file, indent=1)
+        header_file.close()
+        return cls(path)
+    generate = classmethod(generate)
+
+    def get_columns(cls, data_set, energy, time):
+        """
+        Returns a dictionary of the column arrays of the events of the
+        unweighted RooDataSet data_set, read from its tree in one call
+        (TTree.Draw), columns which aren't in data_set are filled with
+        the value of their variable.
+        """
+        data_set.convertToTreeStore()
+        tree = data_set.tree()
+        entries = int(tree.GetEntries())
+        toy = {'weight' : numpy.ones(entries)}
+        observables = data_set.get()
+        drawn = [(column, var) for column, var in 
+                 [('energy', energy), ('time', time)]
+                 if observables.find(var.GetName())]
+        for column, var in [('energy', energy), ('time', time)]:
+            toy[column] = numpy.ones(entries)*var.getVal()
+        if entries and drawn:
+            tree.SetEstimate(entries + 1)
+            tree.Draw(':'.join([var.GetName() for column, var in drawn]),
+                      "", "goff")
+            for i, (column, var) in enumerate(drawn):
+                buffer = getattr(tree, "GetV%i" % (i + 1))()
+                if hasattr(buffer, 'SetSize'): buffer.SetSize(entries)
+                toy[column] = numpy.array(numpy.frombuffer(buffer, 
+                                          dtype=float, count=entries))
+        return toy
+    get_columns = classmethod(get_columns)
@@ -56,6 +56,85 @@ def detectCPUs():
      return 1 # Default
 
 
+def get_rss():
+    """
+    Returns the resident memory of this process in MB, read from 
+    /proc/self/statm (Linux), or 0 if it isn't available.
+    """
+    try:
+        afile = open('/proc/self/statm')
+        pages = int(afile.read().split()[1])
+        afile.close()
+    except (IOError, IndexError, ValueError):
+        return 0
+    return pages*os.sysconf('SC_PAGE_SIZE')/(1024.*1024.)
+
+
+def find_root_brent(func, lower, upper, f_lower = None, f_upper = None,
+                    tolerance = 1e-6, f_tolerance = 0., max_iterations = 100):
+    """
+    Finds the root of func inside the bracket [lower, upper] using 
+    Brent's method (inverse quadratic interpolation, falling back to 
+    bisection).  func(lower) and func(upper) must have opposite signs, 
+    their values can be passed in as f_lower and f_upper if they are 
+    already known to save function evaluations.  Iteration stops when 
+    the bracket is smaller than tolerance or when |func| is smaller 
+    than f_tolerance.  Returns the abscissa of the root.
+    """
+    a, b = float(lower), float(upper)
+    if f_lower is None: f_lower = func(a)
+    if f_upper is None: f_upper = func(b)
+    fa, fb = f_lower, f_upper
+    if fa == 0: return a
+    if fb == 0: return b
+    if (fa > 0) == (fb > 0):
+        raise ValueError("Root is not bracketed: f(%g) = %g, f(%g) = %g" % 
+                         (a, fa, b, fb))
+    c, fc = b, fb
+    d = e = b - a
+    for i in range(max_iterations):
+        if (fb > 0) == (fc > 0):
+            # Root is between a and b, rename to keep it between b and c
+            c, fc = a, fa
+            d = e = b - a
+        if math.fabs(fc) < math.fabs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+        tol = 2e-16*math.fabs(b) + 0.5*tolerance
+        xm = 0.5*(c - b)
+        if math.fabs(xm) <= tol or fb == 0 or math.fabs(fb) < f_tolerance: 
+            return b
+        if math.fabs(e) >= tol and math.fabs(fa) > math.fabs(fb):
+            # Attempt inverse quadratic interpolation
+            s = fb/fa
+            if a == c:
+                p = 2*xm*s
+                q = 1 - s
+            else:
+                q = fa/fc
+                r = fb/fc
+                p = s*(2*xm*q*(q - r) - (b - a)*(r - 1))
+                q = (q - 1)*(r - 1)*(s - 1)
+            if p > 0: q = -q
+            p = math.fabs(p)
+            if 2*p < min(3*xm*q - math.fabs(tol*q), math.fabs(e*q)):
+                e = d
+                d = p/q
+            else:
+                # Interpolation failed, use bisection
+                d = xm
+                e = d
+        else:
+            d = xm
+            e = d
+        a, fa = b, fb
+        if math.fabs(d) > tol: b += d
+        elif xm > 0: b += tol
+        else: b -= tol
+        fb = func(b)
+    return b
+
+
 """
   SignalHandler handles signals being sent to and from a process.
 """
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Checks the predictions of ToyBudget with a clock which is moved by
+hand.  No ROOT is needed.
+"""
+import unittest
+from pyWIMP.utilities import budget
+
+class Clock:
+    def __init__(self): self.now = 1000.
+    def time(self): return self.now
+
+class TestToyBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.saved_time = budget.time
+        budget.time = self.clock
+
+    def tearDown(self):
+        budget.time = self.saved_time
+
+    def test_before_first_toy(self):
+        toy_budget = budget.ToyBudget(self.clock.now + 10)
+        self.assertEqual(toy_budget.get_toy_cost(), None)
+        self.assertEqual(toy_budget.get_toys_per_hour(), None)
+        self.assertTrue(toy_budget.can_start())
+        self.clock.now += 10
+        self.assertFalse(toy_budget.can_start())
+
+    def test_cost(self):
+        toy_budget = budget.ToyBudget(self.clock.now + 100, safety = 1.)
+        for i in range(4):
+            toy_budget.start()
+            self.clock.now += 5
+            toy_budget.finish()
+        self.assertAlmostEqual(toy_budget.get_toy_cost(), 5)
+        self.assertAlmostEqual(toy_budget.get_toys_per_hour(), 720)
+        # 80 seconds left, 5 per toy
+        self.assertTrue(toy_budget.can_start())
+        self.clock.now += 74
+        self.assertTrue(toy_budget.can_start())
+        self.clock.now += 2
+        self.assertFalse(toy_budget.can_start())
+
+    def test_batch_and_in_flight(self):
+        # Toys started together and finished together cost the time
+        # since the first start over the number finished
+        toy_budget = budget.ToyBudget(self.clock.now + 100, safety = 1.)
+        for i in range(4): toy_budget.start()
+        self.clock.now += 20
+        for i in range(4): toy_budget.finish()
+        self.assertAlmostEqual(toy_budget.get_toy_cost(), 5)
+        # 80 seconds left: with 10 toys in flight, one more would take
+        # 55 seconds, with 15 in flight 80
+        for i in range(10): toy_budget.start()
+        self.assertTrue(toy_budget.can_start())
+        for i in range(5): toy_budget.start()
+        self.assertFalse(toy_budget.can_start())
+
+    def test_safety(self):
+        toy_budget = budget.ToyBudget(self.clock.now + 20, safety = 2.)
+        toy_budget.start()
+        self.clock.now += 5
+        toy_budget.finish()
+        # 15 seconds left, a toy counts 10
+        self.assertTrue(toy_budget.can_start())
+        self.clock.now += 6
+        self.assertFalse(toy_budget.can_start())
+
+if __name__ == '__main__':
+    unittest.main()
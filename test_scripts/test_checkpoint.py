@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Checks writing, resuming and the recovery of a partly written record
+of the Checkpoint file.  No ROOT is needed.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from pyWIMP.utilities.checkpoint import Checkpoint
+
+class TestCheckpoint(unittest.TestCase):
+    header = { 'model' : 'WIMPModel', 'input_variables' : { 'mass' : 10 } }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'job.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, number_of_iterations):
+        checkpoint = Checkpoint(self.path, self.header)
+        for iteration in range(number_of_iterations):
+            checkpoint.append(iteration, 100 + iteration,
+                              [{ 'bounded_limit' : float(iteration) }])
+        checkpoint.close()
+
+    def test_resume(self):
+        self.write(3)
+        checkpoint = Checkpoint(self.path, self.header, resume = True)
+        self.assertEqual(checkpoint.get_completed_iterations(),
+                         set([0, 1, 2]))
+        self.assertEqual([val['bounded_limit']
+                          for val in checkpoint.get_results()], [0, 1, 2])
+        checkpoint.append(3, 103, [{ 'bounded_limit' : 3. }])
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, self.header, resume = True)
+        results = list(checkpoint.iterate_results())
+        self.assertEqual([iteration for iteration, a_list in results],
+                         [0, 1, 2, 3])
+        self.assertEqual(results[3][1], [{ 'bounded_limit' : 3. }])
+        checkpoint.release_records()
+        self.assertEqual(checkpoint.get_completed_iterations(), set())
+        checkpoint.close()
+
+    def test_truncated_record(self):
+        self.write(3)
+        size = os.path.getsize(self.path)
+        # Cut the last record in the middle, as if the job was killed
+        # while writing it
+        afile = open(self.path, 'r+b')
+        afile.truncate(size - 5)
+        afile.close()
+        checkpoint = Checkpoint(self.path, self.header, resume = True)
+        self.assertEqual(checkpoint.get_completed_iterations(), set([0, 1]))
+        # The partial record is cut off, so that new records follow
+        # the complete ones
+        checkpoint.append(2, 102, [{ 'bounded_limit' : 2. }])
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, self.header, resume = True)
+        self.assertEqual(checkpoint.get_results_by_iteration()[2],
+                         [{ 'bounded_limit' : 2. }])
+        checkpoint.close()
+
+    def test_truncated_header(self):
+        afile = open(self.path, 'wb')
+        afile.write('\x80')
+        afile.close()
+        checkpoint = Checkpoint(self.path, self.header, resume = True)
+        self.assertEqual(checkpoint.get_completed_iterations(), set())
+        checkpoint.close()
+
+    def test_other_job(self):
+        self.write(1)
+        self.assertRaises(ValueError, Checkpoint, self.path,
+                          { 'model' : 'OtherModel' }, True)
+
+    def test_without_resume(self):
+        self.write(2)
+        checkpoint = Checkpoint(self.path, self.header)
+        self.assertEqual(checkpoint.get_completed_iterations(), set())
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, self.header, resume = True)
+        self.assertEqual(checkpoint.get_completed_iterations(), set())
+        checkpoint.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Checks the quantile intervals and the stopping of QuantileMonitor on
+toys drawn from a known distribution.  No ROOT is needed.
+"""
+import unittest
+import numpy
+from pyWIMP.utilities import convergence
+
+class TestConvergence(unittest.TestCase):
+
+    def test_sigma_quantiles(self):
+        expected = [0.0227501319, 0.1586552539, 0.5,
+                    0.8413447461, 0.9772498681]
+        for quantile, value in zip(convergence.get_sigma_quantiles(),
+                                   expected):
+            self.assertAlmostEqual(quantile, value, 9)
+
+    def test_quantile_interval(self):
+        values = numpy.arange(100.)
+        lower, estimate, upper = convergence.get_quantile_interval(values,
+                                                                   0.5)
+        self.assertEqual(estimate, 50)
+        self.assertEqual((lower, upper), (45, 55))
+        # Too few values for the 2 sigma quantile
+        self.assertEqual(convergence.get_quantile_interval(values[:10],
+                                                           0.0227), None)
+        self.assertEqual(convergence.get_quantile_interval([], 0.5), None)
+
+    def test_monitor(self):
+        random = numpy.random.RandomState(1)
+        monitor = convergence.QuantileMonitor(0.05, min_toys = 20)
+        while not monitor.is_converged():
+            value = 10 + random.normal()
+            # Two results per toy, e.g. of two hypotheses
+            monitor.add([{ 'bounded_limit' : value },
+                         { 'bounded_limit' : 2*value }])
+            self.assertTrue(monitor.number_of_toys < 100000)
+        self.assertTrue(monitor.number_of_toys >= 20)
+        self.assertTrue(monitor.get_relative_precision() <= 0.05)
+        self.assertEqual(len(monitor.values), 2)
+
+    def test_missing_values(self):
+        monitor = convergence.QuantileMonitor(0.5, min_toys = 1)
+        for i in range(50):
+            monitor.add([{ 'bounded_limit' : numpy.nan }, {}])
+        self.assertEqual(monitor.number_of_toys, 50)
+        self.assertFalse(monitor.is_converged())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Checks find_root_brent on functions with known roots.  No ROOT is
+needed.
+"""
+import math
+import unittest
+from pyWIMP.utilities.utilities import find_root_brent
+
+class Counter:
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+    def __call__(self, x):
+        self.calls += 1
+        return self.func(x)
+
+class TestFindRootBrent(unittest.TestCase):
+
+    def test_roots(self):
+        self.assertAlmostEqual(find_root_brent(lambda x: x*x - 2, 0, 2,
+                                               tolerance = 1e-12),
+                               math.sqrt(2), 10)
+        self.assertAlmostEqual(find_root_brent(math.cos, 0, 3,
+                                               tolerance = 1e-12),
+                               0.5*math.pi, 10)
+        # Decreasing function, and the bracket given backwards
+        self.assertAlmostEqual(find_root_brent(lambda x: 1 - x**3, 5, -1,
+                                               tolerance = 1e-12), 1, 10)
+
+    def test_end_points(self):
+        self.assertEqual(find_root_brent(lambda x: x - 1, 1, 3), 1)
+        self.assertEqual(find_root_brent(lambda x: x - 3, 1, 3), 3)
+
+    def test_known_values(self):
+        # The values at the ends passed in are not evaluated again
+        func = Counter(lambda x: x - 0.3)
+        find_root_brent(func, 0, 1, -0.3, 0.7, tolerance = 1e-10)
+        without = Counter(lambda x: x - 0.3)
+        find_root_brent(without, 0, 1, tolerance = 1e-10)
+        self.assertEqual(without.calls, func.calls + 2)
+
+    def test_tolerances(self):
+        func = lambda x: math.exp(x) - 10
+        root = find_root_brent(func, 0, 5, tolerance = 1e-3)
+        self.assertTrue(math.fabs(root - math.log(10)) < 1e-3)
+        root = find_root_brent(func, 0, 5, tolerance = 1e-15,
+                               f_tolerance = 0.1)
+        self.assertTrue(math.fabs(func(root)) < 0.1)
+
+    def test_not_bracketed(self):
+        self.assertRaises(ValueError, find_root_brent, 
+                          lambda x: x*x + 1, -1, 1)
+
+if __name__ == '__main__':
+    unittest.main()
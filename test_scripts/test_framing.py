@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Checks that MessageReader puts the messages of write_message back
+together however the data arrives, and reports the end of the pipe.
+"""
+import os
+import unittest
+import cPickle as pickle
+from pyWIMP.utilities import framing
+
+class TestFraming(unittest.TestCase):
+
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def tearDown(self):
+        for fd in [self.read_fd, self.write_fd]:
+            try:
+                os.close(fd)
+            except OSError: pass
+
+    def test_messages(self):
+        messages = [('result', 1, 2, [{ 'a' : 1. }]), ('request',), None]
+        for message in messages: 
+            framing.write_message(self.write_fd, message)
+        os.close(self.write_fd)
+        reader = framing.MessageReader(self.read_fd)
+        self.assertEqual(reader.read(), (messages, False))
+        self.assertEqual(reader.read(), ([], True))
+
+    def test_partial_reads(self):
+        messages = [range(100), 'x'*1000, {'b' : 2}]
+        for message in messages: 
+            framing.write_message(self.write_fd, message)
+        os.close(self.write_fd)
+        # Read a few bytes at a time, so that the length and the 
+        # messages arrive in pieces
+        reader = framing.MessageReader(self.read_fd, read_size = 3)
+        got = []
+        while 1:
+            some, eof = reader.read()
+            got.extend(some)
+            if eof: break
+        self.assertEqual(got, messages)
+
+    def test_incomplete_message(self):
+        data = pickle.dumps(('request',), 2)
+        data = framing.header.pack(len(data)) + data
+        reader = framing.MessageReader(self.read_fd)
+        os.write(self.write_fd, data[:5])
+        self.assertEqual(reader.read(), ([], False))
+        os.write(self.write_fd, data[5:-1])
+        self.assertEqual(reader.read(), ([], False))
+        os.write(self.write_fd, data[-1:])
+        self.assertEqual(reader.read(), ([('request',)], False))
+
+    def test_read_message(self):
+        framing.write_message(self.write_fd, 1)
+        framing.write_message(self.write_fd, 2)
+        os.close(self.write_fd)
+        reader = framing.MessageReader(self.read_fd)
+        self.assertEqual([reader.read_message() for i in range(3)],
+                         [1, 2, None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Checks that the blocks of hybrid_job_engine.get_iteration_blocks hand
+out every iteration once.  Needs ROOT and mpi4py, which
+hybrid_job_engine imports, but runs on one rank.
+"""
+import unittest
+from pyWIMP.hybrid_job_engine import get_iteration_blocks
+
+class TestIterationBlocks(unittest.TestCase):
+
+    def check(self, number_of_ranks, num_cpus, num_iter, block_iter):
+        blocks = get_iteration_blocks(number_of_ranks, num_cpus,
+                                      num_iter, block_iter)
+        # Each block is run by num_cpus processes, process i doing the
+        # iterations first + i*number ... first + (i+1)*number - 1
+        iterations = []
+        for first, number in blocks:
+            self.assertTrue(0 < number <= block_iter)
+            iterations.extend(range(first, first + num_cpus*number))
+        self.assertEqual(iterations,
+                         range(number_of_ranks*num_cpus*num_iter))
+        self.assertEqual(sum([number for first, number in blocks]),
+                         number_of_ranks*num_iter)
+
+    def test_coverage(self):
+        for number_of_ranks in [1, 3]:
+            for num_cpus in [1, 4]:
+                for num_iter in [1, 5, 12]:
+                    for block_iter in [1, 2, 5, 100]:
+                        self.check(number_of_ranks, num_cpus,
+                                   num_iter, block_iter)
+
+    def test_one_block_per_rank(self):
+        self.assertEqual(get_iteration_blocks(3, 2, 5, 5),
+                         [(0, 5), (10, 5), (20, 5)])
+
+    def test_last_block_shorter(self):
+        self.assertEqual(get_iteration_blocks(1, 2, 5, 2),
+                         [(0, 2), (4, 2), (8, 1)])
+
+    def test_no_iterations(self):
+        self.assertEqual(get_iteration_blocks(2, 4, 0, 3), [])
+
+if __name__ == '__main__':
+    unittest.main()
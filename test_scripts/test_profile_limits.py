@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Checks the limits of profile_limits against parabolas, for which the
+crossings are known: a curve (x - mu)**2/(2*sigma**2) rises to level
+at mu +- sigma*sqrt(2*level).  No ROOT is needed.
+"""
+import math
+import unittest
+import numpy
+from pyWIMP.utilities import profile_limits
+
+def parabola(points, mu, sigma = 1.):
+    return (points - mu)**2/(2*sigma*sigma)
+
+class TestProfileLimits(unittest.TestCase):
+    level = 1.35
+
+    def assertClose(self, first, second, places = 9):
+        self.assertAlmostEqual(float(first), float(second), places)
+
+    def test_delta_nll_level(self):
+        # Half of the 90% quantile of chi^2 with 1 degree of freedom
+        self.assertClose(profile_limits.get_delta_nll_level(0.9),
+                         0.5*2.705543454095404, 6)
+        self.assertClose(profile_limits.get_delta_nll_level(0.6826894921),
+                         0.5, 6)
+
+    def test_quadratic_crossing(self):
+        x = numpy.array([[1., 2., 4.]])
+        y = parabola(x, 0.)
+        crossing = profile_limits.solve_quadratic_crossing(
+          x[:,0], y[:,0], x[:,1], y[:,1], x[:,2], y[:,2],
+          numpy.array([1.]))
+        self.assertClose(crossing[0], math.sqrt(2))
+        # The straight line without a third point
+        crossing = profile_limits.solve_quadratic_crossing(
+          x[:,0], y[:,0], x[:,1], y[:,1],
+          numpy.array([numpy.nan]), numpy.array([numpy.nan]),
+          numpy.array([1.]))
+        self.assertClose(crossing[0], 1 + (1 - 0.5)/(2 - 0.5))
+
+    def test_unbounded(self):
+        mu, sigma = 3., 1.5
+        points = mu + 0.37*numpy.arange(-20, 30)
+        limits = profile_limits.get_limits_at_level(
+          points, parabola(points, mu, sigma), self.level)
+        width = sigma*math.sqrt(2*self.level)
+        self.assertClose(limits['best_fit'][0], mu)
+        self.assertClose(limits['unbounded_upper_limit'][0], mu + width)
+        self.assertClose(limits['unbounded_lower_limit'][0], mu - width)
+        self.assertClose(limits['bounded_limit'][0], mu + width)
+
+    def test_lower_limit_at_zero(self):
+        # The lower crossing is below 0, so the lower limit is 0
+        mu = 0.5
+        points = 0.25*numpy.arange(-20, 40)
+        limits = profile_limits.get_limits_at_level(
+          points, parabola(points, mu), self.level)
+        self.assertClose(limits['unbounded_lower_limit'][0], 0)
+        self.assertClose(limits['unbounded_upper_limit'][0],
+                         mu + math.sqrt(2*self.level))
+
+    def test_negative_best_fit(self):
+        mu = -1.
+        points = 0.25*numpy.arange(-16, 40)
+        delta_nll = parabola(points, mu)
+        zero_nll = parabola(0., mu)
+        bounded = mu + math.sqrt(2*(zero_nll + self.level))
+        for given_zero_nll in [None, zero_nll]:
+            limits = profile_limits.get_limits_at_level(
+              points, delta_nll, self.level, given_zero_nll)
+            self.assertClose(limits['best_fit'][0], mu)
+            self.assertClose(limits['unbounded_lower_limit'][0], mu)
+            self.assertClose(limits['unbounded_upper_limit'][0],
+                             mu + math.sqrt(2*self.level))
+            self.assertClose(limits['bounded_limit'][0], bounded)
+
+    def test_not_reaching_level(self):
+        points = numpy.arange(0., 2., 0.25)
+        limits = profile_limits.get_limits_at_level(
+          points, parabola(points, 1.), self.level)
+        self.assertTrue(numpy.isnan(limits['unbounded_upper_limit'][0]))
+        self.assertTrue(numpy.isnan(limits['bounded_limit'][0]))
+
+    def test_padded_rows(self):
+        # Curves of different lengths, padded with NaN, give the same
+        # limits as each curve alone
+        curves = [(0.3*numpy.arange(-10, 30), 2.),
+                  (0.2*numpy.arange(-30, 20), -1.),
+                  (0.5*numpy.arange(0, 12), 1.)]
+        number_of_points = max([len(points) for points, mu in curves])
+        all_points = numpy.zeros((len(curves), number_of_points))*numpy.nan
+        all_delta_nll = all_points.copy()
+        for i, (points, mu) in enumerate(curves):
+            all_points[i, :len(points)] = points
+            all_delta_nll[i, :len(points)] = parabola(points, mu)
+        limits = profile_limits.get_limits_at_level(all_points,
+                                                    all_delta_nll,
+                                                    self.level)
+        for i, (points, mu) in enumerate(curves):
+            alone = profile_limits.get_limits_at_level(
+              points, parabola(points, mu), self.level)
+            for name in alone.keys():
+                self.assertClose(limits[name][i], alone[name][0])
+
+    def test_get_limits(self):
+        points = 0.1*numpy.arange(-10, 60)
+        limits = profile_limits.get_limits(points, parabola(points, 2.),
+                                           0.9, mult_factor = 10.)
+        self.assertClose(limits['unbounded_upper_limit'][0],
+          10*(2 + math.sqrt(2*profile_limits.get_delta_nll_level(0.9))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Checks the collection of results with different keys into columns
+(result_writer.ColumnBuffer).  No ROOT is needed.
+"""
+import unittest
+import numpy
+from pyWIMP.utilities import result_writer
+
+def same(first, second):
+    first, second = numpy.asarray(first), numpy.asarray(second)
+    return first.shape == second.shape and \
+           ((first == second) | (numpy.isnan(first) & numpy.isnan(second))).all()
+
+class TestColumnBuffer(unittest.TestCase):
+
+    def test_missing_keys(self):
+        columns, objects = result_writer.collect_columns(
+          [{ 'a' : 1, 'b' : 2. }, { 'a' : 3 }, { 'b' : 4., 'c' : 'x' }])
+        self.assertEqual(sorted(columns.keys()), ['a', 'b'])
+        self.assertTrue(same(columns['a'], [1, 3, numpy.nan]))
+        self.assertTrue(same(columns['b'], [2, numpy.nan, 4]))
+        self.assertEqual(objects, {})
+
+    def test_arrays_padded(self):
+        columns, objects = result_writer.collect_columns(
+          [{ 'scan' : numpy.arange(2.) }, {},
+           { 'scan' : numpy.arange(3.) }])
+        self.assertTrue(same(columns['scan'],
+                             [[0, 1, numpy.nan], [numpy.nan]*3, [0, 1, 2]]))
+
+    def test_number_then_array(self):
+        columns, objects = result_writer.collect_columns(
+          [{ 'a' : 1. }, { 'a' : numpy.arange(3.) }, { 'a' : 5 }])
+        self.assertTrue(same(columns['a'],
+                             [[1, numpy.nan, numpy.nan], [0, 1, 2],
+                              [5, numpy.nan, numpy.nan]]))
+
+    def test_growing(self):
+        buffer = result_writer.ColumnBuffer(chunk_size = 2)
+        for i in range(5): buffer.add({ 'a' : i })
+        self.assertEqual(len(buffer), 5)
+        self.assertTrue(same(buffer.get_columns()[0]['a'], range(5)))
+
+    def test_add_columns(self):
+        first = result_writer.ColumnBuffer()
+        first.extend([{ 'a' : 1., 'scan' : numpy.arange(2.) }])
+        second = result_writer.ColumnBuffer()
+        second.extend([{ 'a' : 2. }, { 'b' : 3., 'scan' : numpy.arange(3.) }])
+        columns, objects = second.get_columns()
+        first.add_columns(columns, objects, len(second))
+        columns = first.get_columns()[0]
+        self.assertTrue(same(columns['a'], [1, 2, numpy.nan]))
+        self.assertTrue(same(columns['b'], [numpy.nan, numpy.nan, 3]))
+        self.assertTrue(same(columns['scan'],
+          [[0, 1, numpy.nan], [numpy.nan]*3, [0, 1, 2]]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Checks the points and output file names of a sweep
+(sweep_runner.get_sweep_points and get_output_file).  Needs ROOT,
+which sweep_runner imports through calc_objects.
+"""
+import unittest
+from pyWIMP.sweep_runner import get_sweep_points, get_output_file
+
+class TestSweepPoints(unittest.TestCase):
+    input_variables = { 'mass_of_wimp' : 10., 'num_iter' : 5,
+                        'constrain_to_zero' : False, 'model' : 'WIMP' }
+
+    def test_product(self):
+        keys, points = get_sweep_points(self.input_variables,
+                                        ['mass_of_wimp=5,10,20',
+                                         'num_iter=1,2'])
+        self.assertEqual(keys, ['mass_of_wimp', 'num_iter'])
+        self.assertEqual([(point['mass_of_wimp'], point['num_iter'])
+                          for point in points],
+                         [(5, 1), (5, 2), (10, 1), (10, 2), (20, 1), (20, 2)])
+        # The other variables are kept, and the input isn't changed
+        for point in points:
+            self.assertEqual(point['model'], 'WIMP')
+            self.assertEqual(point['constrain_to_zero'], False)
+        self.assertEqual(self.input_variables['mass_of_wimp'], 10.)
+
+    def test_conversion(self):
+        keys, points = get_sweep_points(self.input_variables,
+                                        ['mass_of_wimp=7.5',
+                                         'num_iter=3',
+                                         'constrain_to_zero=1,True,yes,0,no',
+                                         'model=Other'])
+        self.assertEqual(len(points), 5)
+        self.assertEqual(points[0]['mass_of_wimp'], 7.5)
+        # ints are read as floats, as with the command line options
+        self.assertEqual(points[0]['num_iter'], 3.)
+        self.assertTrue(isinstance(points[0]['num_iter'], float))
+        self.assertEqual([point['constrain_to_zero'] for point in points],
+                         [True, True, True, False, False])
+        self.assertEqual(points[0]['model'], 'Other')
+
+    def test_value_with_equals(self):
+        keys, points = get_sweep_points(self.input_variables, ['model=a=b'])
+        self.assertEqual(points[0]['model'], 'a=b')
+
+    def test_no_sweep(self):
+        keys, points = get_sweep_points(self.input_variables, [])
+        self.assertEqual(keys, [])
+        self.assertEqual(points, [self.input_variables])
+
+    def test_unknown_key(self):
+        self.assertRaises(KeyError, get_sweep_points, self.input_variables,
+                          ['mass=10'])
+
+    def test_output_file(self):
+        keys, points = get_sweep_points(self.input_variables,
+                                        ['mass_of_wimp=5', 'num_iter=2'])
+        self.assertEqual(get_output_file('out/limits.root', keys, points[0]),
+                         'out/limits_mass_of_wimp_5.0_num_iter_2.0.root')
+        self.assertEqual(get_output_file('limits', [], points[0]), 'limits')
+
+if __name__ == '__main__':
+    unittest.main()
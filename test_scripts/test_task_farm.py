@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Checks the splitting of iterations into batches and their merging
+back (task_farm), and a TaskFarm with a checkpoint on one rank.  Needs
+mpi4py, but not ROOT.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from mpi4py import MPI
+from pyWIMP.utilities.task_farm import split_into_batches, merge_batches, \
+                                       TaskFarm
+
+def work(unit):
+    index, point, number = unit
+    return [(point, i) for i in range(number)]
+
+class TestBatches(unittest.TestCase):
+
+    def test_split(self):
+        units = split_into_batches(['a', 'b'], 5, 2)
+        self.assertEqual(units, [(0, 'a', 2), (0, 'a', 2), (0, 'a', 1),
+                                 (1, 'b', 2), (1, 'b', 2), (1, 'b', 1)])
+        self.assertEqual(split_into_batches(['a'], 3, 10), [(0, 'a', 3)])
+        self.assertEqual(split_into_batches(['a'], 0, 10), [])
+
+    def test_round_trip(self):
+        points = [10., 20., 30.]
+        for number_iterations in [1, 4, 7]:
+            for batch_size in [1, 3, 7, 100]:
+                units = split_into_batches(points, number_iterations,
+                                           batch_size)
+                merged = merge_batches(units, [work(unit) for unit in units],
+                                       len(points))
+                self.assertEqual(len(merged), len(points))
+                for point, results in zip(points, merged):
+                    self.assertEqual(len(results), number_iterations)
+                    self.assertEqual(set([apoint for apoint, i in results]),
+                                     set([point]))
+
+    def test_merge_out_of_order(self):
+        units = [(1, 'b', 1), (0, 'a', 2), (1, 'b', 2)]
+        merged = merge_batches(units, [['b0'], ['a0', 'a1'], ['b1', 'b2']], 3)
+        self.assertEqual(merged, [['a0', 'a1'], ['b0', 'b1', 'b2'], []])
+
+class TestTaskFarm(unittest.TestCase):
+    header = { 'model' : 'WIMPModel' }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'farm.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run(self):
+        units = split_into_batches([1., 2.], 3, 2)
+        results = TaskFarm(MPI.COMM_SELF).run(units, work)
+        self.assertEqual(results, [work(unit) for unit in units])
+
+    def test_resume(self):
+        units = split_into_batches([1., 2.], 3, 2)
+        # The results of the first point aren't saved, as if stopped
+        farm = TaskFarm(MPI.COMM_SELF, 0, self.path, self.header)
+        farm.run(units, work, lambda results: results[0][0] != 1.)
+        done = []
+        def record(unit):
+            done.append(unit)
+            return work(unit)
+        farm = TaskFarm(MPI.COMM_SELF, 0, self.path, self.header, True)
+        results = farm.run(units, record)
+        self.assertEqual(done, [unit for unit in units if unit[1] == 1.])
+        self.assertEqual(results, [work(unit) for unit in units])
+
+    def test_other_job(self):
+        TaskFarm(MPI.COMM_SELF, 0, self.path, self.header).run([], work)
+        self.assertRaises(ValueError, TaskFarm, MPI.COMM_SELF, 0, self.path,
+                          { 'model' : 'OtherModel' }, True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Checks the TaskQueue shared by forked processes: every iteration is
+got once, in order, and the queue ends with None once closed.
+"""
+import os
+import unittest
+from pyWIMP.utilities.task_queue import TaskQueue
+
+class TestTaskQueue(unittest.TestCase):
+
+    def test_in_order(self):
+        queue = TaskQueue()
+        for iteration in [5, 3, 2**40]: queue.put(iteration)
+        queue.close_writer()
+        self.assertEqual([queue.get() for i in range(4)],
+                         [5, 3, 2**40, None])
+        queue.close_reader()
+
+    def test_close_twice(self):
+        queue = TaskQueue()
+        queue.close_writer()
+        queue.close_writer()
+        self.assertEqual(queue.get(), None)
+        queue.close_reader()
+        queue.close_reader()
+
+    def test_shared_by_processes(self):
+        number_of_processes = 3
+        queue = TaskQueue()
+        iterations = range(200)
+        readers = []
+        for i in range(number_of_processes):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid:
+                os.close(w)
+                readers.append((pid, r))
+                continue
+            # Each process takes iterations until the queue is empty,
+            # and sends them back in the same format
+            os.close(r)
+            queue.close_writer()
+            while 1:
+                iteration = queue.get()
+                if iteration is None: break
+                os.write(w, queue.record.pack(iteration))
+            os._exit(0)
+        queue.close_reader()
+        for iteration in iterations: queue.put(iteration)
+        queue.close_writer()
+        got = []
+        for pid, r in readers:
+            data = ''
+            while 1:
+                some = os.read(r, 4096)
+                if not some: break
+                data += some
+            os.close(r)
+            os.waitpid(pid, 0)
+            size = queue.record.size
+            got.extend([queue.record.unpack(data[i:i+size])[0]
+                        for i in range(0, len(data), size)])
+        got.sort()
+        self.assertEqual(got, list(iterations))
+
+if __name__ == '__main__':
+    unittest.main()